@@ -0,0 +1,407 @@
+import hashlib
+import json
+import os
+import pickle
+import re
+import boto3
+import tempfile
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on windows, where the index is not locked
+    fcntl = None
+
+from etl_manager.utils import write_json, read_json, _athena_client
+
+_quoted_string_regex = re.compile(r"('(?:[^']|'')*'|\"(?:[^\"]|\"\")*\")")
+_comment_regex = re.compile(r"--[^\n]*|/\*.*?\*/", re.DOTALL)
+
+
+def _normalise_sql(sql):
+    """
+    Normalise sql so that queries differing only in comments, whitespace, keyword case or a trailing semicolon share a cache key.
+    Quoted strings are left untouched.
+    """
+    parts = _quoted_string_regex.split(sql)
+    for i in range(0, len(parts), 2):
+        part = _comment_regex.sub(" ", parts[i])
+        parts[i] = re.sub(r"\s+", " ", part).lower()
+    return "".join(parts).strip().rstrip(";").strip()
+
+
+def _sql_database_names(normalised_sql):
+    """
+    Returns the set of database names used to qualify tables (database.table) after from or join in normalised sql
+    """
+    # Drop string literals but keep quoted identifiers
+    without_strings = re.sub(r"'(?:[^']|'')*'", "''", normalised_sql)
+    return set(n.lower() for n in re.findall(r"\b(?:from|join)\s+\"?(\w+)\"?\s*\.\s*\"?\w+", without_strings))
+
+
+def _sql_references_table(normalised_sql, database_name, table_name):
+    unquoted = " ".join(_quoted_string_regex.split(normalised_sql)[::2])
+    return re.search(r"(?<![\w.])(?:\"?{}\"?\.)?\"?{}\"?(?![\w])".format(re.escape(database_name), re.escape(table_name)), unquoted) is not None
+
+
+class QueryCache:
+    """
+    Local, size capped cache of Athena query results.
+
+    Results are stored under a key made from the normalised sql and a fingerprint of the data the query reads
+    (the object count, total size and latest modified time of the s3 location of each table it references).
+    So a cached result is only reused while none of those tables have changed and it is younger than ttl seconds.
+    Once the results stored in cache_dir exceed max_size_bytes the least recently used results are removed.
+    Several processes can share cache_dir: updates to its index are made under a file lock (except on windows).
+
+    cache = QueryCache('.athena_cache/', ttl = 3600)
+    for batch in db.query("SELECT * FROM my_table", cache = cache) :
+        ...
+    """
+
+    def __init__(self, cache_dir, ttl = 3600, max_size_bytes = 1024**3):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_size_bytes = max_size_bytes
+        os.makedirs(cache_dir, exist_ok = True)
+
+    @property
+    def _index_path(self):
+        return os.path.join(self.cache_dir, "index.json")
+
+    @contextmanager
+    def _index_lock(self):
+        """
+        Hold an exclusive lock on the index while it is read, changed and written back
+        """
+        with open(os.path.join(self.cache_dir, "index.lock"), "a") as f:
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _read_index(self):
+        if os.path.exists(self._index_path):
+            return read_json(self._index_path)
+        return {}
+
+    def _write_index(self, index):
+        write_json(index, self._index_path)
+
+    def _result_path(self, key):
+        return os.path.join(self.cache_dir, key + ".pickle")
+
+    def key(self, sql, fingerprints, **options):
+        """
+        Returns the cache key for sql given a dict of table fingerprints and any other options that change the results.
+        """
+        key_data = {"sql": _normalise_sql(sql), "fingerprints": fingerprints, "options": options}
+        return hashlib.sha256(json.dumps(key_data, sort_keys = True, default = str).encode("utf-8")).hexdigest()
+
+    def __contains__(self, key):
+        index = self._read_index()
+        return key in index and time.time() - index[key]["created"] <= self.ttl and os.path.exists(self._result_path(key))
+
+    def _remove(self, index, key):
+        index.pop(key, None)
+        if os.path.exists(self._result_path(key)):
+            os.remove(self._result_path(key))
+
+    def get(self, key):
+        """
+        Returns a generator of the cached record batches for key or None if there is no (unexpired) result cached.
+        """
+        with self._index_lock():
+            index = self._read_index()
+            if key not in index:
+                return None
+            if key not in self:
+                self._remove(index, key)
+                self._write_index(index)
+                return None
+
+            index[key]["last_used"] = time.time()
+            self._write_index(index)
+        return self._read_batches(self._result_path(key))
+
+    def _read_batches(self, path):
+        with open(path, "rb") as f:
+            while True:
+                try:
+                    yield pickle.load(f)
+                except EOFError:
+                    break
+
+    def put(self, key, batches):
+        """
+        Wraps a generator of record batches so that each batch is written to the cache as it is yielded.
+        The result is only added to the cache once the generator has been fully consumed.
+        """
+        fd, tmp_path = tempfile.mkstemp(dir = self.cache_dir, suffix = ".tmp")
+        complete = False
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for batch in batches:
+                    pickle.dump(batch, f, protocol = pickle.HIGHEST_PROTOCOL)
+                    yield batch
+            complete = True
+        finally:
+            if complete:
+                with self._index_lock():
+                    os.replace(tmp_path, self._result_path(key))
+                    now = time.time()
+                    index = self._read_index()
+                    index[key] = {"created": now, "last_used": now, "size": os.path.getsize(self._result_path(key))}
+                    self._evict(index)
+                    self._write_index(index)
+            elif os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _evict(self, index):
+        now = time.time()
+        for k in [k for k, v in index.items() if now - v["created"] > self.ttl]:
+            self._remove(index, k)
+
+        total_size = sum(v["size"] for v in index.values())
+        for k in sorted(index, key = lambda k: index[k]["last_used"]):
+            if total_size <= self.max_size_bytes:
+                break
+            total_size -= index[k]["size"]
+            self._remove(index, k)
+
+    def clear(self):
+        with self._index_lock():
+            index = self._read_index()
+            for k in list(index):
+                self._remove(index, k)
+            self._write_index(index)
+
+
+class AthenaQueryError(Exception):
+    pass
+
+
+# Converters from the Athena api (string) result values to python values. Other types are left as strings
+_athena_type_converters = {
+    "boolean": lambda v: v == "true",
+    "tinyint": int,
+    "smallint": int,
+    "integer": int,
+    "bigint": int,
+    "float": float,
+    "real": float,
+    "double": float,
+}
+
+
+class AthenaApiCursor:
+    """
+    DB-API style cursor that runs queries through the Athena api (start_query_execution, get_query_execution and get_query_results).
+    Query status is polled with an interval that starts at poll_interval and grows (by 1.5 times) to max_poll_interval, and results
+    are read a page at a time as they are fetched.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.description = None
+        self.query_execution_id = None
+        self._rows = []
+        self._next_token = None
+        self._converters = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._rows = []
+        self._next_token = None
+
+    def execute(self, sql):
+        conn = self.connection
+        kwargs = {"QueryString": sql, "ResultConfiguration": {"OutputLocation": conn.s3_staging_dir}}
+        if conn.schema_name:
+            kwargs["QueryExecutionContext"] = {"Database": conn.schema_name}
+        self.query_execution_id = conn.client.start_query_execution(**kwargs)["QueryExecutionId"]
+
+        execution = self._wait_for_query()
+        self._next_token = None
+        self._rows = []
+        self._read_page(first_page = True, has_header = execution.get("StatementType") == "DML")
+
+    def _wait_for_query(self):
+        conn = self.connection
+        interval = conn.poll_interval
+        while True:
+            execution = conn.client.get_query_execution(QueryExecutionId = self.query_execution_id)["QueryExecution"]
+            state = execution["Status"]["State"]
+            if state == "SUCCEEDED":
+                return execution
+            if state in ["FAILED", "CANCELLED"]:
+                reason = execution["Status"].get("StateChangeReason", "Unknown")
+                raise AthenaQueryError(f"Athena query {self.query_execution_id} {state.lower()}: {reason}")
+            time.sleep(interval)
+            interval = min(interval * 1.5, conn.max_poll_interval)
+
+    def _read_page(self, first_page = False, has_header = False):
+        kwargs = {"QueryExecutionId": self.query_execution_id, "MaxResults": self.connection.page_size}
+        if self._next_token:
+            kwargs["NextToken"] = self._next_token
+        response = self.connection.client.get_query_results(**kwargs)
+        self._next_token = response.get("NextToken")
+
+        if first_page:
+            column_info = response["ResultSet"]["ResultSetMetadata"]["ColumnInfo"]
+            self.description = [(c["Name"], c["Type"], None, None, c.get("Precision"), c.get("Scale"), c.get("Nullable") != "NOT_NULL") for c in column_info]
+            self._converters = [_athena_type_converters.get(c["Type"]) for c in column_info]
+
+        rows = response["ResultSet"]["Rows"]
+        # The first row of a select's results is the column names
+        if first_page and has_header:
+            rows = rows[1:]
+        for row in rows:
+            values = [d.get("VarCharValue") for d in row["Data"]]
+            self._rows.append(tuple(f(v) if f and v is not None else v for f, v in zip(self._converters, values)))
+
+    def fetchmany(self, size):
+        while len(self._rows) < size and self._next_token:
+            self._read_page()
+        rows, self._rows = self._rows[:size], self._rows[size:]
+        return rows
+
+    def fetchall(self):
+        while self._next_token:
+            self._read_page()
+        rows, self._rows = self._rows, []
+        return rows
+
+
+class AthenaApiConnection:
+    """
+    Connection for the "api" backend. Takes the same arguments as pyathenajdbc.connect (s3_staging_dir, region_name and schema_name).
+    """
+
+    def __init__(self, s3_staging_dir, region_name = None, schema_name = None, poll_interval = 0.2, max_poll_interval = 5, page_size = 1000):
+        self.s3_staging_dir = s3_staging_dir
+        self.schema_name = schema_name
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.page_size = page_size
+        if region_name and region_name != _athena_client.meta.region_name:
+            self.client = boto3.client("athena", region_name)
+        else:
+            self.client = _athena_client
+
+    def cursor(self):
+        return AthenaApiCursor(self)
+
+    def close(self):
+        pass
+
+
+class FakeAthenaBackend:
+    """
+    Local stand in for Athena to use in tests. Records every query run and returns the rows set with add_result for the
+    matching (normalised) sql. Queries without a result (e.g. MSCK REPAIR TABLE) return no rows.
+
+    backend = FakeAthenaBackend()
+    backend.add_result("SELECT * FROM db.my_table", ["a", "b"], [(1, "x")])
+    set_default_backend(backend)
+    """
+
+    def __init__(self):
+        self.results = {}
+        self.executed = []
+
+    def add_result(self, sql, column_names, rows):
+        self.results[_normalise_sql(sql)] = (list(column_names), list(rows))
+
+    def __call__(self, **kwargs):
+        return _FakeAthenaConnection(self, kwargs)
+
+
+class _FakeAthenaConnection:
+    def __init__(self, backend, connect_kwargs):
+        self.backend = backend
+        self.connect_kwargs = connect_kwargs
+
+    def cursor(self):
+        return _FakeAthenaCursor(self)
+
+    def close(self):
+        pass
+
+
+class _FakeAthenaCursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.description = None
+        self._rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, sql):
+        backend = self.connection.backend
+        backend.executed.append((sql, self.connection.connect_kwargs))
+        column_names, rows = backend.results.get(_normalise_sql(sql), ([], []))
+        self.description = [(n, None, None, None, None, None, True) for n in column_names]
+        self._rows = list(rows)
+
+    def fetchmany(self, size):
+        rows, self._rows = self._rows[:size], self._rows[size:]
+        return rows
+
+    def fetchall(self):
+        rows, self._rows = self._rows, []
+        return rows
+
+
+def _jdbc_connect(**kwargs):
+    # Imported here so the JVM is only needed when the jdbc backend is used
+    from pyathenajdbc import connect
+    return connect(**kwargs)
+
+
+_backends = {
+    "jdbc": _jdbc_connect,
+    "api": AthenaApiConnection,
+}
+
+_default_backend = os.environ.get("ETL_MANAGER_ATHENA_BACKEND", "jdbc")
+
+
+def set_default_backend(backend):
+    """
+    Set the Athena backend used when none is given to a call. backend is "jdbc" (pyathenajdbc, the default), "api"
+    (the Athena api through boto3, no JVM needed) or a callable taking connect arguments, such as a FakeAthenaBackend.
+    The default can also be set with the ETL_MANAGER_ATHENA_BACKEND environment variable.
+    """
+    global _default_backend
+    _get_backend(backend)
+    _default_backend = backend
+
+
+def _get_backend(backend):
+    if callable(backend):
+        return backend
+    if backend not in _backends:
+        raise ValueError(f"Athena backend must be one of {', '.join(_backends)} or a callable")
+    return _backends[backend]
+
+
+def _athena_connect(backend = None, **kwargs):
+    """
+    Returns a DB-API style connection from backend (defaults to the default backend)
+    """
+    return _get_backend(_default_backend if backend is None else backend)(**kwargs)
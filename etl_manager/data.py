@@ -0,0 +1,630 @@
+"""
+Helpers to stream local data files in bounded chunks and check their values against our agnostic data types.
+
+Values are tested a whole chunk at a time: the chunk of a column is joined into a single string and matched against
+one compiled regex, so the per value work happens inside the regex engine rather than in a python loop. Only when a
+chunk fails (or contains embedded newlines) do we fall back to checking values one at a time.
+"""
+
+import bz2
+import csv
+import datetime
+import gzip
+import io
+import json
+import os
+import re
+import struct
+import warnings
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice, zip_longest
+
+_default_chunk_size = 50000
+
+_int_min, _int_max = -2**31, 2**31 - 1
+_long_min, _long_max = -2**63, 2**63 - 1
+
+_date_pattern = r"\d{4}-(?:0[1-9]|1[0-2])-(?:0[1-9]|[12]\d|3[01])"
+
+_type_patterns = {
+    "boolean": r"(?:true|false|True|False|TRUE|FALSE)",
+    "int": r"[-+]?\d+",
+    "long": r"[-+]?\d+",
+    "float": r"[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?",
+    "double": r"[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?",
+    "date": _date_pattern,
+    "datetime": _date_pattern + r"[ T](?:[01]\d|2[0-3]):[0-5]\d:[0-5]\d(?:\.\d{1,9})?",
+}
+
+_value_regex = {k: re.compile(v) for k, v in _type_patterns.items()}
+_chunk_regex = {k: re.compile("{0}(?:\n{0})*".format(v)) for k, v in _type_patterns.items()}
+
+# Types a column can widen to once it has been seen as the key type (in order of preference)
+_widening = {
+    None: ["boolean", "int", "long", "double", "date", "datetime"],
+    "boolean": ["boolean"],
+    "int": ["int", "long", "double"],
+    "long": ["long", "double"],
+    "float": ["float", "double"],
+    "double": ["double"],
+    "date": ["date", "datetime"],
+    "datetime": ["datetime"],
+    "character": ["character"],
+}
+
+_python_converters = {
+    "character": str,
+    "int": int,
+    "long": int,
+    "float": float,
+    "double": float,
+    "date": lambda v: datetime.datetime.strptime(v[:10], "%Y-%m-%d").date(),
+    "datetime": lambda v: datetime.datetime.strptime(v.replace("T", " ")[:26], "%Y-%m-%d %H:%M:%S.%f" if "." in v else "%Y-%m-%d %H:%M:%S"),
+    "boolean": lambda v: v.lower() == "true",
+}
+
+_file_formats = {
+    ".csv": "csv",
+    ".jsonl": "json",
+    ".json": "json",
+}
+
+
+def _convert_value(data_type, value):
+    """
+    Convert a string value to the python type of data_type. Values that are not strings are assumed to already be
+    converted and empty strings are treated as nulls.
+    """
+    if not isinstance(value, str):
+        return value
+    if value == "" and data_type != "character":
+        return None
+    return _python_converters[data_type](value)
+
+
+def _open_text(file_path):
+    if file_path.endswith(".gz"):
+        return gzip.open(file_path, "rt", newline="")
+    return open(file_path, "r", newline="")
+
+
+def _file_format_from_path(file_path):
+    base = file_path[:-3] if file_path.endswith(".gz") else file_path
+    ext = os.path.splitext(base)[1].lower()
+    if ext not in _file_formats:
+        raise ValueError("Cannot infer the file format of {}. Expected one of the extensions: {}".format(file_path, ", ".join(_file_formats)))
+    return _file_formats[ext]
+
+
+def _list_data_files(data_path):
+    """
+    Returns a sorted list of files under data_path (or data_path itself if it is a file). Hidden files are skipped.
+    """
+    if os.path.isfile(data_path):
+        return [data_path]
+
+    files = []
+    for root, dirs, filenames in os.walk(data_path):
+        dirs[:] = sorted(d for d in dirs if not d.startswith(('.', '_')))
+        files.extend(os.path.join(root, f) for f in sorted(filenames) if not f.startswith(('.', '_')))
+    return files
+
+
+def _partition_values_from_path(file_path, base_path):
+    """
+    Returns an ordered list of (key, value) tuples from the hive style key=value folders between base_path and the file.
+    """
+    rel_folder = os.path.dirname(os.path.relpath(file_path, base_path))
+    parts = []
+    for segment in rel_folder.split(os.sep):
+        if "=" in segment:
+            k, v = segment.split("=", 1)
+            parts.append((k, v))
+    return parts
+
+
+def _clean_column_name(name):
+    name = re.sub(r"[^a-z0-9_]", "_", name.strip().lower())
+    return name if name else "col"
+
+
+def _stringify_json_value(v):
+    if v is None:
+        return ""
+    if isinstance(v, bool):
+        return "true" if v else "false"
+    if isinstance(v, (dict, list)):
+        return json.dumps(v)
+    return str(v)
+
+
+def _iter_csv_chunks(file_path, chunk_size, header, quoting = csv.QUOTE_MINIMAL, delimiter = ","):
+    """
+    Yields (column_names, list_of_rows) for chunks of at most chunk_size rows. column_names is None if header is False.
+    """
+    with _open_text(file_path) as f:
+        reader = csv.reader(f, delimiter=delimiter, quoting=quoting)
+        names = None
+        if header:
+            names = next(reader, None)
+            if names is None:
+                return
+        first = True
+        while True:
+            rows = list(islice(reader, chunk_size))
+            # A file with only a header still has its column names
+            if not rows and not (first and names is not None):
+                break
+            yield names, rows
+            if not rows:
+                break
+            first = False
+
+
+def _iter_json_chunks(file_path, chunk_size):
+    """
+    Yields (column_names, list_of_rows) for chunks of newline delimited json. Values are converted to strings so
+    they can be checked in the same way as csv values.
+    """
+    names = []
+    name_set = set()
+    with _open_text(file_path) as f:
+        records = []
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            records.append(json.loads(line))
+            if len(records) >= chunk_size:
+                yield _json_records_to_rows(records, names, name_set)
+                records = []
+        if records:
+            yield _json_records_to_rows(records, names, name_set)
+
+
+def _json_records_to_rows(records, names, name_set):
+    for r in records:
+        for k in r:
+            if k not in name_set:
+                name_set.add(k)
+                names.append(k)
+    rows = [[_stringify_json_value(r.get(k)) for k in names] for r in records]
+    return list(names), rows
+
+
+def _iter_data_chunks(file_path, file_format, chunk_size, header = False, quoting = csv.QUOTE_MINIMAL, delimiter = ","):
+    if file_format == "json":
+        return _iter_json_chunks(file_path, chunk_size)
+    return _iter_csv_chunks(file_path, chunk_size, header, quoting=quoting, delimiter=delimiter)
+
+
+def _columns_from_rows(rows, n_cols):
+    """
+    Transpose a chunk of rows into columns padding short rows with empty strings (nulls).
+    """
+    padded = [[""] * n_cols] + rows
+    return [list(c[1:]) for c in zip_longest(*padded, fillvalue="")][:n_cols]
+
+
+def _chunk_matches(data_type, values):
+    """
+    Returns True if every (non null) value in values is a valid instance of data_type.
+    """
+    if data_type == "character":
+        return True
+    if not values:
+        return True
+    joined = "\n".join(values)
+    if joined.count("\n") != len(values) - 1:
+        return all(_value_matches(data_type, v) for v in values)
+    if _chunk_regex[data_type].fullmatch(joined) is None:
+        return False
+    if data_type in ("int", "long"):
+        lo, hi = (_int_min, _int_max) if data_type == "int" else (_long_min, _long_max)
+        ints = list(map(int, values))
+        return lo <= min(ints) and max(ints) <= hi
+    return True
+
+
+def _value_matches(data_type, value):
+    if data_type == "character" or value == "":
+        return True
+    if _value_regex[data_type].fullmatch(value) is None:
+        return False
+    if data_type == "int":
+        return _int_min <= int(value) <= _int_max
+    if data_type == "long":
+        return _long_min <= int(value) <= _long_max
+    return True
+
+
+def _infer_values_type(values, current_type = None):
+    """
+    Returns the narrowest type that every value in values (and everything seen before as current_type) fits into.
+    None is returned when no non null values have been seen yet.
+    """
+    values = list(filter(None, values))
+    if not values:
+        return current_type
+    for t in _widening[current_type]:
+        if _chunk_matches(t, values):
+            return t
+    return "character"
+
+
+def _merge_types(a, b):
+    """
+    Returns the narrowest type that both type a and type b can be widened to.
+    """
+    if a is None:
+        return b
+    if b is None:
+        return a
+    for t in _widening[a]:
+        if t in _widening[b]:
+            return t
+    return "character"
+
+
+def _needs_quoting(values, delimiter):
+    joined = "\n".join(values)
+    return delimiter in joined or '"' in joined or "\r" in joined or joined.count("\n") != len(values) - 1
+
+
+def _infer_file_types(file_path, file_format, chunk_size, header, delimiter):
+    """
+    Infer the column types of a single file streaming it in chunks.
+    Returns (column_names, {name: type}, n_rows, quoted) where quoted is True if any csv value needed quoting.
+    """
+    names = None
+    types = []
+    n_rows = 0
+    quoted = False
+    for chunk_names, rows in _iter_data_chunks(file_path, file_format, chunk_size, header=header, delimiter=delimiter):
+        if chunk_names is not None:
+            names = chunk_names
+        n_cols = len(names) if names is not None else max(len(r) for r in rows)
+        if names is None and n_cols > len(types):
+            types = types + [None] * (n_cols - len(types))
+        elif names is not None:
+            types = types + [None] * (len(names) - len(types))
+        for i, col in enumerate(_columns_from_rows(rows, len(types))):
+            if types[i] != "character":
+                types[i] = _infer_values_type(col, types[i])
+            if file_format == "csv" and not quoted and col:
+                quoted = _needs_quoting(col, delimiter)
+        n_rows += len(rows)
+
+    if names is None:
+        names = ["col_{}".format(i + 1) for i in range(len(types))]
+
+    return list(names), dict(zip(names, types)), n_rows, quoted
+
+
+def _infer_file_types_star(args):
+    return _infer_file_types(*args)
+
+
+def _map_files(func, arg_list, max_workers):
+    """
+    Run func over arg_list in a process pool (or in process if there is only one task or max_workers == 1).
+    """
+    if max_workers == 1 or len(arg_list) <= 1:
+        return [func(a) for a in arg_list]
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(func, arg_list))
+
+
+def infer_column_types(data_path, file_format = None, header = True, delimiter = ",", chunk_size = _default_chunk_size, max_workers = None):
+    """
+    Infer agnostic column types from the data file(s) at data_path (a file or folder).
+    Files are streamed in chunks of chunk_size rows so memory use is bounded by the chunk size, and multiple files
+    are processed in parallel over max_workers processes (defaults to the number of cpus).
+    Partition columns are inferred from key=value folder names between data_path and each file.
+    Returns a tuple (columns, partitions) where columns is a list of {"name", "type", "description"} dicts.
+    """
+    columns, partitions, _ = _infer_columns(data_path, file_format, header, delimiter, chunk_size, max_workers)
+    return columns, partitions
+
+
+def _infer_columns(data_path, file_format, header, delimiter, chunk_size, max_workers):
+    """
+    infer_column_types that also returns whether any csv value needed quoting
+    """
+    files = _list_data_files(data_path)
+    if not files:
+        raise ValueError("No data files found in {}".format(data_path))
+
+    base_path = data_path if os.path.isdir(data_path) else os.path.dirname(data_path)
+    args = [(f, file_format or _file_format_from_path(f), chunk_size, header, delimiter) for f in files]
+    results = _map_files(_infer_file_types_star, args, max_workers)
+
+    col_names = []
+    col_types = {}
+    for f, (names, types, _, _) in zip(files, results):
+        duplicates = sorted(set(n for n in names if names.count(n) > 1))
+        if duplicates:
+            raise ValueError("{} has more than one column called {}".format(f, ", ".join(repr(n) for n in duplicates)))
+        for n in names:
+            col_types[n] = _merge_types(col_types.get(n), types[n]) if n in col_types else types[n]
+            if n not in col_names:
+                col_names.append(n)
+
+    partitions = []
+    partition_types = {}
+    for f in files:
+        for k, v in _partition_values_from_path(f, base_path):
+            if k not in partitions:
+                partitions.append(k)
+            if partition_types.get(k) != "character":
+                partition_types[k] = _infer_values_type([v], partition_types.get(k))
+
+    columns = []
+    seen = {}
+    for n in col_names + partitions:
+        clean_name = _clean_column_name(n)
+        if clean_name in seen:
+            raise ValueError("Columns {!r} and {!r} both become column {} once cleaned. Rename one of them in the data".format(seen[clean_name], n, clean_name))
+        seen[clean_name] = n
+        t = partition_types.get(n) if n in partitions else col_types[n]
+        columns.append({"name": clean_name, "type": t or "character", "description": ""})
+
+    if not col_names:
+        raise ValueError("No columns found in the data files in {}".format(data_path))
+    if sum(n_rows for _, _, n_rows, _ in results) == 0:
+        warnings.warn("The data files in {} have no rows so every column has been given the type character".format(data_path))
+
+    return columns, [_clean_column_name(p) for p in partitions], any(quoted for _, _, _, quoted in results)
+
+
+def _data_format_reader_options(data_format):
+    """
+    Returns the file format and csv quoting used to read data described by one of our data_formats.
+    """
+    if data_format == "csv":
+        # LazySimpleSerDe does not understand quotes
+        return "csv", csv.QUOTE_NONE
+    if data_format == "csv_quoted_nodate":
+        return "csv", csv.QUOTE_MINIMAL
+    if data_format == "json":
+        return "json", csv.QUOTE_MINIMAL
+    raise ValueError("Can only check data with a data_format of csv, csv_quoted_nodate or json (not {})".format(data_format))
+
+
+def _validate_file(file_path, file_format, quoting, delimiter, header, columns, partition_values, chunk_size, n_samples):
+    """
+    Check the values of a single file against columns (a list of (name, type) tuples) streaming it in chunks.
+    partition_values is a dict of the partition values for this file taken from its path.
+    """
+    report = {name: {"violations": 0, "samples": []} for name, _ in columns}
+    file_cols = [(name, t) for name, t in columns if name not in partition_values]
+    n_rows = 0
+
+    for names, rows in _iter_data_chunks(file_path, file_format, chunk_size, header=header, quoting=quoting, delimiter=delimiter):
+        row_offset = n_rows + (2 if header else 1)
+        if file_format == "json":
+            positions = {n: i for i, n in enumerate(names)}
+            chunk_cols = _columns_from_rows(rows, len(names))
+            col_values = [chunk_cols[positions[n]] if n in positions else None for n, _ in file_cols]
+            row_names = names
+        else:
+            col_values = _columns_from_rows(rows, len(file_cols))
+            row_names = [n for n, _ in file_cols]
+
+        for (name, t), values in zip(file_cols, col_values):
+            if values is None or _chunk_matches(t, list(filter(None, values))):
+                continue
+            r = report[name]
+            for i, v in enumerate(values):
+                if not _value_matches(t, v):
+                    r["violations"] += 1
+                    if len(r["samples"]) < n_samples:
+                        r["samples"].append({"file": file_path, "row": row_offset + i, "value": v, "data": dict(zip(row_names, rows[i]))})
+        n_rows += len(rows)
+
+    for name, t in columns:
+        if name in partition_values and not _value_matches(t, partition_values[name]):
+            report[name]["violations"] += n_rows
+            report[name]["samples"].append({"file": file_path, "row": None, "value": partition_values[name], "data": None})
+
+    return n_rows, report
+
+
+def _validate_file_star(args):
+    return _validate_file(*args)
+
+
+def validate_data_files(data_path, columns, partitions, data_format, header = False, delimiter = ",", chunk_size = _default_chunk_size, max_workers = None, n_samples = 5):
+    """
+    Check that the data file(s) at data_path match the column types in columns (a list of meta data column dicts).
+    Files are streamed in chunks of chunk_size rows and checked in parallel over max_workers processes.
+    Partition values are taken from the key=value folders between data_path and each file.
+    Returns a report dict giving the number of files and rows checked and, for each column, the number of values
+    that do not match the column type along with up to n_samples example rows.
+    """
+    file_format, quoting = _data_format_reader_options(data_format)
+    files = _list_data_files(data_path)
+    base_path = data_path if os.path.isdir(data_path) else os.path.dirname(data_path)
+    col_types = [(c["name"], c["type"]) for c in columns]
+
+    args = []
+    for f in files:
+        partition_values = {k: v for k, v in _partition_values_from_path(f, base_path) if k in partitions}
+        args.append((f, file_format, quoting, delimiter, header, col_types, partition_values, chunk_size, n_samples))
+    results = _map_files(_validate_file_star, args, max_workers)
+
+    report = {
+        "files": len(files),
+        "rows": 0,
+        "columns": {name: {"type": t, "violations": 0, "samples": []} for name, t in col_types},
+    }
+    for n_rows, file_report in results:
+        report["rows"] += n_rows
+        for name, r in file_report.items():
+            col = report["columns"][name]
+            col["violations"] += r["violations"]
+            col["samples"] = (col["samples"] + r["samples"])[:n_samples]
+    report["valid"] = all(c["violations"] == 0 for c in report["columns"].values())
+
+    return report
+
+
+_glue_to_arrow_types = {
+    "string": "string",
+    "int": "int32",
+    "bigint": "int64",
+    "float": "float32",
+    "double": "float64",
+    "date": "date32",
+    "timestamp": "timestamp[ms]",
+    "boolean": "bool",
+}
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.csv
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("pyarrow is needed to write parquet files. Install it with: pip install etl_manager[parquet]")
+    return pyarrow
+
+
+def _arrow_schema(columns):
+    """
+    columns is a list of (name, glue_type) tuples.
+    """
+    pa = _import_pyarrow()
+    return pa.schema([(name, pa.type_for_alias(_glue_to_arrow_types[t])) for name, t in columns])
+
+
+def _convert_csv_file_to_parquet(file_path, out_path, columns, quoting, delimiter, header, row_group_size, compression):
+    """
+    Stream a single csv file into a parquet file at out_path writing a row group every row_group_size rows.
+    Returns the number of rows written.
+    """
+    pa = _import_pyarrow()
+    schema = _arrow_schema(columns)
+    names = [n for n, _ in columns]
+
+    read_options = pa.csv.ReadOptions(column_names=names, skip_rows=1 if header else 0, use_threads=False)
+    parse_options = pa.csv.ParseOptions(delimiter=delimiter, quote_char=False if quoting == csv.QUOTE_NONE else '"')
+    convert_options = pa.csv.ConvertOptions(
+        column_types=schema,
+        null_values=[""],
+        strings_can_be_null=True,
+        true_values=["true", "True", "TRUE"],
+        false_values=["false", "False", "FALSE"],
+    )
+
+    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+    tmp_path = out_path + ".tmp"
+    n_rows = 0
+    batches = []
+    n_batch_rows = 0
+    # Athena (and older versions of spark) expect timestamps in parquet to be stored as int96
+    with pa.parquet.ParquetWriter(tmp_path, schema, compression=compression, use_deprecated_int96_timestamps=True) as writer:
+        with pa.csv.open_csv(file_path, read_options=read_options, parse_options=parse_options, convert_options=convert_options) as reader:
+            for batch in reader:
+                batches.append(batch)
+                n_batch_rows += batch.num_rows
+                if n_batch_rows >= row_group_size:
+                    writer.write_table(pa.Table.from_batches(batches, schema), row_group_size=row_group_size)
+                    n_rows += n_batch_rows
+                    batches, n_batch_rows = [], 0
+        if batches:
+            writer.write_table(pa.Table.from_batches(batches, schema), row_group_size=row_group_size)
+            n_rows += n_batch_rows
+    os.replace(tmp_path, out_path)
+
+    return n_rows
+
+
+def _convert_csv_file_to_parquet_star(args):
+    return _convert_csv_file_to_parquet(*args)
+
+
+def convert_csv_to_parquet(data_path, output_path, columns, partitions, data_format, header = False, delimiter = ",", row_group_size = 1000000, compression = "snappy", max_workers = None):
+    """
+    Convert the csv data file(s) at data_path into parquet files under output_path.
+    columns is a list of (name, glue_type) tuples for every column (including partitions).
+    Hive style key=value folders between data_path and each file are kept so output_path has the same partition layout.
+    Each file is streamed (so memory is bounded by row_group_size) and files are converted in parallel over max_workers processes.
+    Returns a list of (output_file_path, n_rows) tuples.
+    """
+    _import_pyarrow()
+    _, quoting = _data_format_reader_options(data_format)
+    if data_format == "json":
+        raise ValueError("Can only convert csv data to parquet")
+
+    files = _list_data_files(data_path)
+    base_path = data_path if os.path.isdir(data_path) else os.path.dirname(data_path)
+    file_columns = [(n, t) for n, t in columns if n not in partitions]
+
+    args = []
+    out_paths = []
+    for i, f in enumerate(files):
+        partition_folders = ["{}={}".format(k, v) for k, v in _partition_values_from_path(f, base_path) if k in partitions]
+        out_path = os.path.join(output_path, *partition_folders, "part-{:05d}.{}.parquet".format(i, compression or "uncompressed"))
+        out_paths.append(out_path)
+        args.append((f, out_path, file_columns, quoting, delimiter, header, row_group_size, compression))
+
+    n_rows = _map_files(_convert_csv_file_to_parquet_star, args, max_workers)
+
+    return list(zip(out_paths, n_rows))
+
+
+_decompressors = {
+    "gzip": lambda: zlib.decompressobj(wbits=31),
+    "bzip2": bz2.BZ2Decompressor,
+}
+
+
+def _decompress_chunks(chunks, compression):
+    """
+    Decompress an iterable of byte chunks compressed with compression (gzip or bzip2), including files made of several concatenated streams
+    """
+    if compression not in _decompressors:
+        raise ValueError("Can not decompress {} data. Supported compressions are {}".format(compression, ", ".join(_decompressors)))
+
+    decompressor = _decompressors[compression]()
+    for chunk in chunks:
+        while chunk:
+            yield decompressor.decompress(chunk)
+            if not decompressor.eof:
+                break
+            chunk = decompressor.unused_data
+            decompressor = _decompressors[compression]()
+
+
+def _count_lines(chunks, compression = None):
+    """
+    Count the records in newline delimited text given as an iterable of byte chunks (compressed with compression, gzip or bzip2, if given).
+    A final line without a trailing newline is counted.
+    """
+    if compression:
+        chunks = _decompress_chunks(chunks, compression)
+    n_lines = 0
+    last_byte = b"\n"
+    for chunk in chunks:
+        if chunk:
+            n_lines += chunk.count(b"\n")
+            last_byte = chunk[-1:]
+    return n_lines + (0 if last_byte == b"\n" else 1)
+
+
+def _parquet_row_count_from_footer(footer):
+    """
+    Returns the number of rows in a parquet file given (at least) the last bytes of the file containing its footer.
+    Returns the number of footer bytes needed instead (as a negative number) if footer is too short.
+    """
+    pa = _import_pyarrow()
+    if footer[-4:] != b"PAR1":
+        raise ValueError("Not a parquet file")
+    metadata_length = struct.unpack("<i", footer[-8:-4])[0]
+    if len(footer) < metadata_length + 8:
+        return -(metadata_length + 8)
+    footer = footer[-(metadata_length + 8):]
+    return pa.parquet.read_metadata(io.BytesIO(b"PAR1" + footer)).num_rows
@@ -1,17 +1,33 @@
+from contextlib import contextmanager
+from functools import partial
 from urllib.request import urlretrieve
+import asyncio
 import glob
+import hashlib
 import json
+import math
 import os
+import pkg_resources
 import re
 import shutil
+import sqlite3
+import subprocess
+import sys
 import tempfile
 import time
+import warnings
 import zipfile
 
+from etl_manager.glue_spark_runtime import SPARK_SCHEMAS_FILE
+from etl_manager.meta import read_database_folder
 from etl_manager.utils import (
     read_json,
     write_json,
     _dict_merge,
+    _end_with_slash,
+    _file_sha256,
+    _make_deterministic_zip,
+    _s3_prefix_exists,
     _validate_string,
     _glue_client,
     _unnest_github_zipfile_and_return_new_zip_path,
@@ -25,6 +41,35 @@ from etl_manager.utils import (
 # Run job - check if job exists and lock in temp folder matches
 
 
+_spark_runtime_path = os.path.join(os.path.dirname(__file__), "glue_spark_runtime.py")
+
+# Spark writer format and options for each data format the compaction job can write
+# Timestamps and dates are written the way the Hive serdes read them (spark defaults to ISO 8601 with a T and time zone),
+# and LazySimpleSerDe (csv) does not understand quotes so nothing is quoted or escaped
+_hive_datetime_options = {"timestampFormat": "yyyy-MM-dd HH:mm:ss", "dateFormat": "yyyy-MM-dd"}
+_spark_writers = {
+    "csv": ("csv", {"sep": ",", "header": "false", "quote": "", "escape": "", "emptyValue": "", **_hive_datetime_options}),
+    "csv_quoted_nodate": ("csv", {"sep": ",", "header": "false", "quote": '"', "escape": "\\", **_hive_datetime_options}),
+    "json": ("json", _hive_datetime_options),
+    "orc": ("orc", {}),
+    "par": ("parquet", {}),
+    "parquet": ("parquet", {}),
+    "avro": ("avro", {}),
+}
+
+
+def _spark_read_spec(table, full_database_path=None):
+    """
+    What glue_spark_runtime needs to read a table: its spark schema, partitions, data_format and s3 path
+    """
+    return {
+        "schema": table.spark_schema(),
+        "partitions": table.partitions,
+        "data_format": table.data_format,
+        "path": _end_with_slash(table._s3_table_path(full_database_path)),
+    }
+
+
 class JobMisconfigured(Exception):
     pass
 
@@ -43,6 +88,164 @@ class JobTimedOut(Exception):
 class JobStopped(Exception):
     pass
 
+_worker_types = ['Standard', 'G.1X', 'G.2X', 'G.4X', 'G.8X', 'G.025X']
+
+
+class SizingPolicy:
+    """
+    Estimate the number of workers a GlueJob needs from the size of its input data and how long its previous runs took.
+
+    The starting estimate is one worker per bytes_per_worker of input. If target_duration (seconds) is given and the job
+    has previous successful runs, the estimate is raised so that (assuming the run time scales inversely with the number
+    of workers) the median previous run would have finished in target_duration. The result is kept between min_workers
+    and max_workers. Previous runs are read from the job's run_history (a JobRunHistory), as glue deletes the runs of a
+    job along with the job unless it is incremental.
+    """
+
+    def __init__(self, worker_type='G.1X', bytes_per_worker=10 * 1024**3, min_workers=2, max_workers=100, target_duration=None):
+        if worker_type not in _worker_types:
+            raise ValueError(f"worker_type must be one of {', '.join(_worker_types)}")
+        self.worker_type = worker_type
+        self.bytes_per_worker = bytes_per_worker
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.target_duration = target_duration
+
+    def estimate_workers(self, input_bytes, previous_runs=[]):
+        """
+        input_bytes is the total size of the job's input data.
+        previous_runs is a list of (execution_time_seconds, number_of_workers) tuples for previous successful runs.
+        """
+        workers = math.ceil(input_bytes / self.bytes_per_worker)
+
+        if self.target_duration and previous_runs:
+            worker_seconds = sorted(t * w for t, w in previous_runs if t and w)
+            if worker_seconds:
+                median_worker_seconds = worker_seconds[len(worker_seconds) // 2]
+                workers = max(workers, math.ceil(median_worker_seconds / self.target_duration))
+
+        return min(max(workers, self.min_workers), self.max_workers)
+
+
+class JobRunHistory:
+    """
+    Local sqlite store of the metrics of finished glue job runs, used to spot runs that are much slower than usual.
+
+    history = JobRunHistory()  # defaults to ~/.etl_manager/job_run_history.db
+    job.run_history = history
+    job.run_job()
+    job.wait_for_completion()  # the run is recorded (and flagged if it is a regression) once it finishes
+    history.duration_percentiles(job.job_name)
+    """
+
+    _columns = [
+        ("run_id", "TEXT PRIMARY KEY"),
+        ("job_name", "TEXT"),
+        ("state", "TEXT"),
+        ("started_on", "TEXT"),
+        ("completed_on", "TEXT"),
+        ("execution_time", "INTEGER"),
+        ("allocated_capacity", "REAL"),
+        ("max_capacity", "REAL"),
+        ("worker_type", "TEXT"),
+        ("number_of_workers", "INTEGER"),
+        ("dpu_seconds", "REAL"),
+        ("arguments_hash", "TEXT"),
+        ("resources_hash", "TEXT"),
+        ("is_regression", "INTEGER"),
+    ]
+
+    def __init__(self, db_path=None, regression_threshold=1.5, min_runs=5):
+        if db_path is None:
+            db_path = os.path.join(os.path.expanduser("~"), ".etl_manager", "job_run_history.db")
+        if os.path.dirname(db_path):
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.db_path = db_path
+        self.regression_threshold = regression_threshold
+        self.min_runs = min_runs
+
+        columns = ", ".join(f"{name} {sql_type}" for name, sql_type in self._columns)
+        with self._connect() as conn:
+            conn.execute(f"CREATE TABLE IF NOT EXISTS job_runs ({columns})")
+            conn.execute("CREATE INDEX IF NOT EXISTS job_runs_job_name ON job_runs (job_name, state)")
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def durations(self, job_name, state="SUCCEEDED"):
+        """
+        Returns the execution times (seconds) of the recorded runs of job_name that finished in state
+        """
+        with self._connect() as conn:
+            rows = conn.execute("SELECT execution_time FROM job_runs WHERE job_name = ? AND state = ? AND execution_time IS NOT NULL ORDER BY completed_on", (job_name, state))
+            return [r[0] for r in rows]
+
+    @staticmethod
+    def _percentile(values, p):
+        values = sorted(values)
+        if not values:
+            return None
+        # nearest rank
+        return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+    def duration_percentiles(self, job_name, percentiles=(50, 95)):
+        """
+        Returns a dict like {"p50": seconds, "p95": seconds} of the execution time of successful runs of job_name
+        """
+        durations = self.durations(job_name)
+        return {f"p{p}": self._percentile(durations, p) for p in percentiles}
+
+    def is_regression(self, job_name, execution_time):
+        """
+        A run is a regression if it took longer than regression_threshold times the median and longer than the p95
+        of the job's previous successful runs. Needs at least min_runs previous runs.
+        """
+        durations = self.durations(job_name)
+        if len(durations) < self.min_runs or execution_time is None:
+            return False
+        return execution_time > self.regression_threshold * self._percentile(durations, 50) and execution_time > self._percentile(durations, 95)
+
+    def record(self, job_run, arguments_hash=None, resources_hash=None):
+        """
+        Save a job run (the JobRun dict from glue's get_job_run) to the store. Returns True if the run is a regression.
+        """
+        regression = job_run["JobRunState"] == "SUCCEEDED" and self.is_regression(job_run["JobName"], job_run.get("ExecutionTime"))
+        values = {
+            "run_id": job_run["Id"],
+            "job_name": job_run["JobName"],
+            "state": job_run["JobRunState"],
+            "started_on": str(job_run["StartedOn"]) if job_run.get("StartedOn") else None,
+            "completed_on": str(job_run["CompletedOn"]) if job_run.get("CompletedOn") else None,
+            "execution_time": job_run.get("ExecutionTime"),
+            "allocated_capacity": job_run.get("AllocatedCapacity"),
+            "max_capacity": job_run.get("MaxCapacity"),
+            "worker_type": job_run.get("WorkerType"),
+            "number_of_workers": job_run.get("NumberOfWorkers"),
+            "dpu_seconds": job_run.get("DPUSeconds"),
+            "arguments_hash": arguments_hash,
+            "resources_hash": resources_hash,
+            "is_regression": int(regression),
+        }
+        names = [name for name, _ in self._columns]
+        with self._connect() as conn:
+            conn.execute(f"INSERT OR REPLACE INTO job_runs ({', '.join(names)}) VALUES ({', '.join('?' for _ in names)})", [values[n] for n in names])
+        return regression
+
+    def runs(self, job_name):
+        """
+        Returns all recorded runs of job_name (oldest first) as dicts
+        """
+        with self._connect() as conn:
+            conn.row_factory = sqlite3.Row
+            return [dict(r) for r in conn.execute("SELECT * FROM job_runs WHERE job_name = ? ORDER BY completed_on", (job_name,))]
+
+
 class GlueJob:
     """
     Take a folder structure on local disk.
@@ -68,9 +271,14 @@ class GlueJob:
           txt, sql, json, or csv files
       job_folder
         etc...
+
+    From asyncio code use the async versions of the lifecycle methods, e.g.
+    await job.run_job_async()
+    await job.wait_for_completion_async()
+    await job.cleanup_async()
     """
 
-    def __init__(self, job_folder, bucket, job_role, job_name = None, job_arguments = {}, include_shared_job_resources = True):
+    def __init__(self, job_folder, bucket, job_role, job_name = None, job_arguments = {}, include_shared_job_resources = True, metadata_databases = None):
         self.job_id = "{:0.0f}".format(time.time())
 
         job_folder = os.path.normpath(job_folder)
@@ -89,7 +297,9 @@ class GlueJob:
         self.include_shared_job_resources = include_shared_job_resources
         self.py_resources = self._get_py_resources()
         self.resources = self._get_resources()
-        self.all_meta_data_paths = self._get_metadata_paths()  # Within a glue job, it's sometimes useful to be able to access the agnostic metdata
+        # Within a glue job, it's sometimes useful to be able to access the agnostic metdata.
+        # metadata_databases limits this to some of the database folders in meta_data (see the setter)
+        self.metadata_databases = metadata_databases
         self.github_zip_urls = self._get_github_resource_list()
 
         self.job_arguments = job_arguments
@@ -101,6 +311,29 @@ class GlueJob:
         self.max_retries = 0
         self.max_concurrent_runs = 1
         self.allocated_capacity = 2
+        self.worker_type = None
+        self.number_of_workers = None
+        self.glue_version = None
+
+        # Set sizing_policy (a SizingPolicy) and input_tables (TableMeta objects with a database) to pick the number of workers when the job is run.
+        # Its target_duration needs the durations of previous runs, which are read from run_history
+        self.sizing_policy = None
+        self.input_tables = []
+
+        # Set run_history (a JobRunHistory) to keep the metrics of each run once wait_for_completion finishes
+        self.run_history = None
+
+        # With shared_artifacts py resources are uploaded to a folder keyed by their sha256 that all jobs in the bucket share,
+        # instead of into this job's folder, so a library used by many jobs is only uploaded once
+        self.shared_artifacts = False
+        self._artifact_keys = {}
+
+        # With compile_spark_schemas the spark schemas of the job's metadata tables (spark_schemas.json) and the glue_spark_runtime
+        # module are uploaded with the job, so it can read tables with an explicit schema instead of inferring one
+        self.compile_spark_schemas = False
+
+        # In incremental mode job bookmarks are enabled and the job definition is kept (so is its bookmark) between runs
+        self.incremental = False
 
     @property
     def job_folder(self):
@@ -118,6 +351,10 @@ class GlueJob:
     def s3_job_folder_no_bucket(self):
         return os.path.join('_GlueJobs_', self.job_name, self.job_id, 'resources/')
 
+    @property
+    def s3_artifact_folder_no_bucket(self):
+        return "_GlueArtifacts_/"
+
     @property
     def s3_metadata_base_folder_inc_bucket(self):
         return os.path.join(self.s3_job_folder_inc_bucket, "meta_data")
@@ -134,6 +371,34 @@ class GlueJob:
     def etl_root_folder(self):
         return os.path.dirname(self.job_parent_folder)
 
+    @property
+    def metadata_base_folder(self):
+        return os.path.join(self.etl_root_folder, "meta_data")
+
+    @property
+    def metadata_databases(self):
+        return self._metadata_databases
+
+    @metadata_databases.setter
+    def metadata_databases(self, metadata_databases):
+        """
+        The database folders (within meta_data) whose metadata is uploaded with the job.
+        None uploads every database folder, "auto" uses the folders whose name (or database.json name)
+        appears in job.py or the job resources, otherwise a list of folder names.
+        """
+        if metadata_databases == "auto":
+            metadata_databases = self._find_metadata_databases()
+        elif metadata_databases is not None:
+            if isinstance(metadata_databases, str):
+                raise ValueError('metadata_databases must be None, "auto" or a list of database folder names')
+            missing = [d for d in metadata_databases if not os.path.isdir(os.path.join(self.metadata_base_folder, d))]
+            if missing:
+                raise ValueError(f"Could not find database folder(s) ({', '.join(missing)}) in {self.metadata_base_folder}")
+            metadata_databases = list(metadata_databases)
+
+        self._metadata_databases = metadata_databases
+        self.all_meta_data_paths = self._get_metadata_paths()
+
     @property
     def job_arguments(self):
         metadata_argument = {
@@ -176,6 +441,60 @@ class GlueJob:
     def job_run_id(self):
         return self._job_run_id
 
+    @property
+    def worker_type(self):
+        return self._worker_type
+
+    @worker_type.setter
+    def worker_type(self, worker_type):
+        if worker_type is not None and worker_type not in _worker_types:
+            raise ValueError(f"worker_type must be one of {', '.join(_worker_types)}")
+        self._worker_type = worker_type
+
+    @property
+    def input_bytes(self):
+        """
+        Total size of the data in the s3 locations of input_tables (uses their collected stats if they have them)
+        """
+        total = 0
+        for t in self.input_tables:
+            stats = t.stats if t.stats else t.collect_stats()
+            total += stats['totalSize']
+        return total
+
+    def _previous_runs(self, max_runs=10):
+        """
+        Returns (execution_time, number_of_workers) for the most recent successful runs of the job.
+        They are taken from run_history if it is set, as glue forgets the runs of a job when run_job or cleanup deletes it
+        (so glue's own run list is only useful for jobs in incremental mode).
+        """
+        if self.run_history is not None:
+            runs = [r for r in self.run_history.runs(self.job_name) if r['state'] == 'SUCCEEDED'][-max_runs:]
+            return [(r['execution_time'], r['number_of_workers'] or r['allocated_capacity'] or r['max_capacity']) for r in runs]
+
+        try:
+            response = _glue_client.get_job_runs(JobName=self.job_name, MaxResults=max_runs)
+        except _glue_client.exceptions.EntityNotFoundException:
+            return []
+
+        runs = []
+        for r in response['JobRuns']:
+            if r['JobRunState'] == 'SUCCEEDED':
+                workers = r.get('NumberOfWorkers', r.get('AllocatedCapacity'))
+                runs.append((r.get('ExecutionTime'), workers))
+        return runs
+
+    def apply_sizing_policy(self):
+        """
+        Set worker_type and number_of_workers using sizing_policy, the size of input_tables and the job's previous runs.
+        Called by run_job if sizing_policy is set.
+        """
+        if self.sizing_policy is None:
+            raise JobMisconfigured('Missing "sizing_policy"')
+
+        self.worker_type = self.sizing_policy.worker_type
+        self.number_of_workers = self.sizing_policy.estimate_workers(self.input_bytes, self._previous_runs())
+
     def _check_nondup_resources(self, resources_list):
         file_list = [os.path.basename(r) for r in resources_list]
         if(len(file_list) != len(set(file_list))):
@@ -249,17 +568,52 @@ class GlueJob:
 
     def _get_metadata_paths(self):
         """
-        Enumerate the relative path for all metadata json files
+        Enumerate the relative path for all metadata json files (in metadata_databases if set)
         """
 
-        metadata_base = os.path.join(self.etl_root_folder, "meta_data")
-        all_files = list(glob.iglob(metadata_base + "/**/*.json", recursive=True))
+        metadata_base = self.metadata_base_folder
+        if self.metadata_databases is None:
+            return list(glob.iglob(metadata_base + "/**/*.json", recursive=True))
+
+        all_files = []
+        for d in self.metadata_databases:
+            all_files.extend(glob.iglob(os.path.join(metadata_base, d) + "/**/*.json", recursive=True))
+        return all_files
+
+    def _find_metadata_databases(self):
+        """
+        Returns the database folders in meta_data referred to (by folder name or database name) in job.py or the job resources
+        """
+        if not os.path.isdir(self.metadata_base_folder):
+            return []
+
+        identifiers = {}
+        for d in sorted(os.listdir(self.metadata_base_folder)):
+            if not os.path.isdir(os.path.join(self.metadata_base_folder, d)):
+                continue
+            database_json_path = os.path.join(self.metadata_base_folder, d, "database.json")
+            identifiers[d.lower()] = d
+            if os.path.exists(database_json_path):
+                name = read_json(database_json_path).get("name")
+                if name:
+                    identifiers[name.lower()] = d
+        if not identifiers:
+            return []
+
+        # Also matches glue database names with an environment suffix (e.g. workforce_dev)
+        names = "|".join(re.escape(i) for i in sorted(identifiers, key=len, reverse=True))
+        regex = re.compile(f"(?<![\\w])({names})(?![a-z0-9])", re.IGNORECASE)
+
+        scan_paths = [self.job_path] + [p for p in self.py_resources if p.endswith(".py")] + self.resources
+        found = set()
+        for path in scan_paths:
+            with open(path, "r", errors="ignore") as f:
+                found.update(identifiers[m.lower()] for m in regex.findall(f.read()))
 
-        # Remove everything up to the main meta_data path
-        return list(all_files)
+        return sorted(found)
 
-    def _download_github_zipfile_and_rezip_to_glue_file_structure(self, url):
-        this_zip_path = os.path.join(f'_{self.job_name}_tmp_zip_files_to_s3_', "github.zip")
+    def _download_github_zipfile_and_rezip_to_glue_file_structure(self, url, folder=None):
+        this_zip_path = os.path.join(folder or f'_{self.job_name}_tmp_zip_files_to_s3_', "github.zip")
         urlretrieve(url, this_zip_path)
 
         original_dir = os.path.dirname(this_zip_path)
@@ -271,7 +625,7 @@ class GlueJob:
             nested_path = os.path.join(td, nested_folder_to_unnest)
             name = [d for d in os.listdir(nested_path) if os.path.isdir(os.path.join(nested_path, d))][0]
             output_path = os.path.join(original_dir, name)
-            final_output_path = shutil.make_archive(output_path, 'zip', nested_path)
+            final_output_path = _make_deterministic_zip(output_path, nested_path)
 
         os.remove(this_zip_path)
 
@@ -291,17 +645,28 @@ class GlueJob:
         for url in self.github_zip_urls:
             self.github_py_resources.append(self._download_github_zipfile_and_rezip_to_glue_file_structure(url))
 
+        spark_files = []
+        if self.compile_spark_schemas:
+            spark_schemas_path = os.path.join(temp_zip_folder, SPARK_SCHEMAS_FILE)
+            write_json(self.spark_schemas(), spark_schemas_path)
+            spark_files = [spark_schemas_path, _spark_runtime_path]
+
         # Check if all filenames are unique
-        files_to_sync = self.github_py_resources + self.py_resources + self.resources + [self.job_path]
+        files_to_sync = self.github_py_resources + self.py_resources + self.resources + [self.job_path] + spark_files
         self._check_nondup_resources(files_to_sync)
 
         # delete the tmp folder before uploading new data to it
         self.delete_s3_job_temp_folder()
 
-        # Sync all job resources to the same s3 folder
+        # Sync all job resources to the same s3 folder (apart from shared py resources)
+        self._artifact_keys = {}
+        py_files = set(self.github_py_resources + self.py_resources + spark_files[1:])
         for f in files_to_sync:
-            s3_file_path = os.path.join(self.s3_job_folder_no_bucket, os.path.basename(f))
-            _s3_client.upload_file(f, self.bucket, s3_file_path)
+            if self.shared_artifacts and f in py_files:
+                self._upload_artifact(f)
+            else:
+                s3_file_path = os.path.join(self.s3_job_folder_no_bucket, os.path.basename(f))
+                _s3_client.upload_file(f, self.bucket, s3_file_path)
 
         # Upload metadata to subfolder
         for f in self.all_meta_data_paths:
@@ -310,12 +675,112 @@ class GlueJob:
             _s3_client.upload_file(f, self.bucket, s3_file_path)
 
         # Clean up downloaded zip files
-        for f in list(self.github_py_resources):
+        for f in list(self.github_py_resources) + spark_files[:1]:
             os.remove(f)
         if not temp_folder_already_exists:
             os.rmdir(temp_zip_folder)
 
 
+    def spark_schemas(self):
+        """
+        Compile the metadata uploaded with the job into a dict of "database.table" to the table's spark schema (StructType json),
+        partitions, data_format and s3 path. This is what glue_spark_runtime.read_table reads tables with.
+        """
+        schemas = {}
+        for f in sorted(self.all_meta_data_paths):
+            if os.path.basename(f) == "database.json":
+                db = read_database_folder(os.path.dirname(f))
+                for t in db._tables:
+                    schemas[f"{db.name}.{t.name}"] = _spark_read_spec(t)
+        return schemas
+
+    def run_local(self, python_path=[], work_dir=None, python=None, env=None, timeout=None, capture_output=False):
+        """
+        Run job.py on this machine (in a subprocess) with the same layout glue gives it, to test changes without deploying the job:
+        resources (--extra-files) are copied into the working directory, py resources and github zips are put on the PYTHONPATH,
+        the job's metadata is copied to a local meta_data folder that --metadata_base_path points at and the job arguments
+        (plus --JOB_NAME and --JOB_RUN_ID) are passed on the command line.
+
+        python_path is a list of extra PYTHONPATH entries, e.g. a folder holding local stand ins for awsglue (and pyspark if it is not installed),
+        and python the interpreter to use (defaults to the current one).
+        The working directory is a temporary folder that is removed afterwards unless work_dir is given.
+        Returns the subprocess.CompletedProcess. Raises JobFailed if the job exits with an error.
+        """
+        temp_dir = None
+        if work_dir is None:
+            temp_dir = tempfile.mkdtemp(prefix=f"{self.job_name}_")
+            work_dir = temp_dir
+        else:
+            os.makedirs(work_dir, exist_ok=True)
+
+        try:
+            py_folder = os.path.join(work_dir, "_py_resources_")
+            os.makedirs(py_folder, exist_ok=True)
+            py_resources = list(self.py_resources)
+            for url in self.github_zip_urls:
+                py_resources.append(self._download_github_zipfile_and_rezip_to_glue_file_structure(url, folder=py_folder))
+            if self.compile_spark_schemas:
+                py_resources.append(_spark_runtime_path)
+                write_json(self.spark_schemas(), os.path.join(work_dir, SPARK_SCHEMAS_FILE))
+            self._check_nondup_resources(py_resources + self.resources + [self.job_path])
+
+            # Glue puts zips on the path as they are and .py files through a folder
+            search_path = list(python_path)
+            for f in py_resources:
+                if f.endswith(".zip"):
+                    search_path.append(f)
+                elif not os.path.exists(os.path.join(py_folder, os.path.basename(f))):
+                    shutil.copy(f, py_folder)
+            search_path.append(py_folder)
+
+            for f in self.resources + [self.job_path]:
+                shutil.copy(f, work_dir)
+
+            metadata_folder = os.path.join(work_dir, "meta_data")
+            for f in self.all_meta_data_paths:
+                path_within_metadata_folder = os.path.relpath(f, self.metadata_base_folder)
+                os.makedirs(os.path.dirname(os.path.join(metadata_folder, path_within_metadata_folder)), exist_ok=True)
+                shutil.copy(f, os.path.join(metadata_folder, path_within_metadata_folder))
+
+            arguments = {**self.job_arguments, "--metadata_base_path": _end_with_slash(metadata_folder)}
+            command = [python or sys.executable, os.path.join(work_dir, "job.py"), "--JOB_NAME", self.job_name, "--JOB_RUN_ID", f"local_{self.job_id}"]
+            for k, v in arguments.items():
+                command.extend([k, str(v)])
+
+            run_env = {**os.environ, **(env or {})}
+            run_env["PYTHONPATH"] = os.pathsep.join(search_path + [p for p in [run_env.get("PYTHONPATH")] if p])
+
+            pipe = subprocess.PIPE if capture_output else None
+            result = subprocess.run(command, cwd=work_dir, env=run_env, timeout=timeout, stdout=pipe, stderr=pipe, universal_newlines=True)
+            if result.returncode != 0:
+                error = result.stderr.strip().splitlines()[-1] if capture_output and result.stderr.strip() else f"exit code {result.returncode}"
+                raise JobFailed(f"Local run of {self.job_name} failed: {error}")
+            return result
+        finally:
+            if temp_dir is not None:
+                shutil.rmtree(temp_dir, ignore_errors=True)
+
+    def _artifact_key(self, path):
+        # Keys are kept for the github zips as they are deleted once synced
+        if path not in self._artifact_keys:
+            self._artifact_keys[path] = os.path.join(self.s3_artifact_folder_no_bucket, _file_sha256(path), os.path.basename(path))
+        return self._artifact_keys[path]
+
+    def _upload_artifact(self, path):
+        """
+        Upload path to the shared artifact folder unless it is already there. Returns True if it was uploaded.
+        """
+        key = self._artifact_key(path)
+        if _s3_prefix_exists(self.bucket, key):
+            return False
+        _s3_client.upload_file(path, self.bucket, key)
+        return True
+
+    def _py_resource_s3_path(self, path):
+        if self.shared_artifacts:
+            return f"s3://{self.bucket}/{self._artifact_key(path)}"
+        return os.path.join(self.s3_job_folder_inc_bucket, os.path.basename(path))
+
     def _job_definition(self):
         script_location = os.path.join(self.s3_job_folder_inc_bucket, 'job.py')
         tmp_dir = os.path.join(self.s3_job_folder_inc_bucket, 'glue_temp_folder/')
@@ -334,20 +799,33 @@ class GlueJob:
                 "--TempDir": tmp_dir,
                 "--extra-files": "",
                 "--extra-py-files": "",
-                "--job-bookmark-option": "job-bookmark-disable",
+                "--job-bookmark-option": "job-bookmark-enable" if self.incremental else "job-bookmark-disable",
             },
             "MaxRetries": self.max_retries,
             "AllocatedCapacity": self.allocated_capacity,
         }
 
-        if len(self.resources) > 0:
-            extra_files = ','.join([os.path.join(self.s3_job_folder_inc_bucket, os.path.basename(f)) for f in self.resources])
+        # Worker type and number of workers replace the legacy allocated capacity
+        if self.worker_type is not None:
+            if not self.number_of_workers:
+                raise JobMisconfigured('"number_of_workers" must be set when using "worker_type"')
+            job_definition.pop("AllocatedCapacity")
+            job_definition["WorkerType"] = self.worker_type
+            job_definition["NumberOfWorkers"] = self.number_of_workers
+
+        if self.glue_version is not None:
+            job_definition["GlueVersion"] = self.glue_version
+
+        resources = self.resources + ([SPARK_SCHEMAS_FILE] if self.compile_spark_schemas else [])
+        if len(resources) > 0:
+            extra_files = ','.join([os.path.join(self.s3_job_folder_inc_bucket, os.path.basename(f)) for f in resources])
             job_definition["DefaultArguments"]["--extra-files"] = extra_files
         else:
             job_definition["DefaultArguments"].pop("--extra-files", None)
 
-        if len(self.py_resources) > 0 or  len(self.github_py_resources) > 0:
-            extra_py_files = ','.join([os.path.join(self.s3_job_folder_inc_bucket, os.path.basename(f)) for f in (self.py_resources + self.github_py_resources)])
+        py_resources = self.py_resources + self.github_py_resources + ([_spark_runtime_path] if self.compile_spark_schemas else [])
+        if len(py_resources) > 0:
+            extra_py_files = ','.join([self._py_resource_s3_path(f) for f in py_resources])
             job_definition["DefaultArguments"]["--extra-py-files"] = extra_py_files
         else:
             job_definition["DefaultArguments"].pop("--extra-py-files", None)
@@ -355,18 +833,58 @@ class GlueJob:
         return job_definition
 
     def run_job(self, sync_to_s3_before_run = True):
-        self.delete_job()
+        # Size the job before it is deleted, as its previous runs are deleted with it
+        if self.sizing_policy is not None:
+            self.apply_sizing_policy()
+
+        if not self.incremental:
+            self.delete_job()
 
         if sync_to_s3_before_run:
             self.sync_job_to_s3_folder()
 
         job_definition = self._job_definition()
-        _glue_client.create_job(**job_definition)
+        if self.incremental:
+            self._create_or_update_job(job_definition)
+        else:
+            _glue_client.create_job(**job_definition)
 
         response = _glue_client.start_job_run(JobName = self.job_name, Arguments = self.job_arguments)
 
         self._job_run_id = response['JobRunId']
 
+    def _create_or_update_job(self, job_definition):
+        # Updating (rather than recreating) the job keeps its bookmark
+        try:
+            _glue_client.get_job(JobName=self.job_name)
+        except _glue_client.exceptions.EntityNotFoundException:
+            _glue_client.create_job(**job_definition)
+        else:
+            job_update = {k: v for k, v in job_definition.items() if k != "Name"}
+            _glue_client.update_job(JobName=self.job_name, JobUpdate=job_update)
+
+    def get_job_bookmark(self):
+        """
+        Returns the job bookmark entry (run, attempt, version and the bookmark JobBookmark json) of the job
+        """
+        if self.job_name is None:
+            raise JobMisconfigured('Missing "job_name"')
+
+        return _glue_client.get_job_bookmark(JobName=self.job_name)["JobBookmarkEntry"]
+
+    def reset_job_bookmark(self, run_id=None):
+        """
+        Reset the job bookmark so the next incremental run processes all of the input data again.
+        If run_id is given the bookmark is reset to the state after that run instead.
+        """
+        if self.job_name is None:
+            raise JobMisconfigured('Missing "job_name"')
+
+        kwargs = {"JobName": self.job_name}
+        if run_id is not None:
+            kwargs["RunId"] = run_id
+        return _glue_client.reset_job_bookmark(**kwargs)["JobBookmarkEntry"]
+
     @property
     def job_status(self):
         if self.job_run_id is None:
@@ -386,11 +904,37 @@ class GlueJob:
     def is_running(self):
         return self.job_run_state == 'RUNNING'
 
+    @property
+    def arguments_hash(self):
+        return hashlib.sha256(json.dumps(self.job_arguments, sort_keys=True).encode("utf-8")).hexdigest()
+
+    @property
+    def resources_hash(self):
+        """
+        Hash of the contents of every file (and github url) the job is deployed with
+        """
+        manifest = hashlib.sha256()
+        for f in sorted([self.job_path] + self.py_resources + self.resources, key=os.path.basename):
+            with open(f, "rb") as fh:
+                manifest.update(os.path.basename(f).encode("utf-8"))
+                manifest.update(hashlib.sha256(fh.read()).digest())
+        for url in sorted(self.github_zip_urls):
+            manifest.update(url.strip().encode("utf-8"))
+        return manifest.hexdigest()
+
+    def _record_job_run(self, status):
+        if self.run_history is None:
+            return
+        if self.run_history.record(status["JobRun"], self.arguments_hash, self.resources_hash):
+            p = self.run_history.duration_percentiles(self.job_name)
+            warnings.warn(f"Job run {self.job_run_id} of {self.job_name} took {status['JobRun'].get('ExecutionTime')}s which is much slower than usual (p50: {p['p50']}s, p95: {p['p95']}s)")
+
     def wait_for_completion(self):
         """
         Wait for the job to complete.
 
         This means it either succeeded or it was manually stopped.
+        If run_history is set the metrics of the finished run are saved to it.
 
         Raises:
             JobFailed: When the job failed
@@ -400,28 +944,69 @@ class GlueJob:
         while True:
             time.sleep(10)
 
-            status = self.job_status
-            status_code = status["JobRun"]["JobRunState"]
-            status_error = status["JobRun"].get("ErrorMessage", "Unknown")
-
-            if status_code == "SUCCEEDED" :
+            if self._check_job_run_status(self.job_status):
                 break
 
-            if status_code == "FAILED":
-                raise JobFailed(status_error)
-            if status_code == "TIMEOUT":
-                raise JobTimedOut(status_error)
-            if status_code == "STOPPED":
-                raise JobStopped(status_error)
+    def _check_job_run_status(self, status):
+        """
+        Returns True if the job run succeeded and False if it is still running. Raises if it finished any other way.
+        """
+        status_code = status["JobRun"]["JobRunState"]
+        status_error = status["JobRun"].get("ErrorMessage", "Unknown")
+
+        if status_code in ["SUCCEEDED", "FAILED", "TIMEOUT", "STOPPED"]:
+            self._record_job_run(status)
+
+        if status_code == "SUCCEEDED" :
+            return True
+
+        if status_code == "FAILED":
+            raise JobFailed(status_error)
+        if status_code == "TIMEOUT":
+            raise JobTimedOut(status_error)
+        if status_code == "STOPPED":
+            raise JobStopped(status_error)
+
+        return False
 
     def cleanup(self):
         """
         Delete the Glue Job resources (the job itself and the S3 objects)
+        In incremental mode the job itself is kept, as deleting it would also delete its bookmark (call delete_job to remove it).
         """
 
-        self.delete_job()
+        if not self.incremental:
+            self.delete_job()
         self.delete_s3_job_temp_folder()
 
+    # Async versions of the job lifecycle methods. The blocking boto3 calls are run in executor
+    # (the event loop's default thread pool if None) and waiting polls with asyncio.sleep, so no thread is held while a job runs.
+
+    async def _run_in_executor(self, executor, func, *args, **kwargs):
+        # get_running_loop needs python 3.7. Inside a coroutine get_event_loop returns the running loop
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(executor, partial(func, *args, **kwargs))
+
+    async def sync_job_to_s3_folder_async(self, executor=None):
+        await self._run_in_executor(executor, self.sync_job_to_s3_folder)
+
+    async def run_job_async(self, sync_to_s3_before_run=True, executor=None):
+        await self._run_in_executor(executor, self.run_job, sync_to_s3_before_run=sync_to_s3_before_run)
+
+    async def wait_for_completion_async(self, poll_interval=10, executor=None):
+        """
+        Async version of wait_for_completion, checking the job run status every poll_interval seconds
+        """
+        while True:
+            await asyncio.sleep(poll_interval)
+
+            status = await self._run_in_executor(executor, lambda: self.job_status)
+            if await self._run_in_executor(executor, self._check_job_run_status, status):
+                break
+
+    async def cleanup_async(self, executor=None):
+        await self._run_in_executor(executor, self.cleanup)
+
     def delete_job(self):
         """
         DEPRECATED: Use `cleanup()`
@@ -439,3 +1024,55 @@ class GlueJob:
 
         bucket = _s3_resource.Bucket(self.bucket)
         bucket.objects.filter(Prefix=self.s3_job_folder_no_bucket).delete()
+
+
+def create_compaction_job(table, job_folder, bucket, job_role, partitions=None, target_file_size=128 * 1024**2, min_reduction=2,
+                          delete_old_files=False, job_name=None, database_name=None, full_database_path=None):
+    """
+    Write a glue job folder to job_folder that rewrites partitions of table (a TableMeta) into files of about target_file_size bytes
+    (in the table's data_format and compression) and return a GlueJob for it.
+
+    partitions is a list of partitions from table.compaction_candidates and defaults to the candidates for target_file_size and min_reduction
+    (with stats collected from the partition locations in the glue catalog, so partitions that have already been compacted are not picked again).
+    Each partition is written to a new folder (<table path>/_compacted_/<job run id>/<partition>/, which Hive and Athena ignore when listing
+    the table) and only then is the partition's location in the glue catalog switched to it, so queries see either all the old or all the compacted files.
+    If delete_old_files is True the previous files of each partition are deleted once its location has been switched.
+    """
+    if not table.partitions:
+        raise ValueError("Only partitioned tables can be compacted")
+    if table.data_format not in _spark_writers:
+        raise ValueError(f"Can not compact tables with data_format {table.data_format}")
+
+    if database_name is None:
+        if table.database is None:
+            raise ValueError("You must provide a database_name, or register a database object against the table")
+        database_name = table.database.name
+
+    if partitions is None:
+        partitions = table.compaction_candidates(target_file_size, min_reduction, full_database_path=full_database_path, database_name=database_name)
+
+    spark_format, writer_options = _spark_writers[table.data_format]
+    writer_options = {**writer_options, "compression": table.compression or ("uncompressed" if spark_format == "avro" else "none")}
+
+    key = f"{database_name}.{table.name}"
+    config = {
+        "region": _glue_client.meta.region_name,
+        "database": database_name,
+        "table_name": table.name,
+        "table": key,
+        "schemas": {key: _spark_read_spec(table, full_database_path)},
+        "writer": {"format": spark_format, "options": writer_options},
+        "delete_old_files": delete_old_files,
+        "partitions": [{"partition": p["partition"], "values": p["values"], "number_of_files": p["number_of_files"]} for p in partitions],
+    }
+
+    os.makedirs(os.path.join(job_folder, "glue_resources"), exist_ok=True)
+    os.makedirs(os.path.join(job_folder, "glue_py_resources"), exist_ok=True)
+    with open(os.path.join(job_folder, "job.py"), "wb") as f:
+        f.write(pkg_resources.resource_string(__name__, "templates/compaction_job.py"))
+    with open(_spark_runtime_path, "rb") as src, open(os.path.join(job_folder, "glue_py_resources", "glue_spark_runtime.py"), "wb") as dst:
+        dst.write(src.read())
+    write_json(config, os.path.join(job_folder, "glue_resources", "compaction.json"))
+
+    job_name = job_name or f"compact_{database_name}_{table.name}"
+    return GlueJob(job_folder, bucket, job_role, job_name=job_name, include_shared_job_resources=False, metadata_databases=[])
@@ -0,0 +1,92 @@
+"""
+Helpers for reading tables inside a glue job with the spark schemas compiled from their meta data.
+
+This module is uploaded with a GlueJob when its compile_spark_schemas attribute is True, along with a spark_schemas.json
+file (in the job's working directory) holding the schema, format and s3 path of every table in the job's metadata. In job.py:
+
+from glue_spark_runtime import read_table
+df = read_table(spark, "my_database.my_table")
+
+It only needs pyspark, so it can be imported without etl_manager being installed.
+"""
+
+import json
+import os
+
+SPARK_SCHEMAS_FILE = "spark_schemas.json"
+
+# Timestamps and dates as the Hive serdes write them (spark defaults to ISO 8601 with a T and time zone)
+_hive_datetime_options = {"timestampFormat": "yyyy-MM-dd HH:mm:ss", "dateFormat": "yyyy-MM-dd"}
+
+# Reader options matching the glue table definitions (see etl_manager/specs) for each data format.
+# LazySimpleSerDe (csv) does not understand quotes so they are read as part of the value
+_reader_options = {
+    "csv": ("csv", {"header": "false", "sep": ",", "quote": "", "escape": "", **_hive_datetime_options}),
+    "csv_quoted_nodate": ("csv", {"header": "false", "sep": ",", "quote": '"', "escape": "\\", **_hive_datetime_options}),
+    "json": ("json", _hive_datetime_options),
+    "orc": ("orc", {}),
+    "par": ("parquet", {}),
+    "parquet": ("parquet", {}),
+    "avro": ("avro", {}),
+}
+
+_schemas = None
+
+
+def load_spark_schemas(path=None):
+    """
+    Returns the dict of table ("database.table") to compiled schema from spark_schemas.json (in the working directory by default)
+    """
+    global _schemas
+    if path is not None:
+        with open(path) as f:
+            return json.load(f)
+    if _schemas is None:
+        with open(os.path.join(os.getcwd(), SPARK_SCHEMAS_FILE)) as f:
+            _schemas = json.load(f)
+    return _schemas
+
+
+def spark_schema(table, schemas=None):
+    """
+    Returns the StructType of all the columns (partitions last) of table
+    """
+    from pyspark.sql.types import StructType
+
+    spec = (schemas or load_spark_schemas())[table]
+    return StructType.fromJson(spec["schema"])
+
+
+def _reader(spark, spec, options):
+    from pyspark.sql.types import StructType
+
+    if spec["data_format"] not in _reader_options:
+        raise ValueError(f"Can not read tables with data_format {spec['data_format']} with an explicit schema")
+
+    spark_format, reader_options = _reader_options[spec["data_format"]]
+    data_schema = {"type": "struct", "fields": [f for f in spec["schema"]["fields"] if f["name"] not in spec["partitions"]]}
+    return spark.read.format(spark_format).schema(StructType.fromJson(data_schema)).options(**{**reader_options, **options})
+
+
+def read_files(spark, table, path, schemas=None, **options):
+    """
+    Read the data files under path (e.g. one partition folder) with the schema of table's data (non partition) columns
+    """
+    spec = (schemas or load_spark_schemas())[table]
+    return _reader(spark, spec, options).load(path)
+
+
+def read_table(spark, table, path=None, schemas=None, **options):
+    """
+    Read table ("database.table") into a DataFrame using its compiled schema, so spark does not read the data to infer it.
+    path defaults to the table's s3 location (give a partition folder to read part of the table) and options are passed to the reader.
+    Partition columns are read from the key=value folder names and cast to their meta data type.
+    """
+    spec = (schemas or load_spark_schemas())[table]
+    partitions = [f for f in spec["schema"]["fields"] if f["name"] in spec["partitions"]]
+
+    df = _reader(spark, spec, {"basePath": spec["path"], **options}).load(path or spec["path"])
+
+    for p in partitions:
+        df = df.withColumn(p["name"], df[p["name"]].cast(p["type"]))
+    return df
@@ -1,11 +1,16 @@
-from etl_manager.utils import read_json, write_json, _dict_merge, _end_with_slash, _validate_string, _glue_client, _s3_resource, _remove_final_slash
-from copy import copy
+from etl_manager.utils import read_json, write_json, _dict_merge, _end_with_slash, _validate_string, _glue_client, _s3_resource, _remove_final_slash, _split_s3_path, _list_s3_common_prefixes, _s3_prefix_exists, _s3_prefix_fingerprint, _list_s3_objects, _read_s3_object_chunks, _read_s3_object_range, _read_s3_json
+from etl_manager.athena import _normalise_sql, _sql_references_table, _sql_database_names, _athena_connect
+from etl_manager.data import infer_column_types, _infer_columns, validate_data_files, convert_csv_to_parquet, _list_data_files, _convert_value, _count_lines, _parquet_row_count_from_footer, _default_chunk_size
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+import hashlib
 import string
 import json
 import os
 import re
+import time
+import warnings
 import pkg_resources
-from pyathenajdbc import connect
 import jsonschema
 
 _template = {
@@ -13,12 +18,25 @@ _template = {
     "avro":  json.load(pkg_resources.resource_stream(__name__, "specs/avro_specific.json")),
     "csv":  json.load(pkg_resources.resource_stream(__name__, "specs/csv_specific.json")),
     "csv_quoted_nodate":  json.load(pkg_resources.resource_stream(__name__, "specs/csv_quoted_nodate_specific.json")),
+    "json":  json.load(pkg_resources.resource_stream(__name__, "specs/json_specific.json")),
     "regex":  json.load(pkg_resources.resource_stream(__name__, "specs/regex_specific.json")),
     "orc":  json.load(pkg_resources.resource_stream(__name__, "specs/orc_specific.json")),
     "par":  json.load(pkg_resources.resource_stream(__name__, "specs/par_specific.json")),
     "parquet":  json.load(pkg_resources.resource_stream(__name__, "specs/par_specific.json"))
 }
 
+_compression_specs = json.load(pkg_resources.resource_stream(__name__, "specs/compression_specific.json"))
+_data_format_compression_family = {
+    "avro": "avro",
+    "csv": "text",
+    "csv_quoted_nodate": "text",
+    "json": "text",
+    "regex": "text",
+    "orc": "orc",
+    "par": "parquet",
+    "parquet": "parquet"
+}
+
 _agnostic_to_glue_spark_dict = json.load(pkg_resources.resource_stream(__name__, "specs/glue_spark_dict.json"))
 _table_json_schema = json.load(pkg_resources.resource_stream(__name__, "specs/table_schema.json"))
 _web_link_to_table_json_schema = "https://raw.githubusercontent.com/moj-analytical-services/etl_manager/master/etl_manager/specs/table_schema.json"
@@ -26,18 +44,154 @@ _web_link_to_table_json_schema = "https://raw.githubusercontent.com/moj-analytic
 _supported_column_types = _table_json_schema['properties']['columns']['items']['properties']["type"]["enum"]
 _supported_data_formats = _table_json_schema['properties']['data_format']["enum"]
 
+_partition_value_converters = {"int": int, "long": int, "float": float, "double": float}
+_projection_options = {
+    "date": {"required": ["range", "format"], "optional": ["interval", "interval_unit"]},
+    "integer": {"required": ["range"], "optional": ["interval", "digits"]},
+    "enum": {"required": ["values"], "optional": []},
+    "injected": {"required": [], "optional": []},
+}
+
+_range_operators = {
+    ">": lambda v, x: v > x,
+    ">=": lambda v, x: v >= x,
+    "<": lambda v, x: v < x,
+    "<=": lambda v, x: v <= x,
+}
+
+# Spark type names as used in the json of a StructType (e.g. IntegerType -> integer)
+_agnostic_to_spark_json_type = {k : re.sub("Type$", "", v['spark']).lower() for k, v in _agnostic_to_glue_spark_dict.items()}
+
+# Reverse mappings used to build meta data from tables in the glue catalog
+_glue_to_agnostic_type = {v['glue'] : k for k, v in _agnostic_to_glue_spark_dict.items()}
+_glue_to_agnostic_type.update({"integer" : "int", "char" : "character", "varchar" : "character"})
+_serde_to_data_format = {
+    "org.apache.hadoop.hive.serde2.lazy.LazySimpleSerDe" : "csv",
+    "org.apache.hadoop.hive.serde2.OpenCSVSerde" : "csv_quoted_nodate",
+    "org.openx.data.jsonserde.JsonSerDe" : "json",
+    "org.apache.hive.hcatalog.data.JsonSerDe" : "json",
+    "org.apache.hadoop.hive.serde2.RegexSerDe" : "regex",
+    "org.apache.hadoop.hive.ql.io.orc.OrcSerde" : "orc",
+    "org.apache.hadoop.hive.ql.io.parquet.serde.ParquetHiveSerDe" : "parquet",
+    "org.apache.hadoop.hive.serde2.avro.AvroSerDe" : "avro",
+}
+
+def _get_compression_spec(data_format, compression) :
+    """
+    Returns the glue spec for data of data_format compressed with compression
+    """
+    def fill(d) :
+        if isinstance(d, dict) :
+            return {k : fill(v) for k, v in d.items()}
+        if isinstance(d, str) :
+            return d.format(codec = compression, CODEC = compression.upper())
+        return d
+
+    return fill(_compression_specs[_data_format_compression_family[data_format]]['spec'])
+
 def _get_spec(spec_name) :
     if spec_name not in _template :
         raise ValueError("spec_name/data_type requested ({}) is not a valid spec/data_type".format(spec_name))
 
-    return copy(_template[spec_name])
+    return deepcopy(_template[spec_name])
+
+class TableEdit :
+    """
+    A batch of column changes to a table meta object. Create one with TableMeta.edit().
+    Each change is checked when it is made (against the columns as they will be after the earlier changes in the batch)
+    but the table is only updated once, when the with block exits. Renamed and removed columns are also updated in
+    (or removed from) the table partitions, bucket columns, sort columns, partition projection and partition indexes.
+    """
+    def __init__(self, table) :
+        self._table = table
+        # Removed columns are left as None so every operation is O(1)
+        self._columns = [dict(c) for c in table.columns]
+        self._positions = {c['name'] : i for i, c in enumerate(self._columns)}
+        self._original_names = {c['name'] : c['name'] for c in self._columns}
+
+    def __enter__(self) :
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) :
+        if exc_type is None :
+            self._commit()
+        return False
+
+    def _check_column_exists(self, column_name) :
+        if column_name not in self._positions :
+            raise ValueError("The column name: {} does not match those existing in meta: {}".format(column_name, ", ".join(self._positions)))
+
+    def add_column(self, name, type, description) :
+        if name in self._positions :
+            raise ValueError("The column name provided ({}) already exists table in meta.".format(name))
+        self._table._check_valid_datatype(type)
+        _validate_string(name)
+        self._positions[name] = len(self._columns)
+        self._original_names[name] = None
+        self._columns.append({"name": name, "type": type, "description": description})
+
+    def remove_column(self, column_name) :
+        self._check_column_exists(column_name)
+        self._columns[self._positions.pop(column_name)] = None
+        self._original_names.pop(column_name)
+
+    def update_column(self, column_name, new_name = None, new_type = None, new_description = None) :
+        self._check_column_exists(column_name)
+
+        if new_name is None and new_type is None and new_description is None :
+            raise ValueError("one or more of the function inputs (new_name, new_type and new_description) must be specified.")
+
+        if new_name is not None :
+            _validate_string(new_name, "_")
+            if new_name != column_name and new_name in self._positions :
+                raise ValueError("The column name provided ({}) already exists table in meta.".format(new_name))
+        if new_type is not None :
+            self._table._check_valid_datatype(new_type)
+        if new_description is not None :
+            _validate_string(new_description, "_,.")
+
+        c = self._columns[self._positions[column_name]]
+        if new_name is not None :
+            c['name'] = new_name
+            self._positions[new_name] = self._positions.pop(column_name)
+            self._original_names[new_name] = self._original_names.pop(column_name)
+        if new_type is not None :
+            c['type'] = new_type
+        if new_description is not None :
+            c['description'] = new_description
+
+    def _commit(self) :
+        table = self._table
+        new_names = {original : name for name, original in self._original_names.items() if original is not None}
+
+        partitions = [new_names[p] for p in table.partitions if p in new_names]
+        bucket_columns = [new_names[b] for b in table.bucket_columns if b in new_names]
+        sort_columns = [dict(sc, name = new_names[sc['name']]) for sc in table.sort_columns if sc['name'] in new_names]
+        partition_projection = {new_names[k] : v for k, v in table.partition_projection.items() if k in new_names}
+        # Indexes on a removed partition are dropped
+        partition_indexes = {i : [new_names[k] for k in keys] for i, keys in table.partition_indexes.items() if all(k in new_names for k in keys)}
+
+        previous = (table.columns, table.partitions, table.bucket_columns, table.number_of_buckets, table.sort_columns, table.partition_projection, table.partition_indexes)
+        try :
+            table.columns = [c for c in self._columns if c is not None]
+            table.partitions = partitions
+            table.set_bucketing(bucket_columns, table.number_of_buckets if bucket_columns else None)
+            table.sort_columns = sort_columns
+            table.partition_projection = partition_projection
+            table.partition_indexes = partition_indexes
+        except :
+            table.columns, table.partitions = previous[0], previous[1]
+            table.set_bucketing(previous[2], previous[3])
+            table.sort_columns, table.partition_projection, table.partition_indexes = previous[4], previous[5], previous[6]
+            raise
+
 
 class TableMeta :
     """
     Manipulate the agnostic metadata associated with a table and convert to a Glue spec
     """
 
-    def __init__(self, name, location, columns = [], data_format = 'csv',  description = '', partitions = [], glue_specific = {}, database = None) :
+    def __init__(self, name, location, columns = [], data_format = 'csv',  description = '', partitions = [], glue_specific = {}, database = None, bucket_columns = [], number_of_buckets = None, sort_columns = [], partition_projection = {}, compression = None, partition_indexes = {}) :
        
         self.name = name
         self.location = location
@@ -47,9 +201,29 @@ class TableMeta :
         self.partitions = partitions
         self.glue_specific = glue_specific
         self.database = database
+        self.set_bucketing(bucket_columns, number_of_buckets)
+        self.sort_columns = sort_columns
+        self.partition_projection = partition_projection
+        self.partition_indexes = partition_indexes
+        self.compression = compression
+        self._stats = None
+        self._json_path = None
+        self._clean_dict = None
 
         jsonschema.validate(self.to_dict(), _table_json_schema)
 
+    @property
+    def is_dirty(self) :
+        """
+        True if the table has been modified since it was last read from or written to json.
+        The table's meta data is compared with a snapshot taken then, so in place edits (e.g. of a column dict) are seen too.
+        """
+        return self._clean_dict is None or self.to_dict() != self._clean_dict
+
+    def _mark_clean(self, file_path) :
+        self._json_path = os.path.abspath(file_path)
+        self._clean_dict = deepcopy(self.to_dict())
+
     @property
     def name(self) :
         return self._name
@@ -67,7 +241,24 @@ class TableMeta :
     @data_format.setter
     def data_format(self, data_format) :
         self._check_valid_data_format(data_format)
+        if getattr(self, '_compression', None) :
+            self._check_valid_compression(data_format, self._compression)
         self._data_format = data_format
+
+    @property
+    def compression(self) :
+        """
+        The compression codec of the data files (None if the data is not compressed)
+        """
+        return self._compression
+
+    @compression.setter
+    def compression(self, compression) :
+        if compression == 'none' :
+            compression = None
+        if compression is not None :
+            self._check_valid_compression(self.data_format, compression)
+        self._compression = compression
     
     @property
     def column_names(self) :
@@ -83,12 +274,153 @@ class TableMeta :
         if partitions is None :
             self._partitions = []
         else :
-            for p in partitions : self._check_column_exists(p)
+            column_names = set(self.column_names)
+            for p in partitions :
+                if p not in column_names : self._check_column_exists(p)
             new_col_order = [c for c in self.column_names if c not in partitions]
             new_col_order = new_col_order + partitions
             self._partitions = partitions
             self.reorder_columns(new_col_order)
 
+    # bucketing
+    @property
+    def bucket_columns(self) :
+        return self._bucket_columns
+
+    @property
+    def number_of_buckets(self) :
+        return self._number_of_buckets
+
+    def set_bucketing(self, bucket_columns, number_of_buckets) :
+        """
+        Bucket the table by bucket_columns into number_of_buckets buckets. Set bucket_columns to an empty list (or None) to remove bucketing.
+        """
+        bucket_columns = list(bucket_columns) if bucket_columns else []
+        if bucket_columns :
+            for c in bucket_columns :
+                self._check_column_exists(c)
+                if c in self.partitions :
+                    raise ValueError("Partition column ({}) cannot be used as a bucket column".format(c))
+            if not isinstance(number_of_buckets, int) or isinstance(number_of_buckets, bool) or number_of_buckets < 1 :
+                raise ValueError("number_of_buckets must be a positive integer when bucket_columns are given")
+        elif number_of_buckets is not None :
+            raise ValueError("number_of_buckets can only be set with bucket_columns")
+        self._bucket_columns = bucket_columns
+        self._number_of_buckets = number_of_buckets if bucket_columns else None
+
+    # sort columns
+    @property
+    def sort_columns(self) :
+        """
+        List of {"name": column_name, "order": "asc" or "desc"} dicts giving the sort order of the data within each file/bucket.
+        Can be set with column names (sorted ascending) or dicts.
+        """
+        return self._sort_columns
+
+    @sort_columns.setter
+    def sort_columns(self, sort_columns) :
+        new_sort_columns = []
+        for sc in (sort_columns if sort_columns else []) :
+            sc = {"name" : sc, "order" : "asc"} if isinstance(sc, str) else {"name" : sc["name"], "order" : sc.get("order", "asc")}
+            self._check_column_exists(sc["name"])
+            if sc["name"] in self.partitions :
+                raise ValueError("Partition column ({}) cannot be used as a sort column".format(sc["name"]))
+            if sc["order"] not in ["asc", "desc"] :
+                raise ValueError("Sort order for column {} must be asc or desc".format(sc["name"]))
+            new_sort_columns.append(sc)
+        self._sort_columns = new_sort_columns
+
+    # partition projection
+    @property
+    def partition_projection(self) :
+        """
+        Dict of partition name to an Athena partition projection definition. Each definition needs a type and the settings for that type:
+            date: range (e.g. ["2018-01-01", "NOW"]) and format (e.g. "yyyy-MM-dd"), optionally interval and interval_unit
+            integer: range (e.g. [1, 12]), optionally interval and digits
+            enum: values (e.g. ["a", "b"])
+            injected: no settings (values must be given in the query)
+        If any partition is projected then they all must be.
+        """
+        return self._partition_projection
+
+    @partition_projection.setter
+    def partition_projection(self, partition_projection) :
+        partition_projection = deepcopy(partition_projection) if partition_projection else {}
+        for p, projection in partition_projection.items() :
+            if p not in self.partitions :
+                raise ValueError("Partition projection given for {} which is not a partition of the table".format(p))
+            projection_type = projection.get("type")
+            if projection_type not in _projection_options :
+                raise ValueError("Partition projection type for {} must be one of: {}".format(p, ", ".join(_projection_options)))
+            options = _projection_options[projection_type]
+            for k in options["required"] :
+                if k not in projection :
+                    raise ValueError("Partition projection of type {} for {} must include {}".format(projection_type, p, k))
+            for k in projection :
+                if k != "type" and k not in options["required"] + options["optional"] :
+                    raise ValueError("{} is not a valid setting for a partition projection of type {}".format(k, projection_type))
+            if "range" in projection and isinstance(projection["range"], (list, tuple)) and len(projection["range"]) != 2 :
+                raise ValueError("Partition projection range for {} must have two values (min and max)".format(p))
+
+        if partition_projection :
+            missing = [p for p in self.partitions if p not in partition_projection]
+            if missing :
+                raise ValueError("All partitions must be projected if any are. Missing projection for: {}".format(", ".join(missing)))
+
+        self._partition_projection = partition_projection
+
+    # partition indexes
+    @property
+    def partition_indexes(self) :
+        """
+        Dict of index name to the list of partition columns (in order) of a glue partition index.
+        Indexes let glue (and Athena) find the partitions matching a filter without reading every partition of the table.
+        """
+        return self._partition_indexes
+
+    @partition_indexes.setter
+    def partition_indexes(self, partition_indexes) :
+        partition_indexes = {k : list(v) for k, v in partition_indexes.items()} if partition_indexes else {}
+        if len(partition_indexes) > 3 :
+            raise ValueError("A table can have at most 3 partition indexes")
+        for index_name, keys in partition_indexes.items() :
+            _validate_string(index_name)
+            if not keys :
+                raise ValueError("Partition index {} must have at least one partition column".format(index_name))
+            if len(set(keys)) != len(keys) :
+                raise ValueError("Partition index {} has duplicate columns".format(index_name))
+            for k in keys :
+                if k not in self.partitions :
+                    raise ValueError("Partition index {} uses {} which is not a partition of the table".format(index_name, k))
+        self._partition_indexes = partition_indexes
+
+    def glue_partition_indexes(self) :
+        """
+        Returns the partition indexes in the form taken by glue create_table (PartitionIndexes)
+        """
+        return [{"Keys" : keys, "IndexName" : index_name} for index_name, keys in self.partition_indexes.items()]
+
+    @property
+    def is_projected(self) :
+        return bool(self.partition_projection)
+
+    def _partition_projection_parameters(self, table_s3_path) :
+        """
+        Returns the glue table parameters needed for Athena partition projection
+        """
+        def as_string(v) :
+            return ",".join(str(x) for x in v) if isinstance(v, (list, tuple)) else str(v)
+
+        parameters = {"projection.enabled" : "true"}
+        for p in self.partitions :
+            projection = self.partition_projection[p]
+            for k, v in projection.items() :
+                parameters["projection.{}.{}".format(p, k.replace("_", "."))] = as_string(v)
+
+        template = "/".join("{0}=${{{0}}}".format(p) for p in self.partitions)
+        parameters["storage.location.template"] = _end_with_slash(table_s3_path) + template + "/"
+        return parameters
+
     @property
     def location(self) :
         return self._location
@@ -116,26 +448,32 @@ class TableMeta :
             raise ValueError('database must be a database meta object from the DatabaseMeta class.')
         self._database = database
 
+    def edit(self) :
+        """
+        Returns a context manager to make many column changes to the table at once. Changes are checked as they are made but only applied
+        (and the columns reordered) once, when the with block ends. If an error is raised inside the block no changes are made.
+
+        with table.edit() as e :
+            e.add_column('new_col', 'int', 'a new column')
+            e.update_column('old_name', new_name = 'new_name')
+            e.remove_column('unused_col')
+        """
+        return TableEdit(self)
+
     def remove_column(self, column_name) :
-        self._check_column_exists(column_name)
-        new_cols = [c for c in self.columns if c['name'] != column_name]
-        new_partitions = [p for p in self.partitions if p != column_name]
-        self.columns = new_cols
-        self.partitions = new_partitions
+        with self.edit() as e :
+            e.remove_column(column_name)
 
     def add_column(self, name, type, description) :
-        self._check_column_does_not_exists(name)
-        self._check_valid_datatype(type)
-        _validate_string(name)
-        cols = self.columns
-        cols.append({"name": name, "type": type, "description": description})
-        self.columns = cols
+        with self.edit() as e :
+            e.add_column(name, type, description)
 
     def reorder_columns(self, column_name_order) :
+        positions = {c : i for i, c in enumerate(column_name_order)}
         for c in self.column_names :
-            if c not in column_name_order :
+            if c not in positions :
                 raise ValueError("input column_name_order is missing column ({}) in meta table".format(c))
-        self.columns = sorted(self.columns, key=lambda x: column_name_order.index(x['name']))
+        self.columns = sorted(self.columns, key=lambda x: positions[x['name']])
 
     def generate_glue_columns(self, exclude_columns = []) :
 
@@ -150,10 +488,22 @@ class TableMeta :
 
         return glue_columns
 
+    def spark_schema(self) :
+        """
+        Returns the spark schema of the table (partitions last) as StructType json. Create the StructType with StructType.fromJson.
+        """
+        fields = [{"name" : c['name'], "type" : _agnostic_to_spark_json_type[c['type']], "nullable" : True, "metadata" : {"comment" : c['description']}} for c in self.columns]
+        return {"type" : "struct", "fields" : fields}
+
     def _check_valid_data_format(self, data_format) :
         if data_format not in _supported_data_formats :
             raise ValueError("The data_format provided ({}) must match the supported data_type names: {}".format(data_format, ", ".join(_supported_data_formats)))
 
+    def _check_valid_compression(self, data_format, compression) :
+        codecs = _compression_specs[_data_format_compression_family[data_format]]['codecs']
+        if compression not in codecs :
+            raise ValueError("The compression provided ({}) is not supported for the data_format {}. Must be one of: {}".format(compression, data_format, ", ".join(codecs)))
+
     def _check_valid_datatype(self, data_type) :
         if data_type not in _supported_column_types :
             raise ValueError("The data_type provided must match the supported data_type names: {}".format(", ".join(_supported_column_types)))
@@ -167,36 +517,255 @@ class TableMeta :
             raise ValueError("The column name provided ({}) already exists table in meta.".format(column_name))
 
     def update_column(self, column_name, new_name = None, new_type = None, new_description = None) :
+        with self.edit() as e :
+            e.update_column(column_name, new_name = new_name, new_type = new_type, new_description = new_description)
 
-        self._check_column_exists(column_name)
+    def _s3_table_path(self, full_database_path = None) :
+        if full_database_path:
+            return os.path.join(full_database_path, self.location)
+        elif self.database:
+            return os.path.join(self.database.s3_database_path, self.location)
+        else:
+            raise ValueError("Need to provide a database or full database path to get the s3 path of the table")
 
-        if new_name is None and new_type is None and new_description is None :
-            raise ValueError("one or more of the function inputs (new_name, new_type and new_description) must be specified.")
-        new_cols = []
-        for c in self.columns :
-            if c['name'] == column_name :
+    def _partition_value(self, column_name, value) :
+        column_type = [c['type'] for c in self.columns if c['name'] == column_name][0]
+        return _partition_value_converters.get(column_type, str)(str(value))
+
+    def _partition_predicate_matches(self, column_name, predicate, value) :
+        try :
+            value = self._partition_value(column_name, value)
+        except ValueError :
+            # Folders whose value is not of the column type (e.g. __HIVE_DEFAULT_PARTITION__ under an int partition) can not be in a range
+            return False
+        for op, x in predicate.items() :
+            if not _range_operators[op](value, self._partition_value(column_name, x)) :
+                return False
+        return True
+
+    def get_partition_paths(self, predicates = None, full_database_path = None, max_workers = 10) :
+        """
+        Returns the s3 paths of the partitions that match the predicates (e.g. to use as glue job inputs).
+        predicates is a dict mapping partition names to one of:
+            a single value (equality) e.g. {"snapshot_year": 2018}
+            a list of values (IN) e.g. {"snapshot_month": [1, 2, 3]}
+            a dict of range operators (>, >=, <, <=) e.g. {"snapshot_date": {">=": "2018-01-01", "<": "2018-01-08"}}
+        Partitions without a predicate match any value. Rather than listing the whole table location, each partition level is
+        either built directly from the predicate values or found with a delimiter listing of the matching prefixes from the level above.
+        """
+        if not self.partitions :
+            raise ValueError("Table {} has no partitions".format(self.name))
+
+        predicates = predicates if predicates else {}
+        for p in predicates :
+            if p not in self.partitions :
+                raise ValueError("Predicate column ({}) is not one of the table partitions: {}".format(p, ", ".join(self.partitions)))
+            if isinstance(predicates[p], dict) :
+                for op in predicates[p] :
+                    if op not in _range_operators :
+                        raise ValueError("Range operator {} must be one of: {}".format(op, ", ".join(_range_operators)))
+
+        bucket, table_prefix = _split_s3_path(_end_with_slash(self._s3_table_path(full_database_path)))
+        prefixes = [table_prefix]
+        prefixes_listed = True
+
+        with ThreadPoolExecutor(max_workers = max_workers) as executor :
+            for p in self.partitions :
+                predicate = predicates.get(p)
+                if predicate is not None and not isinstance(predicate, dict) :
+                    values = predicate if isinstance(predicate, (list, tuple, set)) else [predicate]
+                    prefixes = [prefix + "{}={}/".format(p, v) for prefix in prefixes for v in values]
+                    prefixes_listed = False
+                else :
+                    listings = executor.map(lambda prefix : _list_s3_common_prefixes(bucket, prefix), prefixes)
+                    new_prefixes = []
+                    for prefix, listing in zip(prefixes, listings) :
+                        for cp in listing :
+                            key, _, value = cp[len(prefix):-1].partition('=')
+                            if key == p and (predicate is None or self._partition_predicate_matches(p, predicate, value)) :
+                                new_prefixes.append(cp)
+                    prefixes = new_prefixes
+                    prefixes_listed = True
+
+            if not prefixes_listed :
+                exists = list(executor.map(lambda prefix : _s3_prefix_exists(bucket, prefix), prefixes))
+                prefixes = [prefix for prefix, e in zip(prefixes, exists) if e]
+
+        return ["s3://{}/{}".format(bucket, prefix) for prefix in prefixes]
+
+    @property
+    def stats(self) :
+        """
+        Table statistics gathered by collect_stats (None if they have not been collected)
+        """
+        return self._stats
+
+    def _object_compression(self, key) :
+        if self.compression :
+            return self.compression
+        for suffix, codec in [('.gz', 'gzip'), ('.bz2', 'bzip2')] :
+            if key.endswith(suffix) :
+                return codec
+        return None
+
+    @property
+    def _header_line_count(self) :
+        # Set through glue_specific as a table, storage descriptor or serde parameter
+        for parameters in _glue_specific_parameters(self.glue_specific or {}) :
+            if 'skip.header.line.count' in parameters :
+                return int(parameters['skip.header.line.count'])
+        return 0
+
+    def _object_row_count(self, bucket, key) :
+        compression_family = _data_format_compression_family[self.data_format]
+        if compression_family == 'text' :
+            n_lines = _count_lines(_read_s3_object_chunks(bucket, key), compression = self._object_compression(key))
+            if self.data_format.startswith('csv') :
+                n_lines = max(n_lines - self._header_line_count, 0)
+            return n_lines
+        if compression_family == 'parquet' :
+            n_rows = _parquet_row_count_from_footer(_read_s3_object_range(bucket, key, '-65536'))
+            if n_rows < 0 :
+                n_rows = _parquet_row_count_from_footer(_read_s3_object_range(bucket, key, str(n_rows)))
+            return n_rows
+        raise ValueError("Row counts can only be collected for text (csv, json, regex) or parquet data (not {})".format(self.data_format))
+
+    def _glue_partition_locations(self, database_name) :
+        """
+        Returns a dict of partition folder (e.g. "year=2018/") to the s3 location of that partition in the glue catalog
+        """
+        locations = {}
+        kwargs = {}
+        while True :
+            response = _glue_client.get_partitions(DatabaseName = database_name, TableName = self.name, **kwargs)
+            for p in response['Partitions'] :
+                folder = "".join("{}={}/".format(k, v) for k, v in zip(self.partitions, p['Values']))
+                locations[folder] = _end_with_slash(p['StorageDescriptor']['Location'])
+            if not response.get('NextToken') :
+                return locations
+            kwargs['NextToken'] = response['NextToken']
+
+    def collect_stats(self, full_database_path = None, row_counts = False, max_workers = 10, cache_path = None, database_name = None) :
+        """
+        Walk the table location in s3 to collect the number of files, total size and (if row_counts is True) the number of records
+        of the table and each of its partitions. Partitions are found with delimiter listings and listed (and counted) in parallel over max_workers threads.
+        If database_name is given the partitions and their locations are read from the table in that glue database instead, so partitions
+        whose location has been moved (e.g. by a compaction job) are described by the files they currently point at.
+        Row counts are cached against the keys and etags of each partition's files, so unchanged partitions are not rescanned
+        by later calls (the cache is also written to / read from the json file cache_path if given).
+        The stats are added to the table (and partition) parameters when the table is created with DatabaseMeta.create_glue_database.
+        Returns the stats dict.
+        """
+        table_path = _end_with_slash(self._s3_table_path(full_database_path))
+        if self.partitions and database_name :
+            locations = self._glue_partition_locations(database_name)
+        elif self.partitions :
+            locations = {p[len(table_path):] : p for p in self.get_partition_paths(full_database_path = full_database_path, max_workers = max_workers)}
+        else :
+            locations = {'' : table_path}
+        partition_prefixes = [(partition,) + _split_s3_path(location) for partition, location in sorted(locations.items())]
 
-                if new_name is not None :
-                    _validate_string(new_name, "_")
-                    c['name'] = new_name
+        if cache_path and os.path.exists(cache_path) :
+            cache = read_json(cache_path)
+        else :
+            cache = self._stats['partitions'] if self._stats else {}
+
+        partitions = {}
+        to_count = []
+        with ThreadPoolExecutor(max_workers = max_workers) as executor :
+            listings = executor.map(lambda x : _list_s3_objects(x[1], x[2]), partition_prefixes)
+            for (partition, bucket, prefix), objects in zip(partition_prefixes, listings) :
+                # Hive ignores files starting with _ or . (e.g. _SUCCESS) and folder placeholders
+                objects = [o for o in objects if not os.path.basename(o['Key']).startswith(('_', '.')) and not o['Key'].endswith('/')]
+                signature = hashlib.sha256(json.dumps(sorted((o['Key'], o['ETag']) for o in objects)).encode('utf-8')).hexdigest()
+                partitions[partition] = {
+                    "values" : [segment.split('=', 1)[1] for segment in partition.split('/') if '=' in segment],
+                    "numFiles" : len(objects),
+                    "totalSize" : sum(o['Size'] for o in objects),
+                    "recordCount" : None,
+                    "signature" : signature
+                }
+                if row_counts :
+                    cached = cache.get(partition, {})
+                    if cached.get('signature') == signature and cached.get('recordCount') is not None :
+                        partitions[partition]['recordCount'] = cached['recordCount']
+                    else :
+                        to_count.append((partition, bucket, objects))
+
+            count_objects = [(partition, bucket, o['Key']) for partition, bucket, objects in to_count for o in objects]
+            counts = executor.map(lambda x : self._object_row_count(x[1], x[2]), count_objects)
+            for partition, _, _ in to_count :
+                partitions[partition]['recordCount'] = 0
+            for (partition, _, _), n in zip(count_objects, counts) :
+                partitions[partition]['recordCount'] += n
+
+        stats = {
+            "numFiles" : sum(p['numFiles'] for p in partitions.values()),
+            "totalSize" : sum(p['totalSize'] for p in partitions.values()),
+            "recordCount" : sum(p['recordCount'] for p in partitions.values()) if row_counts else None,
+            "partitions" : partitions
+        }
+        self._stats = stats
+        if cache_path :
+            write_json(partitions, cache_path)
 
-                if new_type is not None :
-                    self._check_valid_datatype(new_type)
-                    c['type'] = new_type
+        return stats
 
-                if new_description is not None :
-                    _validate_string(new_description, "_,.")
-                    c['description'] = new_description
+    @staticmethod
+    def _stats_parameters(stats) :
+        parameters = {"numFiles" : str(stats['numFiles']), "totalSize" : str(stats['totalSize'])}
+        if stats['recordCount'] is not None :
+            parameters['recordCount'] = str(stats['recordCount'])
+        return parameters
 
-            new_cols.append(c)
+    def compaction_candidates(self, target_file_size = 128 * 1024**2, min_reduction = 2, full_database_path = None, max_workers = 10, refresh_stats = False, database_name = None) :
+        """
+        Returns the partitions worth compacting, from the file counts and sizes found by collect_stats (run if the table has no stats or refresh_stats is True).
+        A partition is a candidate if rewriting it into files of about target_file_size bytes would divide its number of files by at least min_reduction.
+        Each candidate is a dict of the partition folder (e.g. "year=2018/"), its values, numFiles, totalSize and the number_of_files to write.
+        Give the glue database_name once the table has been compacted before: stats are then collected from each partition's location in the catalog,
+        otherwise the (stale) files left in the default partition folders are counted and compacted partitions are picked again.
+        """
+        if not self.partitions :
+            raise ValueError("Only partitioned tables can be compacted")
+        if refresh_stats or not self.stats or database_name :
+            stats = self.collect_stats(full_database_path = full_database_path, max_workers = max_workers, database_name = database_name)
+        else :
+            stats = self.stats
 
-        self.columns = new_cols
+        candidates = []
+        for partition, p in sorted(stats['partitions'].items()) :
+            number_of_files = max(1, -(-p['totalSize'] // target_file_size))
+            if p['numFiles'] > 1 and p['numFiles'] >= number_of_files * min_reduction :
+                candidates.append({"partition" : partition, "values" : p['values'], "numFiles" : p['numFiles'], "totalSize" : p['totalSize'], "number_of_files" : number_of_files})
+        return candidates
+
+    def glue_partition_inputs(self, glue_table_definition) :
+        """
+        Returns glue PartitionInputs (with the collected stats as parameters) for each partition found by collect_stats
+        """
+        if not self.partitions or not self.stats :
+            return []
+
+        partition_inputs = []
+        table_location = _end_with_slash(glue_table_definition['StorageDescriptor']['Location'])
+        for partition, partition_stats in sorted(self.stats['partitions'].items()) :
+            storage_descriptor = deepcopy(glue_table_definition['StorageDescriptor'])
+            storage_descriptor['Location'] = table_location + partition
+            partition_inputs.append({
+                "Values" : partition_stats['values'],
+                "StorageDescriptor" : storage_descriptor,
+                "Parameters" : self._stats_parameters(partition_stats)
+            })
+        return partition_inputs
 
     def glue_table_definition(self, full_database_path = None) :
 
         glue_table_definition = _get_spec('base')
         specific = _get_spec(self.data_format)
         _dict_merge(glue_table_definition, specific)
+        if self.compression :
+            _dict_merge(glue_table_definition, _get_compression_spec(self.data_format, self.compression))
 
         # Create glue specific variables from meta data
         glue_table_definition["Name"] = self.name
@@ -204,22 +773,33 @@ class TableMeta :
 
         glue_table_definition['StorageDescriptor']['Columns'] = self.generate_glue_columns(exclude_columns = self.partitions)
 
-        if full_database_path:
-            glue_table_definition['StorageDescriptor']["Location"] = os.path.join(full_database_path, self.location)
-        elif self.database:
-            glue_table_definition['StorageDescriptor']["Location"] = os.path.join(self.database.s3_database_path, self.location)
+        if full_database_path or self.database:
+            glue_table_definition['StorageDescriptor']["Location"] = self._s3_table_path(full_database_path)
         else:
             raise ValueError("Need to provide a database or full database path to generate glue table def")
 
         if self.glue_specific:
             _dict_merge(glue_table_definition, self.glue_specific)
 
+        if self.bucket_columns :
+            glue_table_definition['StorageDescriptor']['NumberOfBuckets'] = self.number_of_buckets
+            glue_table_definition['StorageDescriptor']['BucketColumns'] = list(self.bucket_columns)
+
+        if self.sort_columns :
+            glue_table_definition['StorageDescriptor']['SortColumns'] = [{"Column" : sc["name"], "SortOrder" : 1 if sc["order"] == "asc" else 0} for sc in self.sort_columns]
+
         if len(self.partitions) > 0 :
             not_partitions = [c for c in self.column_names if c not in self.partitions]
             glue_partition_cols = self.generate_glue_columns(exclude_columns = not_partitions)
 
             glue_table_definition['PartitionKeys'] = glue_partition_cols
 
+            if self.is_projected :
+                glue_table_definition['Parameters'].update(self._partition_projection_parameters(glue_table_definition['StorageDescriptor']["Location"]))
+
+        if self.stats :
+            glue_table_definition['Parameters'].update(self._stats_parameters(self.stats))
+
         return glue_table_definition
 
     def to_dict(self) :
@@ -232,10 +812,22 @@ class TableMeta :
             "partitions" : self.partitions,
             "location" : self.location
         }
+        if self.bucket_columns :
+            meta["bucket_columns"] = self.bucket_columns
+            meta["number_of_buckets"] = self.number_of_buckets
+        if self.sort_columns :
+            meta["sort_columns"] = self.sort_columns
+        if self.partition_projection :
+            meta["partition_projection"] = self.partition_projection
+        if self.partition_indexes :
+            meta["partition_indexes"] = self.partition_indexes
+        if self.compression :
+            meta["compression"] = self.compression
         return meta
 
     def write_to_json(self, file_path) :
         write_json(self.to_dict(), file_path)
+        self._mark_clean(file_path)
 
     def generate_markdown_doc(self, filepath) :
         """
@@ -293,21 +885,76 @@ class TableMeta :
             f.write("\n")
             f.write("***")
             f.write("\n")
-        
-        
-    def refresh_paritions(self, temp_athena_staging_dir = None, database_name = None) :
+
+    @property
+    def _csv_delimiter(self) :
+        serde_parameters = dict(_template[self.data_format]['StorageDescriptor']['SerdeInfo'].get('Parameters', {}))
+        serde_parameters.update((self.glue_specific or {}).get('StorageDescriptor', {}).get('SerdeInfo', {}).get('Parameters', {}))
+        return serde_parameters.get('field.delim', serde_parameters.get('separatorChar', ','))
+
+    def validate_data(self, data_path, header = None, chunk_size = _default_chunk_size, max_workers = None, n_samples = 5) :
+        """
+        Check that the local data file(s) at data_path match the types of the table columns before they are registered with glue.
+        data_path should be a local copy of (or stand in for) the table location, i.e. partitions are read from key=value folders below it.
+        header defaults to whether the table skips a header line, and csv files are split on the table's delimiter.
+        Files are streamed in chunks of chunk_size rows and checked in parallel over max_workers processes.
+        Returns a report dict with the number of files and rows checked, whether the data is valid and
+        the number of violations (plus up to n_samples example rows) for each column.
+        """
+        if header is None :
+            header = self._header_line_count > 0
+        delimiter = self._csv_delimiter if self.data_format in ['csv', 'csv_quoted_nodate'] else ','
+        return validate_data_files(data_path, self.columns, self.partitions, self.data_format, header = header, delimiter = delimiter, chunk_size = chunk_size, max_workers = max_workers, n_samples = n_samples)
+
+    def convert_to_parquet(self, data_path, output_path, location = None, header = None, row_group_size = 1000000, compression = 'snappy', max_workers = None) :
+        """
+        Convert the local csv data file(s) at data_path (a local copy of the table location) into parquet files written under output_path.
+        The partition layout (key=value folders) of data_path is kept. Column types and the delimiter are taken from the table meta data,
+        and header defaults to whether the table skips a header line.
+        Files are streamed in row groups of row_group_size rows and converted in parallel over max_workers processes.
+        Returns a new table meta object describing the parquet data. Its location defaults to the location of this table and it keeps
+        this table's database and glue_specific (less any csv header setting). Requires pyarrow.
+        """
+        if self.data_format not in ['csv', 'csv_quoted_nodate'] :
+            raise ValueError("Can only convert tables with a csv data_format to parquet (not {})".format(self.data_format))
+
+        columns = [(c['name'], _agnostic_to_glue_spark_dict[c['type']]['glue']) for c in self.columns]
+        if header is None :
+            header = self._header_line_count > 0
+        convert_csv_to_parquet(data_path, output_path, columns, self.partitions, self.data_format, header = header, delimiter = self._csv_delimiter, row_group_size = row_group_size, compression = compression, max_workers = max_workers)
+
+        # The parquet files have no header line to skip
+        glue_specific = deepcopy(self.glue_specific or {})
+        for parameters in _glue_specific_parameters(glue_specific) :
+            parameters.pop('skip.header.line.count', None)
+
+        tab = TableMeta(name = self.name,
+            location = location if location else self.location,
+            columns = deepcopy(self.columns),
+            data_format = 'parquet',
+            description = self.description,
+            partitions = list(self.partitions),
+            glue_specific = glue_specific,
+            database = self.database,
+            compression = compression)
+
+        return tab
+
+    def refresh_paritions(self, temp_athena_staging_dir = None, database_name = None, backend = None) :
         """
-        Refresh the partitions in a table, if they exist
+        Refresh the partitions in a table, if they exist.
+        Tables using partition projection are skipped as Athena works out their partitions at query time.
+        backend is the Athena backend to run the query with (see etl_manager.athena.set_default_backend).
         """
 
-        if self.partitions:
+        if self.partitions and not self.is_projected:
             if not temp_athena_staging_dir:
                 if self.database:
                     temp_athena_staging_dir = self.database.s3_athena_temp_folder
                 else:
                     raise ValueError("You must provide a path to a directory in s3 for Athena to cache query results")
 
-            conn = connect(s3_staging_dir = temp_athena_staging_dir, region_name = 'eu-west-1')
+            conn = _athena_connect(backend, s3_staging_dir = temp_athena_staging_dir, region_name = 'eu-west-1')
 
             if not database_name:
                 if self.database:
@@ -451,6 +1098,7 @@ class DatabaseMeta :
     def create_glue_database(self) :
         """
         Creates a database in Glue based on the database object calling the method function. If a database with the same name (db.name) already exists it overwrites it.
+        Tables are created with their partition indexes and this waits until the indexes are active.
         """
         db = {
             "DatabaseInput": {
@@ -463,7 +1111,160 @@ class DatabaseMeta :
 
         for tab in self._tables :
             glue_table_def = tab.glue_table_definition(self.s3_database_path)
-            _glue_client.create_table(DatabaseName = self.name, TableInput = glue_table_def)
+            table_kwargs = {"PartitionIndexes" : tab.glue_partition_indexes()} if tab.partition_indexes else {}
+            _glue_client.create_table(DatabaseName = self.name, TableInput = glue_table_def, **table_kwargs)
+
+            # Register partitions found by collect_stats along with their stats (glue takes at most 100 per call)
+            if not tab.is_projected :
+                partition_inputs = tab.glue_partition_inputs(glue_table_def)
+                errors = []
+                for i in range(0, len(partition_inputs), 100) :
+                    response = _glue_client.batch_create_partition(DatabaseName = self.name, TableName = tab.name, PartitionInputList = partition_inputs[i:i+100])
+                    errors += response.get('Errors', [])
+                # batch_create_partition reports partitions it could not create rather than raising
+                if errors :
+                    details = ["{}: {}".format("/".join(e.get('PartitionValues', [])), e.get('ErrorDetail', {}).get('ErrorMessage', e.get('ErrorDetail', {}).get('ErrorCode'))) for e in errors]
+                    raise RuntimeError("Failed to create {} partition(s) of table {}.{}: {}".format(len(errors), self.name, tab.name, "; ".join(details)))
+
+        for tab in self._tables :
+            if tab.partition_indexes :
+                self._wait_for_partition_indexes(tab.name, list(tab.partition_indexes))
+
+    def _get_partition_indexes(self, table_name) :
+        """
+        Returns a dict of index name to the glue partition index descriptor of each index of the table
+        """
+        indexes = {}
+        kwargs = {}
+        while True :
+            response = _glue_client.get_partition_indexes(DatabaseName = self.name, TableName = table_name, **kwargs)
+            for index in response.get("PartitionIndexDescriptorList", []) :
+                indexes[index["IndexName"]] = index
+            if not response.get("NextToken") :
+                return indexes
+            kwargs["NextToken"] = response["NextToken"]
+
+    def _wait_for_partition_indexes(self, table_name, index_names, deleted = False, timeout = 600, poll_interval = 5) :
+        """
+        Wait until the named partition indexes of the table are ACTIVE (or have been removed if deleted is True)
+        """
+        start = time.time()
+        while True :
+            indexes = self._get_partition_indexes(table_name)
+            if deleted :
+                pending = [i for i in index_names if i in indexes]
+            else :
+                failed = [i for i in index_names if indexes.get(i, {}).get("IndexStatus") == "FAILED"]
+                if failed :
+                    errors = [e.get("ErrorDetail", {}).get("ErrorMessage", "Unknown") for i in failed for e in indexes[i].get("BackfillErrors", [])]
+                    raise RuntimeError("Partition index(es) {} of {} failed: {}".format(", ".join(failed), table_name, "; ".join(errors) or "Unknown"))
+                pending = [i for i in index_names if indexes.get(i, {}).get("IndexStatus") != "ACTIVE"]
+            if not pending :
+                return
+            if time.time() - start > timeout :
+                raise TimeoutError("Timed out waiting for partition index(es) {} of {}".format(", ".join(pending), table_name))
+            time.sleep(poll_interval)
+
+    def update_partition_indexes(self, table_names = None, wait = True, timeout = 600, poll_interval = 5) :
+        """
+        Make the glue partition indexes of the tables (defaults to all tables) match their partition_indexes.
+        Indexes that are not declared (or whose columns have changed) are deleted and missing indexes are created.
+        If wait is True this waits for the new indexes to become ACTIVE (raising if any fail or it takes longer than timeout seconds).
+        Returns a dict of table name to the names of the indexes created.
+        """
+        table_names = self.table_names if table_names is None else table_names
+        created = {}
+        for t in table_names :
+            declared = self.table(t).partition_indexes
+            existing = self._get_partition_indexes(t)
+
+            stale = [i for i, index in existing.items() if [k["Name"] for k in index["Keys"]] != declared.get(i)]
+            for i in stale :
+                _glue_client.delete_partition_index(DatabaseName = self.name, TableName = t, IndexName = i)
+            # An index can't be recreated with the same name until the old one has gone
+            if stale :
+                self._wait_for_partition_indexes(t, stale, deleted = True, timeout = timeout, poll_interval = poll_interval)
+
+            created[t] = [i for i in declared if i not in existing or i in stale]
+            for i in created[t] :
+                _glue_client.create_partition_index(DatabaseName = self.name, TableName = t, PartitionIndex = {"Keys" : declared[i], "IndexName" : i})
+
+        if wait :
+            for t, index_names in created.items() :
+                if index_names :
+                    self._wait_for_partition_indexes(t, index_names, timeout = timeout, poll_interval = poll_interval)
+        return created
+
+    def _column_types(self, table_names = None) :
+        """
+        Returns a dict of column name to agnostic type for the columns of the given tables (defaults to all tables).
+        Columns that share a name but not a type across tables are left out.
+        """
+        table_names = self.table_names if table_names is None else table_names
+        column_types = {}
+        ambiguous = set()
+        for t in table_names :
+            for c in self.table(t).columns :
+                if column_types.get(c['name'], c['type']) != c['type'] :
+                    ambiguous.add(c['name'])
+                column_types[c['name']] = c['type']
+        return {k : v for k, v in column_types.items() if k not in ambiguous}
+
+    def _query_fingerprints(self, sql, other_databases = []) :
+        """
+        Returns a fingerprint of the s3 data of each table (of this database or other_databases) that sql references,
+        or None if sql reads a table (database.table after from or join) of any other database, as changes to it could not be seen.
+        """
+        normalised_sql = _normalise_sql(sql)
+        databases = [self] + list(other_databases)
+        if not _sql_database_names(normalised_sql) <= set(db.name.lower() for db in databases) :
+            return None
+
+        fingerprints = {}
+        for db in databases :
+            for t in db._tables :
+                if _sql_references_table(normalised_sql, db.name, t.name) :
+                    bucket, prefix = _split_s3_path(_end_with_slash(t._s3_table_path(db.s3_database_path)))
+                    fingerprints["{}.{}".format(db.name, t.name)] = _s3_prefix_fingerprint(bucket, prefix)
+        return fingerprints
+
+    def query(self, sql, batch_size = 10000, convert_types = False, table_names = None, cache = None, backend = None, other_databases = []) :
+        """
+        Run an Athena query against the database and return a generator of record batches (lists of dicts) of at most batch_size rows.
+        Results are fetched one batch at a time (using the database s3_athena_temp_folder) so memory use stays flat however many rows are returned.
+        If convert_types is True values of result columns that match a column in the database tables (or only the tables listed in table_names)
+        are converted to the python type of that column's meta data type.
+        If cache (an etl_manager.athena.QueryCache object) is given, results are read from the cache when the same query has already been run
+        against unchanged data, otherwise they are written to it as they are fetched. Queries that join tables of other databases are only
+        cached if those databases are given as other_databases (DatabaseMeta objects) so that their tables' data is fingerprinted too.
+        backend is the Athena backend to run the query with (see etl_manager.athena.set_default_backend).
+        """
+        fingerprints = self._query_fingerprints(sql, other_databases) if cache is not None else None
+        if fingerprints is None :
+            return self._query(sql, batch_size, convert_types, table_names, backend)
+
+        key = cache.key(sql, fingerprints, database = self.name, batch_size = batch_size, convert_types = convert_types, table_names = table_names)
+        cached = cache.get(key)
+        if cached is not None :
+            return cached
+        return cache.put(key, self._query(sql, batch_size, convert_types, table_names, backend))
+
+    def _query(self, sql, batch_size, convert_types, table_names, backend = None) :
+        column_types = self._column_types(table_names) if convert_types else {}
+
+        conn = _athena_connect(backend, s3_staging_dir = self.s3_athena_temp_folder, region_name = 'eu-west-1', schema_name = self.name)
+        try :
+            with conn.cursor() as cursor :
+                cursor.execute(sql)
+                names = [d[0] for d in cursor.description]
+                types = [column_types.get(n) for n in names]
+                while True :
+                    rows = cursor.fetchmany(batch_size)
+                    if not rows :
+                        break
+                    yield [{n : (_convert_value(t, v) if t else v) for n, t, v in zip(names, types, row)} for row in rows]
+        finally :
+            conn.close()
 
     def to_dict(self) :
         db_dict = {
@@ -474,50 +1275,76 @@ class DatabaseMeta :
         }
         return db_dict
 
-    def write_to_json(self, folder_path, write_tables = True) :
+    def write_to_json(self, folder_path, write_tables = True, max_workers = 10) :
         """
         Writes the database object back into the agnostic meta data json files.
         Function writes a file called database.json to the folder_path provided.
         If write_tables is True (default) this method will also write all table objects as an agnostic meta data json.
         The table meta data json will be saved as <table_name>.json where table_name == table.name.
+        Only tables that have been modified since they were read from (or last written to) that file are written. They are written
+        in parallel over max_workers threads, each via a temporary file that is renamed into place, and files whose contents would not change are left alone.
         """
 
         write_json(self.to_dict(), os.path.join(folder_path, 'database.json'))
 
         if write_tables :
+            to_write = []
             for t in self._tables :
-                t.write_to_json(os.path.join(folder_path, t.name + '.json'))
+                table_path = os.path.join(folder_path, t.name + '.json')
+                if t.is_dirty or t._json_path != os.path.abspath(table_path) or not os.path.exists(table_path) :
+                    to_write.append((t, table_path))
 
-    def refresh_all_table_partitions(self):
+            with ThreadPoolExecutor(max_workers = max_workers) as executor :
+                list(executor.map(lambda x : x[0].write_to_json(x[1]), to_write))
+
+    def refresh_all_table_partitions(self, backend = None):
         for table in self._tables:
-                table.refresh_paritions()
+                table.refresh_paritions(backend = backend)
 
 # Create meta objects from json files or directories
 def read_table_json(filepath, database = None) :
-    meta = read_json(filepath)
+    tab = _table_meta_from_dict(read_json(filepath), database)
+    tab._mark_clean(filepath)
+
+    return tab
+
+def _table_meta_from_dict(meta, database = None) :
     if 'partitions' not in meta :
         meta['partitions'] = []
 
     if "glue_specific" not in meta:
         meta['glue_specific'] = {}
 
-    tab = TableMeta(name = meta['name'],
+    return TableMeta(name = meta['name'],
         location=meta['location'],
         columns=meta['columns'],
         data_format=meta['data_format'],
         description=meta['description'],
         partitions=meta['partitions'],
         glue_specific=meta['glue_specific'],
-        database=database)
-    
-    return tab
+        database=database,
+        bucket_columns=meta.get('bucket_columns', []),
+        number_of_buckets=meta.get('number_of_buckets'),
+        sort_columns=meta.get('sort_columns', []),
+        partition_projection=meta.get('partition_projection', {}),
+        partition_indexes=meta.get('partition_indexes', {}),
+        compression=meta.get('compression'))
 
 def read_database_json(filepath) :
     db_meta = read_json(filepath)
     db = DatabaseMeta(name=db_meta['name'], bucket=db_meta['bucket'], base_folder=db_meta['base_folder'], description=db_meta['description'])
     return db
 
-def read_database_folder(folderpath) :
+def read_database_folder(folderpath, max_workers = 10, cache_dir = None) :
+    """
+    Create a database meta object from a folder holding a database.json file and a json file for each table.
+    folderpath can be a local folder or an s3 folder (s3://bucket/prefix/, e.g. the --metadata_base_path of a glue job plus the database folder).
+    An s3 folder is listed once and its json files are fetched in parallel over max_workers threads. If cache_dir is given they are
+    also cached there against their ETags, so files that have not changed since the last read are not downloaded again.
+    """
+    if folderpath.startswith('s3://') :
+        return _read_s3_database_folder(folderpath, max_workers, cache_dir)
+
     # Always assigned to database through keyword argument
     db = read_database_json(os.path.join(folderpath, 'database.json'))
 
@@ -529,3 +1356,225 @@ def read_database_folder(folderpath) :
         tm = read_table_json(table_file_path, database=db)
         db.add_table(tm)
     return db
+
+def _read_s3_database_folder(folderpath, max_workers = 10, cache_dir = None) :
+    bucket, prefix = _split_s3_path(_end_with_slash(folderpath))
+    objects = [o for o in _list_s3_objects(bucket, prefix) if re.match(r"[^/]+\.json$", o['Key'][len(prefix):])]
+    if prefix + 'database.json' not in [o['Key'] for o in objects] :
+        raise ValueError("Could not find database.json in {}".format(folderpath))
+
+    with ThreadPoolExecutor(max_workers = max_workers) as executor :
+        metas = dict(zip([o['Key'] for o in objects], executor.map(lambda o : _read_s3_json(bucket, o['Key'], o['ETag'], cache_dir), objects)))
+
+    db_meta = metas.pop(prefix + 'database.json')
+    db = DatabaseMeta(name=db_meta['name'], bucket=db_meta['bucket'], base_folder=db_meta['base_folder'], description=db_meta['description'])
+    for key in sorted(metas) :
+        db.add_table(_table_meta_from_dict(metas[key], database=db))
+    return db
+
+def _glue_specific_parameters(glue_specific) :
+    """
+    Returns the table, storage descriptor and serde parameter dicts of glue_specific (that exist)
+    """
+    sd = glue_specific.get('StorageDescriptor', {})
+    return [p for p in [glue_specific.get('Parameters'), sd.get('Parameters'), sd.get('SerdeInfo', {}).get('Parameters')] if p is not None]
+
+def _glue_columns_to_agnostic(table_name, glue_columns) :
+    columns = []
+    for c in glue_columns :
+        # Drop the length of char and varchar types
+        glue_type = re.sub(r"\(\d+\)$", "", c['Type'].lower())
+        if glue_type not in _glue_to_agnostic_type :
+            raise ValueError("Column {} of glue table {} has a type ({}) that has no agnostic meta data type".format(c['Name'], table_name, c['Type']))
+        columns.append({"name" : c['Name'], "type" : _glue_to_agnostic_type[glue_type], "description" : c.get('Comment', '')})
+    return columns
+
+def _glue_projection_to_agnostic(partitions, parameters) :
+    if parameters.get("projection.enabled") != "true" :
+        return {}
+
+    projection = {}
+    for p in partitions :
+        settings = {}
+        prefix = "projection.{}.".format(p)
+        for k, v in parameters.items() :
+            if k.startswith(prefix) :
+                settings[k[len(prefix):].replace(".", "_")] = v
+        if settings.get("type") == "integer" :
+            settings["range"] = [int(x) for x in settings["range"].split(",")]
+        elif "range" in settings :
+            settings["range"] = settings["range"].split(",")
+        if "values" in settings :
+            settings["values"] = settings["values"].split(",")
+        for k in ["interval", "digits"] :
+            if k in settings :
+                settings[k] = int(settings[k])
+        projection[p] = settings
+    return projection
+
+def _glue_table_to_meta_dict(glue_table, base_folder_path) :
+    """
+    Convert a glue table (from get_tables) to an agnostic meta data dict. base_folder_path is the s3 path of the database the table belongs to.
+    """
+    name = glue_table['Name']
+    if glue_table.get('TableType') == 'VIRTUAL_VIEW' :
+        raise ValueError("Glue table {} is a view".format(name))
+    sd = glue_table.get('StorageDescriptor', {})
+    parameters = glue_table.get('Parameters', {})
+
+    data_format = _serde_to_data_format.get(sd.get('SerdeInfo', {}).get('SerializationLibrary'))
+    if data_format is None :
+        raise ValueError("Could not work out the data_format of glue table {} from its serde ({})".format(name, sd.get('SerdeInfo', {}).get('SerializationLibrary')))
+
+    if not sd.get('Location') :
+        raise ValueError("Glue table {} has no location".format(name))
+    location = _end_with_slash(sd['Location'])
+    if not location.startswith(_end_with_slash(base_folder_path)) :
+        raise ValueError("The location of glue table {} ({}) is not in the database folder ({})".format(name, location, base_folder_path))
+
+    partition_columns = _glue_columns_to_agnostic(name, glue_table.get('PartitionKeys', []))
+    meta = {
+        "name" : name,
+        "description" : glue_table.get('Description', ''),
+        "data_format" : data_format,
+        "location" : location[len(_end_with_slash(base_folder_path)):],
+        "columns" : _glue_columns_to_agnostic(name, sd['Columns']) + partition_columns,
+        "partitions" : [c['name'] for c in partition_columns],
+    }
+
+    if sd.get('NumberOfBuckets', -1) > 0 and sd.get('BucketColumns') :
+        meta['bucket_columns'] = sd['BucketColumns']
+        meta['number_of_buckets'] = sd['NumberOfBuckets']
+    if sd.get('SortColumns') :
+        meta['sort_columns'] = [{"name" : sc['Column'], "order" : "asc" if sc['SortOrder'] == 1 else "desc"} for sc in sd['SortColumns']]
+
+    projection = _glue_projection_to_agnostic(meta['partitions'], parameters)
+    if projection :
+        meta['partition_projection'] = projection
+
+    compression = parameters.get('compressionType', sd.get('Parameters', {}).get('compressionType'))
+    if compression and compression != 'none' and compression in _compression_specs[_data_format_compression_family[data_format]]['codecs'] :
+        meta['compression'] = compression
+
+    return meta
+
+def _get_glue_tables(database_name) :
+    tables = []
+    kwargs = {}
+    while True :
+        response = _glue_client.get_tables(DatabaseName = database_name, **kwargs)
+        tables.extend(response['TableList'])
+        if not response.get('NextToken') :
+            return tables
+        kwargs['NextToken'] = response['NextToken']
+
+def read_glue_database(name, bucket = None, base_folder = None, cache_path = None, max_age = 300, refresh = False) :
+    """
+    Create a database meta object (and its table meta objects) from a database in the glue catalog.
+    The tables are read with paginated get_tables calls and their glue types, serde, location, partitions, bucketing, sort columns,
+    partition projection and compression are mapped back to agnostic meta data.
+    bucket and base_folder default to the bucket and deepest folder shared by the table locations.
+    Tables that can not be described by agnostic meta data (views, tables with column types such as decimal, array or struct, unknown serdes
+    or locations outside the database folder) are left out of the database with a warning giving the reason for each.
+
+    If cache_path is given the catalog snapshot is saved to that json file and reused (without calling glue) while it is younger than max_age seconds.
+    Once it is older (or refresh is True) the tables are listed again and only tables whose glue UpdateTime has changed are converted again.
+    """
+    snapshot = read_json(cache_path) if cache_path and os.path.exists(cache_path) else None
+    if snapshot and (snapshot.get('name') != name or bucket not in [None, snapshot['bucket']] or base_folder not in [None, snapshot['base_folder']]) :
+        snapshot = None
+
+    if snapshot is None or refresh or time.time() - snapshot['created'] > max_age :
+        glue_database = _glue_client.get_database(Name = name)['Database']
+        glue_tables = _get_glue_tables(name)
+
+        if bucket is None or base_folder is None :
+            locations = [t.get('StorageDescriptor', {}).get('Location', '') for t in glue_tables]
+            paths = [_split_s3_path(_remove_final_slash(l)) for l in locations if l.startswith('s3://')]
+            buckets = set(b for b, k in paths)
+            if len(buckets) > 1 :
+                raise ValueError("Tables of glue database {} are in more than one bucket ({}), please provide the bucket and base_folder".format(name, ", ".join(sorted(buckets))))
+            bucket = bucket or (buckets.pop() if buckets else None)
+            if base_folder is None :
+                base_folder = os.path.commonpath([os.path.dirname(k) for b, k in paths]) if paths else ''
+        if bucket is None :
+            raise ValueError("Could not work out the bucket of glue database {} as it has no tables, please provide it".format(name))
+
+        previous = {t['name'] : t for t in snapshot['tables']} if snapshot and snapshot['bucket'] == bucket and snapshot['base_folder'] == base_folder else {}
+        base_folder_path = os.path.join('s3://', bucket, base_folder)
+        tables = []
+        for t in glue_tables :
+            update_time = str(t.get('UpdateTime', t.get('CreateTime')))
+            if t['Name'] in previous and previous[t['Name']]['update_time'] == update_time :
+                tables.append(previous[t['Name']])
+            else :
+                try :
+                    meta = _glue_table_to_meta_dict(t, base_folder_path)
+                    # Glue allows names and settings that agnostic meta data does not, so check the table can be created
+                    _table_meta_from_dict(deepcopy(meta))
+                    tables.append({"name" : t['Name'], "update_time" : update_time, "meta" : meta})
+                except (ValueError, jsonschema.ValidationError) as e :
+                    tables.append({"name" : t['Name'], "update_time" : update_time, "meta" : None, "error" : str(e).split('\n')[0]})
+
+        snapshot = {
+            "name" : name,
+            "description" : glue_database.get('Description', ''),
+            "bucket" : bucket,
+            "base_folder" : base_folder,
+            "created" : time.time(),
+            "tables" : tables,
+        }
+        if cache_path :
+            write_json(snapshot, cache_path)
+
+    db = DatabaseMeta(name = snapshot['name'], bucket = snapshot['bucket'], base_folder = snapshot['base_folder'], description = snapshot['description'])
+    skipped = []
+    for t in snapshot['tables'] :
+        if t['meta'] is None :
+            skipped.append(t['error'])
+        else :
+            db.add_table(_table_meta_from_dict(deepcopy(t['meta']), database = db))
+    if skipped :
+        warnings.warn("Skipped {} table(s) of glue database {}:\n{}".format(len(skipped), name, "\n".join(skipped)))
+    return db
+
+def infer_table_meta(name, data_path, location = None, data_format = None, description = '', header = True, delimiter = ',', chunk_size = _default_chunk_size, max_workers = None, database = None) :
+    """
+    Create a table meta object by inferring the column types from the csv or jsonl data file(s) at data_path.
+    data_path can be a single file or a folder. Folders are walked recursively and any key=value folder names are added as partitions.
+    Files are streamed in chunks of chunk_size rows and processed in parallel over max_workers processes.
+    If location is not given it defaults to the name of the data_path folder.
+    data_format defaults to json or, depending on the file extensions found, csv (csv_quoted_nodate if any value needed quoting, as the csv serde does not understand quotes).
+    csv tables are given the glue_specific settings to skip the header line (if header is True) and to use delimiter.
+    """
+    file_format = {'csv': 'csv', 'csv_quoted_nodate': 'csv', 'json': 'json'}.get(data_format)
+    columns, partitions, quoted = _infer_columns(data_path, file_format, header, delimiter, chunk_size, max_workers)
+
+    if location is None :
+        folder = data_path if os.path.isdir(data_path) else os.path.dirname(data_path)
+        location = _end_with_slash(os.path.basename(os.path.normpath(folder)))
+
+    if data_format is None :
+        extensions = set(os.path.splitext(f[:-3] if f.endswith('.gz') else f)[1].lower() for f in _list_data_files(data_path))
+        data_format = 'json' if extensions and extensions <= {'.json', '.jsonl'} else ('csv_quoted_nodate' if quoted else 'csv')
+    elif data_format == 'csv' and quoted :
+        warnings.warn("Some values in {} are quoted (or contain the delimiter) which the csv data_format can not read. Use csv_quoted_nodate instead".format(data_path))
+
+    glue_specific = {}
+    if data_format in ['csv', 'csv_quoted_nodate'] :
+        if header :
+            glue_specific['Parameters'] = {'skip.header.line.count' : '1'}
+        if delimiter != ',' :
+            delimiter_key = 'field.delim' if data_format == 'csv' else 'separatorChar'
+            glue_specific['StorageDescriptor'] = {'SerdeInfo' : {'Parameters' : {delimiter_key : delimiter}}}
+
+    tab = TableMeta(name = name,
+        location = location,
+        columns = columns,
+        data_format = data_format,
+        description = description,
+        partitions = partitions,
+        glue_specific = glue_specific,
+        database = database)
+
+    return tab
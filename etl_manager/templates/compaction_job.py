@@ -0,0 +1,62 @@
+# Compaction job generated by etl_manager.etl.create_compaction_job
+# Rewrites each partition listed in compaction.json into number_of_files files under a new (underscore prefixed, so hidden from
+# Hive / Athena listings) folder, then points the partition in the glue catalog at the new folder.
+import json
+import os
+import sys
+
+import boto3
+from awsglue.context import GlueContext
+from awsglue.utils import getResolvedOptions
+from pyspark.context import SparkContext
+
+from glue_spark_runtime import read_files
+
+args = getResolvedOptions(sys.argv, ["JOB_NAME", "JOB_RUN_ID"])
+
+with open(os.path.join(os.getcwd(), "compaction.json")) as f:
+    config = json.load(f)
+
+sc = SparkContext()
+glue_context = GlueContext(sc)
+spark = glue_context.spark_session
+glue = boto3.client("glue", config["region"])
+s3 = boto3.client("s3")
+
+table = config["table"]
+output_base = f"{config['schemas'][table]['path']}_compacted_/{args['JOB_RUN_ID']}/"
+
+
+def delete_prefix(path):
+    bucket, prefix = path.rstrip("/")[len("s3://"):].split("/", 1)
+    prefix += "/"
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        keys = [{"Key": o["Key"]} for o in page.get("Contents", [])]
+        if keys:
+            s3.delete_objects(Bucket=bucket, Delete={"Objects": keys})
+
+
+for p in config["partitions"]:
+    # Read from the partition's current location, which is not the default one if it has been compacted before
+    current = glue.get_partition(DatabaseName=config["database"], TableName=config["table_name"], PartitionValues=p["values"])["Partition"]
+    storage_descriptor = current["StorageDescriptor"]
+    old_location = storage_descriptor["Location"]
+    output_path = output_base + p["partition"]
+
+    df = read_files(spark, table, old_location, schemas=config["schemas"])
+    (
+        df.repartition(p["number_of_files"])
+        .write.format(config["writer"]["format"])
+        .options(**config["writer"]["options"])
+        .mode("errorifexists")
+        .save(output_path)
+    )
+
+    # The swap: the catalog is only pointed at the new files once they have all been written
+    storage_descriptor["Location"] = output_path
+    partition_input = {"Values": p["values"], "StorageDescriptor": storage_descriptor, "Parameters": current.get("Parameters", {})}
+    glue.update_partition(DatabaseName=config["database"], TableName=config["table_name"], PartitionValueList=p["values"], PartitionInput=partition_input)
+
+    if config["delete_old_files"]:
+        delete_prefix(old_location)
@@ -1,14 +1,18 @@
 import collections
+import functools
+import hashlib
 import json
 import boto3
+from botocore.exceptions import ClientError
 import tempfile
 import zipfile
-import shutil
 import string
 import os
 import subprocess
+import uuid
 
 _glue_client = boto3.client('glue', 'eu-west-1')
+_athena_client = boto3.client('athena', 'eu-west-1')
 _s3_client = boto3.client('s3')
 _s3_resource = boto3.resource('s3')
 
@@ -44,8 +48,31 @@ def read_json(filename) :
 
 # Write json file
 def write_json(data, filename) :
-    with open(filename, 'w+') as outfile:
-        json.dump(data, outfile, indent=4, separators=(',', ': '))
+    """
+    Writes data to filename as json. The file is written to a temporary file first and then renamed so a crash
+    never leaves a half written file. Files that already contain exactly the same json are not rewritten.
+    Returns True if the file was written.
+    """
+    text = json.dumps(data, indent=4, separators=(',', ': '))
+
+    if os.path.exists(filename) :
+        with open(filename) as existing :
+            if existing.read() == text :
+                return False
+
+    # Created like open() would create the file (0666 less the umask) rather than with mkstemp's 0600
+    tmp_filename = '{}.{}.tmp'.format(os.path.abspath(filename), uuid.uuid4().hex)
+    fd = os.open(tmp_filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    try :
+        with os.fdopen(fd, 'w') as outfile :
+            outfile.write(text)
+        if os.path.exists(filename) :
+            os.chmod(tmp_filename, os.stat(filename).st_mode & 0o7777)
+        os.replace(tmp_filename, filename)
+    except :
+        os.remove(tmp_filename)
+        raise
+    return True
 
 def _end_with_slash(string) :
     if string[-1] != '/' :
@@ -59,18 +86,127 @@ def _remove_final_slash(string) :
     else:
         return string
 
+@functools.lru_cache(maxsize=None)
+def _invalid_chars(allowed_chars) :
+    return frozenset(string.punctuation) - frozenset(allowed_chars)
+
 # Used by both classes (Should move into another module)
 def _validate_string(s, allowed_chars = "_") :
     if s != s.lower() :
         raise ValueError("string provided must be lowercase")
 
-    invalid_chars = string.punctuation
+    if not _invalid_chars(allowed_chars).isdisjoint(s) :
+        raise ValueError("punctuation excluding ({}) is not allowed in string".format(allowed_chars))
 
-    for a in allowed_chars :
-        invalid_chars = invalid_chars.replace(a, "")
+def _split_s3_path(s3_path) :
+    """
+    Split an s3 path (s3://bucket/key) into a bucket and a key
+    """
+    if not s3_path.startswith('s3://') :
+        raise ValueError("s3 path must start with s3:// ({})".format(s3_path))
+    bucket, _, key = s3_path[5:].partition('/')
+    return bucket, key
 
-    if any(char in invalid_chars for char in s) :
-        raise ValueError("punctuation excluding ({}) is not allowed in string".format(allowed_chars))
+def _list_s3_common_prefixes(bucket, prefix) :
+    """
+    List the 'folders' directly below prefix (i.e. a delimiter listing rather than a full recursive one)
+    """
+    paginator = _s3_client.get_paginator('list_objects_v2')
+    common_prefixes = []
+    for page in paginator.paginate(Bucket = bucket, Prefix = prefix, Delimiter = '/') :
+        common_prefixes.extend(cp['Prefix'] for cp in page.get('CommonPrefixes', []))
+    return common_prefixes
+
+def _s3_prefix_exists(bucket, prefix) :
+    response = _s3_client.list_objects_v2(Bucket = bucket, Prefix = prefix, MaxKeys = 1)
+    return response.get('KeyCount', len(response.get('Contents', []))) > 0
+
+def _s3_prefix_fingerprint(bucket, prefix) :
+    """
+    Returns the object count, total size and latest modified time of the objects under prefix.
+    Used to tell whether the data under prefix has changed.
+    """
+    paginator = _s3_client.get_paginator('list_objects_v2')
+    fingerprint = {'object_count' : 0, 'total_size' : 0, 'last_modified' : None}
+    for page in paginator.paginate(Bucket = bucket, Prefix = prefix) :
+        for obj in page.get('Contents', []) :
+            fingerprint['object_count'] += 1
+            fingerprint['total_size'] += obj['Size']
+            last_modified = str(obj['LastModified'])
+            if fingerprint['last_modified'] is None or last_modified > fingerprint['last_modified'] :
+                fingerprint['last_modified'] = last_modified
+    return fingerprint
+
+def _list_s3_objects(bucket, prefix) :
+    """
+    List every object (key, size and etag) under prefix
+    """
+    paginator = _s3_client.get_paginator('list_objects_v2')
+    objects = []
+    for page in paginator.paginate(Bucket = bucket, Prefix = prefix) :
+        objects.extend({'Key' : o['Key'], 'Size' : o['Size'], 'ETag' : o['ETag']} for o in page.get('Contents', []))
+    return objects
+
+def _read_s3_object_chunks(bucket, key, chunk_size = 1024**2) :
+    body = _s3_client.get_object(Bucket = bucket, Key = key)['Body']
+    try :
+        for chunk in iter(lambda : body.read(chunk_size), b'') :
+            yield chunk
+    finally :
+        body.close()
+
+def _read_s3_object_range(bucket, key, byte_range) :
+    return _s3_client.get_object(Bucket = bucket, Key = key, Range = 'bytes={}'.format(byte_range))['Body'].read()
+
+def _read_s3_json(bucket, key, etag = None, cache_dir = None) :
+    """
+    Read a json object from s3. If cache_dir is given the object is cached there against its ETag. It is not fetched at all
+    when etag (e.g. from a listing) matches the cached copy, otherwise it is fetched with a conditional GET (IfNoneMatch).
+    """
+    cache_path = os.path.join(cache_dir, hashlib.sha256('{}/{}'.format(bucket, key).encode('utf-8')).hexdigest() + '.json') if cache_dir else None
+    cached = read_json(cache_path) if cache_path and os.path.exists(cache_path) else None
+    if cached and cached['etag'] == etag :
+        return cached['data']
+
+    kwargs = {'IfNoneMatch' : cached['etag']} if cached else {}
+    try :
+        response = _s3_client.get_object(Bucket = bucket, Key = key, **kwargs)
+    except ClientError as e :
+        if cached and e.response.get('Error', {}).get('Code') in ['304', 'NotModified'] :
+            return cached['data']
+        raise
+
+    data = json.loads(response['Body'].read().decode('utf-8'))
+    if cache_path :
+        os.makedirs(cache_dir, exist_ok = True)
+        write_json({'etag' : response['ETag'], 'data' : data}, cache_path)
+    return data
+
+def _file_sha256(file_path, chunk_size = 1024**2) :
+    sha = hashlib.sha256()
+    with open(file_path, 'rb') as f :
+        for chunk in iter(lambda: f.read(chunk_size), b'') :
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def _make_deterministic_zip(base_name, root_dir) :
+    """
+    Same as shutil.make_archive(base_name, 'zip', root_dir) but the zip only depends on the file names and contents
+    (entries are sorted and timestamps and permissions are fixed) so the same files always give the same sha256
+    """
+    zip_path = base_name + '.zip'
+    paths = []
+    for folder, dirs, files in os.walk(root_dir) :
+        paths.extend(os.path.join(folder, f) for f in files)
+
+    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zf :
+        for path in sorted(paths, key = lambda p: os.path.relpath(p, root_dir).replace(os.sep, '/')) :
+            info = zipfile.ZipInfo(os.path.relpath(path, root_dir).replace(os.sep, '/'), date_time = (1980, 1, 1, 0, 0, 0))
+            info.external_attr = 0o644 << 16
+            info.compress_type = zipfile.ZIP_DEFLATED
+            with open(path, 'rb') as f :
+                zf.writestr(info, f.read())
+    return zip_path
 
 def _get_file_from_file_path(file_path) :
     return file_path.split('/')[-1]
@@ -100,6 +236,6 @@ def _unnest_github_zipfile_and_return_new_zip_path(zip_path):
         nested_folder_to_unnest = os.listdir(td)[0]
         nested_path = os.path.join(td, nested_folder_to_unnest)
         output_path = os.path.join(original_dir, new_file_name)
-        final_output_path = shutil.make_archive(output_path, 'zip', nested_path)
+        final_output_path = _make_deterministic_zip(output_path, nested_path)
 
     return final_output_path
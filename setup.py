@@ -12,6 +12,9 @@ setup(
         "PyAthenaJDBC >= 1.3.0",
         "jsonschema >= 2.6.0"
     ],
+    extras_require={
+        "parquet": ["pyarrow >= 0.17.0"]
+    },
     include_package_data=True,
     url='https://github.com/moj-analytical-services/etl_manager',
     author='Karik Isichei',
@@ -5,13 +5,125 @@ Testing DatabaseMeta, TableMeta
 """
 
 import unittest
-from etl_manager.meta import DatabaseMeta, TableMeta, read_database_folder, read_table_json, _agnostic_to_glue_spark_dict
-from etl_manager.utils import _end_with_slash, _validate_string, _glue_client, read_json, _remove_final_slash
-from etl_manager.etl import GlueJob
+from etl_manager.meta import DatabaseMeta, TableMeta, read_database_folder, read_table_json, read_glue_database, infer_table_meta, _agnostic_to_glue_spark_dict
+from etl_manager.data import infer_column_types
+from etl_manager.athena import QueryCache, FakeAthenaBackend, AthenaApiConnection, AthenaQueryError, set_default_backend, _normalise_sql
+from etl_manager.utils import _end_with_slash, _validate_string, _glue_client, read_json, write_json, _remove_final_slash, _file_sha256, _make_deterministic_zip, _read_s3_json
+from etl_manager.glue_spark_runtime import read_table
+from etl_manager.etl import GlueJob, SizingPolicy, JobRunHistory, JobFailed, create_compaction_job
+import asyncio
+import bz2
+import gzip
 import boto3
+from botocore.exceptions import ClientError
+import datetime
+import etl_manager.meta
+import io
 import tempfile
 import os
+import warnings
 import urllib, json
+from unittest import mock
+
+try :
+    import pyarrow.parquet as pq
+except ImportError :
+    pq = None
+try :
+    from pyspark.sql.types import StructType
+except ImportError :
+    StructType = None
+
+class FakeS3Client :
+    """
+    Minimal in memory stand in for the parts of the boto3 s3 client used by etl_manager
+    """
+    def __init__(self, keys) :
+        self.objects = {k : b'' for k in keys} if isinstance(keys, list) else dict(keys)
+        self.calls = []
+
+    def _list(self, Bucket, Prefix = '', Delimiter = None, **kwargs) :
+        self.calls.append(('list_objects_v2', Prefix, Delimiter))
+        contents = []
+        common_prefixes = set()
+        for k in sorted(self.objects) :
+            if not k.startswith(Prefix) :
+                continue
+            rest = k[len(Prefix):]
+            if Delimiter and Delimiter in rest :
+                common_prefixes.add(Prefix + rest.split(Delimiter)[0] + Delimiter)
+            else :
+                contents.append({'Key' : k, 'Size' : len(self.objects[k]), 'ETag' : '"{}"'.format(hash(self.objects[k])), 'LastModified' : 0})
+        page = {'Contents' : contents, 'KeyCount' : len(contents) + len(common_prefixes)}
+        if common_prefixes :
+            page['CommonPrefixes'] = [{'Prefix' : cp} for cp in sorted(common_prefixes)]
+        return page
+
+    def list_objects_v2(self, Bucket, Prefix = '', MaxKeys = 1000, **kwargs) :
+        page = self._list(Bucket, Prefix, kwargs.get('Delimiter'))
+        page['Contents'] = page['Contents'][:MaxKeys]
+        page['KeyCount'] = len(page['Contents'])
+        return page
+
+    def get_object(self, Bucket, Key, Range = None, IfNoneMatch = None) :
+        self.calls.append(('get_object', Key, Range))
+        data = self.objects[Key]
+        etag = '"{}"'.format(hash(data))
+        if IfNoneMatch == etag :
+            raise ClientError({'Error' : {'Code' : '304', 'Message' : 'Not Modified'}}, 'GetObject')
+        if Range :
+            start, end = Range[len('bytes='):].split('-')
+            data = data[-int(end):] if start == '' else data[int(start):(int(end) + 1 if end else None)]
+        return {'Body' : io.BytesIO(data), 'ETag' : etag}
+
+    def upload_file(self, Filename, Bucket, Key) :
+        self.calls.append(('upload_file', Key))
+        with open(Filename, 'rb') as f :
+            self.objects[Key] = f.read()
+
+    def get_paginator(self, name) :
+        fake = self
+        class Paginator :
+            def paginate(self, **kwargs) :
+                return [fake._list(**kwargs)]
+        return Paginator()
+
+
+class FakeAthenaConnection :
+    """
+    Stand in for a pyathenajdbc connection that returns rows from a list
+    """
+    def __init__(self, description, rows) :
+        self.description = description
+        self.rows = list(rows)
+        self.executed = []
+        self.fetch_sizes = []
+        self.closed = False
+
+    def __call__(self, **kwargs) :
+        self.connect_kwargs = kwargs
+        return self
+
+    def cursor(self) :
+        return self
+
+    def __enter__(self) :
+        return self
+
+    def __exit__(self, *args) :
+        pass
+
+    def execute(self, sql) :
+        self.executed.append(sql)
+
+    def fetchmany(self, size) :
+        self.fetch_sizes.append(size)
+        out, self.rows = self.rows[:size], self.rows[size:]
+        return out
+
+    def close(self) :
+        self.closed = True
+
 
 class UtilsTest(unittest.TestCase) :
     """
@@ -77,6 +189,267 @@ class GlueTest(unittest.TestCase) :
         g.job_arguments = {"--new_args" : "something"}
         self.assertEqual(g.job_arguments["--new_args"], "something")
 
+    def test_metadata_databases(self) :
+        with tempfile.TemporaryDirectory() as td :
+            for d, name in [("db_a", "alpha"), ("db_b", "beta"), ("db_c", "gamma")] :
+                os.makedirs(os.path.join(td, "meta_data", d))
+                write_json({"name": name}, os.path.join(td, "meta_data", d, "database.json"))
+                write_json({"name": "t"}, os.path.join(td, "meta_data", d, "t.json"))
+            job_folder = os.path.join(td, "glue_jobs", "job1")
+            os.makedirs(os.path.join(job_folder, "glue_resources"))
+            with open(os.path.join(job_folder, "job.py"), "w") as f :
+                f.write("df = spark.read.table('alpha_dev.t')\n")
+            with open(os.path.join(job_folder, "glue_resources", "query.sql"), "w") as f :
+                f.write("SELECT * FROM db_c.t JOIN alphabet.t")
+
+            g = GlueJob(job_folder, bucket = 'alpha-everyone', job_role = 'alpha_user_isichei')
+            self.assertIsNone(g.metadata_databases)
+            self.assertEqual(len(g.all_meta_data_paths), 6)
+
+            g.metadata_databases = "auto"
+            self.assertEqual(g.metadata_databases, ["db_a", "db_c"])
+            self.assertEqual(sorted(os.path.relpath(p, os.path.join(td, "meta_data")) for p in g.all_meta_data_paths),
+                ["db_a/database.json", "db_a/t.json", "db_c/database.json", "db_c/t.json"])
+
+            g = GlueJob(job_folder, bucket = 'alpha-everyone', job_role = 'alpha_user_isichei', metadata_databases = ["db_b"])
+            self.assertEqual(len(g.all_meta_data_paths), 2)
+            with self.assertRaises(ValueError) :
+                g.metadata_databases = ["db_d"]
+
+    def test_shared_artifacts(self) :
+        g = GlueJob('example/glue_jobs/simple_etl_job/', bucket = 'alpha-everyone', job_role = 'alpha_user_isichei')
+        g.shared_artifacts = True
+        zip_path = 'example/glue_jobs/shared_job_resources/glue_py_resources/my_dummy_utils.zip'
+        key = '_GlueArtifacts_/{}/my_dummy_utils.zip'.format(_file_sha256(zip_path))
+
+        fake_s3 = FakeS3Client([])
+        with mock.patch('etl_manager.etl._s3_client', fake_s3), mock.patch('etl_manager.utils._s3_client', fake_s3) :
+            self.assertTrue(g._upload_artifact(zip_path))
+            # A second job with the same library does not upload it again
+            g2 = GlueJob('example/glue_jobs/simple_etl_job/', bucket = 'alpha-everyone', job_role = 'alpha_user_isichei', job_name = 'other_job')
+            g2.shared_artifacts = True
+            self.assertFalse(g2._upload_artifact(zip_path))
+        self.assertEqual([c for c in fake_s3.calls if c[0] == 'upload_file'], [('upload_file', key)])
+
+        self.assertEqual(g._job_definition()['DefaultArguments']['--extra-py-files'], 's3://alpha-everyone/' + key)
+
+        # Zips of the same files made at different times have the same hash
+        with tempfile.TemporaryDirectory() as td :
+            os.makedirs(os.path.join(td, 'src', 'lib'))
+            with open(os.path.join(td, 'src', 'lib', '__init__.py'), 'w') as f :
+                f.write('x = 1')
+            first = _file_sha256(_make_deterministic_zip(os.path.join(td, 'a'), os.path.join(td, 'src')))
+            os.utime(os.path.join(td, 'src', 'lib', '__init__.py'), (0, 0))
+            second = _file_sha256(_make_deterministic_zip(os.path.join(td, 'b'), os.path.join(td, 'src')))
+            self.assertEqual(first, second)
+
+    def test_spark_schemas(self) :
+        g = GlueJob('example/glue_jobs/simple_etl_job/', bucket = 'alpha-everyone', job_role = 'alpha_user_isichei')
+        g.github_zip_urls = []
+        g.compile_spark_schemas = True
+
+        schemas = g.spark_schemas()
+        teams = schemas['workforce.teams']
+        self.assertEqual(teams['path'], 's3://my-bucket/database/database1/teams/')
+        self.assertEqual(teams['partitions'], ['snapshot_year', 'snapshot_month'])
+        self.assertEqual([f['name'] for f in teams['schema']['fields']][-2:], ['snapshot_year', 'snapshot_month'])
+        self.assertEqual(teams['schema']['fields'][0], {'name' : 'team_id', 'type' : 'integer', 'nullable' : True, 'metadata' : {'comment' : 'ID given to each team'}})
+
+        fake_s3 = FakeS3Client([])
+        with mock.patch('etl_manager.etl._s3_client', fake_s3), mock.patch('etl_manager.etl._s3_resource') :
+            g.sync_job_to_s3_folder()
+        uploaded = {k.split('/')[-1] : v for k, v in fake_s3.objects.items() if k.startswith(g.s3_job_folder_no_bucket)}
+        self.assertEqual(json.loads(uploaded['spark_schemas.json'].decode('utf-8')), schemas)
+        self.assertIn('glue_spark_runtime.py', uploaded)
+
+        args = g._job_definition()['DefaultArguments']
+        self.assertTrue(args['--extra-files'].endswith('/spark_schemas.json'))
+        self.assertTrue(args['--extra-py-files'].endswith('/glue_spark_runtime.py'))
+
+    @unittest.skipIf(StructType is None, "pyspark is not installed")
+    def test_glue_spark_runtime(self) :
+        g = GlueJob('example/glue_jobs/simple_etl_job/', bucket = 'alpha-everyone', job_role = 'alpha_user_isichei')
+        spark = mock.MagicMock()
+        reader = spark.read.format.return_value
+        read_table(spark, 'workforce.teams', schemas = g.spark_schemas())
+
+        spark.read.format.assert_called_with('parquet')
+        data_schema = reader.schema.call_args[0][0]
+        self.assertIsInstance(data_schema, StructType)
+        self.assertNotIn('snapshot_year', data_schema.names)
+        self.assertEqual(reader.schema.return_value.options.call_args[1]['basePath'], 's3://my-bucket/database/database1/teams/')
+
+    def test_run_local(self) :
+        with tempfile.TemporaryDirectory() as td :
+            os.makedirs(os.path.join(td, "meta_data", "db_a"))
+            write_json({"name" : "alpha"}, os.path.join(td, "meta_data", "db_a", "database.json"))
+            job_folder = os.path.join(td, "glue_jobs", "job1")
+            os.makedirs(os.path.join(job_folder, "glue_resources"))
+            os.makedirs(os.path.join(job_folder, "glue_py_resources"))
+            with open(os.path.join(job_folder, "glue_resources", "lookup.txt"), "w") as f :
+                f.write("resource text")
+            with open(os.path.join(job_folder, "glue_py_resources", "helpers.py"), "w") as f :
+                f.write("VALUE = 42\n")
+            # A local stand in for awsglue
+            os.makedirs(os.path.join(td, "stand_in", "awsglue"))
+            open(os.path.join(td, "stand_in", "awsglue", "__init__.py"), "w").close()
+            with open(os.path.join(td, "stand_in", "awsglue", "utils.py"), "w") as f :
+                f.write("def getResolvedOptions(argv, names) :\n    return {n : argv[argv.index('--' + n) + 1] for n in names}\n")
+            with open(os.path.join(job_folder, "job.py"), "w") as f :
+                f.write("\n".join([
+                    "import json, os, sys",
+                    "from awsglue.utils import getResolvedOptions",
+                    "import helpers",
+                    "args = getResolvedOptions(sys.argv, ['JOB_NAME', 'metadata_base_path', 'output'])",
+                    "out = {'args' : args, 'value' : helpers.VALUE, 'resource' : open('lookup.txt').read(),",
+                    "       'metadata' : os.path.exists(os.path.join(args['metadata_base_path'], 'db_a', 'database.json'))}",
+                    "json.dump(out, open(args['output'], 'w'))",
+                ]))
+
+            output = os.path.join(td, "output.json")
+            g = GlueJob(job_folder, bucket = 'alpha-everyone', job_role = 'alpha_user_isichei', job_arguments = {'--output' : output})
+            g.run_local(python_path = [os.path.join(td, "stand_in")])
+
+            out = read_json(output)
+            self.assertEqual(out['args']['JOB_NAME'], 'job1')
+            self.assertEqual((out['value'], out['resource'], out['metadata']), (42, 'resource text', True))
+
+            with open(os.path.join(job_folder, "job.py"), "w") as f :
+                f.write("raise RuntimeError('bad job')")
+            with self.assertRaises(JobFailed) as cm :
+                g.run_local(capture_output = True)
+            self.assertIn('bad job', str(cm.exception))
+
+    def test_worker_type(self) :
+        g = GlueJob('example/glue_jobs/simple_etl_job/', bucket = 'alpha-everyone', job_role = 'alpha_user_isichei')
+        self.assertEqual(g._job_definition()['AllocatedCapacity'], 2)
+
+        g.worker_type = 'G.2X'
+        g.number_of_workers = 10
+        g.glue_version = '2.0'
+        job_def = g._job_definition()
+        self.assertNotIn('AllocatedCapacity', job_def)
+        self.assertEqual(job_def['WorkerType'], 'G.2X')
+        self.assertEqual(job_def['NumberOfWorkers'], 10)
+        self.assertEqual(job_def['GlueVersion'], '2.0')
+
+        with self.assertRaises(ValueError) :
+            g.worker_type = 'G.3X'
+
+    def test_sizing_policy(self) :
+        policy = SizingPolicy(bytes_per_worker = 100, min_workers = 2, max_workers = 20)
+        self.assertEqual(policy.estimate_workers(50), 2)
+        self.assertEqual(policy.estimate_workers(1001), 11)
+        self.assertEqual(policy.estimate_workers(10**6), 20)
+
+        # Previous runs took 600 seconds on 4 workers so 8 workers are needed to hit 300 seconds
+        policy.target_duration = 300
+        self.assertEqual(policy.estimate_workers(50, [(600, 4), (100, 4), (700, 4)]), 8)
+
+        db = read_database_folder('example/meta_data/db1/')
+        fake_s3 = FakeS3Client({'database/database1/employees/a.parquet' : b'x' * 250, 'database/database1/pay/a.csv' : b'x' * 250})
+        g = GlueJob('example/glue_jobs/simple_etl_job/', bucket = 'alpha-everyone', job_role = 'alpha_user_isichei')
+        g.sizing_policy = SizingPolicy(worker_type = 'G.1X', bytes_per_worker = 100)
+        g.input_tables = [db.table('employees'), db.table('pay')]
+        fake_glue = mock.Mock()
+        fake_glue.get_job_runs.return_value = {'JobRuns' : [{'JobRunState' : 'FAILED', 'ExecutionTime' : 10000, 'NumberOfWorkers' : 2}]}
+        with mock.patch('etl_manager.utils._s3_client', fake_s3), mock.patch('etl_manager.etl._glue_client', fake_glue) :
+            g.apply_sizing_policy()
+        self.assertEqual(g.worker_type, 'G.1X')
+        self.assertEqual(g.number_of_workers, 5)
+
+        # Durations of earlier runs come from the run history as glue deletes the job (and its runs) after each run
+        g.sizing_policy.target_duration = 300
+        with tempfile.TemporaryDirectory() as td :
+            g.run_history = JobRunHistory(os.path.join(td, 'history.db'))
+            for i, (state, execution_time) in enumerate([('SUCCEEDED', 600), ('FAILED', 10000), ('SUCCEEDED', 700), ('SUCCEEDED', 100)]) :
+                g.run_history.record({'Id' : 'jr_{}'.format(i), 'JobName' : g.job_name, 'JobRunState' : state, 'CompletedOn' : '2018-01-0{}'.format(i + 1), 'ExecutionTime' : execution_time, 'NumberOfWorkers' : 4})
+            fake_glue.get_job_runs.side_effect = AssertionError('glue should not be asked for runs of a deleted job')
+            with mock.patch('etl_manager.utils._s3_client', fake_s3), mock.patch('etl_manager.etl._glue_client', fake_glue) :
+                g.apply_sizing_policy()
+        self.assertEqual(g.number_of_workers, 8)
+
+    def test_job_run_history(self) :
+        g = GlueJob('example/glue_jobs/simple_etl_job/', bucket = 'alpha-everyone', job_role = 'alpha_user_isichei')
+        g._job_run_id = 'run_new'
+        self.assertEqual(len(g.resources_hash), 64)
+        self.assertEqual(g.arguments_hash, GlueJob('example/glue_jobs/simple_etl_job/', bucket = 'alpha-everyone', job_role = 'alpha_user_isichei').arguments_hash)
+
+        with tempfile.TemporaryDirectory() as td :
+            history = JobRunHistory(os.path.join(td, 'history.db'), min_runs = 5)
+            for i, t in enumerate([100, 110, 90, 105, 95, 100]) :
+                self.assertFalse(history.record({'Id' : f'run_{i}', 'JobName' : g.job_name, 'JobRunState' : 'SUCCEEDED', 'ExecutionTime' : t, 'CompletedOn' : f'2018-01-0{i + 1}'}))
+            history.record({'Id' : 'run_failed', 'JobName' : g.job_name, 'JobRunState' : 'FAILED', 'ExecutionTime' : 5})
+
+            self.assertEqual(history.duration_percentiles(g.job_name), {'p50' : 100, 'p95' : 110})
+            self.assertTrue(history.is_regression(g.job_name, 200))
+            self.assertFalse(history.is_regression(g.job_name, 120))
+
+            g.run_history = history
+            fake_glue = mock.Mock()
+            fake_glue.get_job_run.return_value = {'JobRun' : {'Id' : 'run_new', 'JobName' : g.job_name, 'JobRunState' : 'SUCCEEDED', 'ExecutionTime' : 300, 'CompletedOn' : '2018-01-09'}}
+            with mock.patch('etl_manager.etl._glue_client', fake_glue), mock.patch('etl_manager.etl.time.sleep'), warnings.catch_warnings(record = True) as w :
+                warnings.simplefilter('always')
+                g.wait_for_completion()
+            self.assertEqual(len(w), 1)
+
+            runs = history.runs(g.job_name)
+            self.assertEqual(len(runs), 8)
+            self.assertEqual(runs[-1]['run_id'], 'run_new')
+            self.assertEqual(runs[-1]['is_regression'], 1)
+            self.assertEqual(runs[-1]['resources_hash'], g.resources_hash)
+
+    def test_async_job(self) :
+        jobs = [GlueJob('example/glue_jobs/simple_etl_job/', bucket = 'alpha-everyone', job_role = 'alpha_user_isichei', job_name = f'job_{i}') for i in range(3)]
+        states = {j.job_name : iter(['RUNNING', 'RUNNING', 'SUCCEEDED' if j.job_name != 'job_2' else 'FAILED']) for j in jobs}
+
+        fake_glue = mock.MagicMock()
+        fake_glue.start_job_run.side_effect = lambda JobName, Arguments : {'JobRunId' : JobName + '_run'}
+        fake_glue.get_job_run.side_effect = lambda JobName, RunId : {'JobRun' : {'JobRunState' : next(states[JobName]), 'ErrorMessage' : 'bad data'}}
+
+        async def run(job) :
+            await job.run_job_async(sync_to_s3_before_run = False)
+            await job.wait_for_completion_async(poll_interval = 0)
+            return job.job_run_id
+
+        async def run_all() :
+            return await asyncio.gather(*[run(j) for j in jobs], return_exceptions = True)
+
+        with mock.patch('etl_manager.etl._glue_client', fake_glue) :
+            loop = asyncio.new_event_loop()
+            try :
+                results = loop.run_until_complete(run_all())
+            finally :
+                loop.close()
+
+        self.assertEqual(results[:2], ['job_0_run', 'job_1_run'])
+        self.assertIsInstance(results[2], JobFailed)
+        self.assertEqual(fake_glue.get_job_run.call_count, 9)
+
+    def test_incremental_job(self) :
+        g = GlueJob('example/glue_jobs/simple_etl_job/', bucket = 'alpha-everyone', job_role = 'alpha_user_isichei')
+        self.assertEqual(g._job_definition()['DefaultArguments']['--job-bookmark-option'], 'job-bookmark-disable')
+        g.incremental = True
+        self.assertEqual(g._job_definition()['DefaultArguments']['--job-bookmark-option'], 'job-bookmark-enable')
+
+        fake_glue = mock.MagicMock()
+        fake_glue.start_job_run.return_value = {'JobRunId' : 'run_1'}
+        with mock.patch('etl_manager.etl._glue_client', fake_glue), mock.patch('etl_manager.etl._s3_resource') :
+            g.run_job(sync_to_s3_before_run = False)
+            fake_glue.delete_job.assert_not_called()
+            fake_glue.create_job.assert_not_called()
+            self.assertEqual(fake_glue.update_job.call_args[1]['JobName'], g.job_name)
+            self.assertNotIn('Name', fake_glue.update_job.call_args[1]['JobUpdate'])
+            self.assertEqual(g.job_run_id, 'run_1')
+
+            g.reset_job_bookmark()
+            fake_glue.reset_job_bookmark.assert_called_with(JobName = g.job_name)
+            g.get_job_bookmark()
+            fake_glue.get_job_bookmark.assert_called_with(JobName = g.job_name)
+
+            g.cleanup()
+            fake_glue.delete_job.assert_not_called()
+
 class TableTest(unittest.TestCase):
 
     def test_table_init(self):
@@ -87,6 +460,122 @@ class TableTest(unittest.TestCase):
         gtd = tm.glue_table_definition("full_db_path")
         self.assertTrue(gtd["StorageDescriptor"]["Location"] == 'full_db_path/teams/')
 
+    def test_bucketing(self) :
+        tm = read_table_json('example/meta_data/db1/teams.json')
+        tm.set_bucketing(['employee_id'], 16)
+        tm.sort_columns = ['employee_id', {'name' : 'team_id', 'order' : 'desc'}]
+
+        gtd = tm.glue_table_definition('db_path')
+        self.assertEqual(gtd['StorageDescriptor']['NumberOfBuckets'], 16)
+        self.assertEqual(gtd['StorageDescriptor']['BucketColumns'], ['employee_id'])
+        self.assertEqual(gtd['StorageDescriptor']['SortColumns'], [{'Column' : 'employee_id', 'SortOrder' : 1}, {'Column' : 'team_id', 'SortOrder' : 0}])
+
+        with tempfile.TemporaryDirectory() as tmpdirname :
+            tm.write_to_json(os.path.join(tmpdirname, 'teams.json'))
+            tm2 = read_table_json(os.path.join(tmpdirname, 'teams.json'))
+        self.assertDictEqual(tm.to_dict(), tm2.to_dict())
+        self.assertEqual(tm2.number_of_buckets, 16)
+
+        with self.assertRaises(ValueError) :
+            tm.set_bucketing(['snapshot_year'], 4)
+        with self.assertRaises(ValueError) :
+            tm.set_bucketing(['employee_id'], None)
+        with self.assertRaises(ValueError) :
+            tm.sort_columns = ['not_a_column']
+
+        tm.remove_column('employee_id')
+        self.assertEqual(tm.bucket_columns, [])
+        self.assertIsNone(tm.number_of_buckets)
+        self.assertEqual(tm.sort_columns, [{'name' : 'team_id', 'order' : 'desc'}])
+        self.assertEqual(tm.glue_table_definition('db_path')['StorageDescriptor']['NumberOfBuckets'], -1)
+
+    def test_partition_projection(self) :
+        tm = read_table_json('example/meta_data/db1/teams.json')
+        projection = {
+            'snapshot_year' : {'type' : 'integer', 'range' : [2018, 2030]},
+            'snapshot_month' : {'type' : 'integer', 'range' : '1,12', 'digits' : 2}
+        }
+        tm.partition_projection = projection
+        self.assertTrue(tm.is_projected)
+
+        params = tm.glue_table_definition('s3://bucket/db')['Parameters']
+        self.assertEqual(params['projection.enabled'], 'true')
+        self.assertEqual(params['projection.snapshot_year.type'], 'integer')
+        self.assertEqual(params['projection.snapshot_year.range'], '2018,2030')
+        self.assertEqual(params['projection.snapshot_month.digits'], '2')
+        self.assertEqual(params['storage.location.template'], 's3://bucket/db/teams/snapshot_year=${snapshot_year}/snapshot_month=${snapshot_month}/')
+
+        with tempfile.TemporaryDirectory() as tmpdirname :
+            tm.write_to_json(os.path.join(tmpdirname, 'teams.json'))
+            tm2 = read_table_json(os.path.join(tmpdirname, 'teams.json'))
+        self.assertEqual(tm2.partition_projection, projection)
+
+        # Projected tables do not need their partitions refreshing
+        backend = FakeAthenaBackend()
+        tm.refresh_paritions('s3://bucket/temp/', 'db', backend = backend)
+        self.assertEqual(backend.executed, [])
+
+        with self.assertRaises(ValueError) :
+            tm.partition_projection = {'snapshot_year' : {'type' : 'integer', 'range' : [2018, 2030]}}
+        with self.assertRaises(ValueError) :
+            tm.partition_projection = {'snapshot_year' : {'type' : 'date', 'range' : ['2018-01-01', 'NOW']}, 'snapshot_month' : {'type' : 'injected'}}
+        with self.assertRaises(ValueError) :
+            tm.partition_projection = {'team_id' : {'type' : 'injected'}}
+
+        tm.partition_projection = {}
+        self.assertNotIn('projection.enabled', tm.glue_table_definition('s3://bucket/db')['Parameters'])
+
+    def test_partition_indexes(self) :
+        tm = read_table_json('example/meta_data/db1/teams.json')
+        self.assertEqual(tm.partition_indexes, {})
+        self.assertNotIn('partition_indexes', tm.to_dict())
+
+        tm.partition_indexes = {'by_year' : ['snapshot_year'], 'by_year_month' : ['snapshot_year', 'snapshot_month']}
+        self.assertEqual(tm.glue_partition_indexes()[1], {'Keys' : ['snapshot_year', 'snapshot_month'], 'IndexName' : 'by_year_month'})
+        with tempfile.TemporaryDirectory() as tmpdirname :
+            tm.write_to_json(os.path.join(tmpdirname, 'teams.json'))
+            self.assertEqual(read_table_json(os.path.join(tmpdirname, 'teams.json')).partition_indexes, tm.partition_indexes)
+
+        with self.assertRaises(ValueError) :
+            tm.partition_indexes = {'by_team' : ['team_id']}
+        with self.assertRaises(ValueError) :
+            tm.partition_indexes = {'a' : ['snapshot_year'], 'b' : ['snapshot_month'], 'c' : ['snapshot_year', 'snapshot_month'], 'd' : ['snapshot_month', 'snapshot_year']}
+
+        # Renaming a partition renames it in the indexes, removing it drops the indexes that use it
+        tm.update_column('snapshot_month', new_name = 'month')
+        self.assertEqual(tm.partition_indexes['by_year_month'], ['snapshot_year', 'month'])
+        tm.remove_column('month')
+        self.assertEqual(tm.partition_indexes, {'by_year' : ['snapshot_year']})
+
+    def test_compression(self) :
+        tm = read_table_json('example/meta_data/db1/teams.json')
+        self.assertIsNone(tm.compression)
+        self.assertFalse(tm.glue_table_definition('db_path')['StorageDescriptor']['Compressed'])
+
+        tm.compression = 'snappy'
+        gtd = tm.glue_table_definition('db_path')
+        self.assertTrue(gtd['StorageDescriptor']['Compressed'])
+        self.assertEqual(gtd['StorageDescriptor']['Parameters']['compressionType'], 'snappy')
+        self.assertEqual(gtd['Parameters']['parquet.compression'], 'SNAPPY')
+        self.assertEqual(gtd['Parameters']['classification'], 'parquet')
+
+        with tempfile.TemporaryDirectory() as tmpdirname :
+            tm.write_to_json(os.path.join(tmpdirname, 'teams.json'))
+            tm2 = read_table_json(os.path.join(tmpdirname, 'teams.json'))
+        self.assertEqual(tm2.compression, 'snappy')
+
+        # gzip is valid for parquet and csv but snappy is not valid for csv
+        with self.assertRaises(ValueError) :
+            tm.data_format = 'csv'
+        tm.compression = 'gzip'
+        tm.data_format = 'csv'
+        self.assertEqual(tm.glue_table_definition('db_path')['StorageDescriptor']['Parameters']['compressionType'], 'gzip')
+        with self.assertRaises(ValueError) :
+            tm.compression = 'zstd'
+
+        tm.compression = 'none'
+        self.assertIsNone(tm.compression)
+        self.assertNotIn('compression', tm.to_dict())
 
 
 class DatabaseMetaTest(unittest.TestCase):
@@ -136,6 +625,84 @@ class DatabaseMetaTest(unittest.TestCase):
             with self.assertRaises(FileNotFoundError) : 
                 tr = read_json(os.path.join(tmpdirname, 'table1.json'))
 
+    def test_db_write_only_dirty_tables(self) :
+        db = read_database_folder('example/meta_data/db1/')
+        self.assertFalse(any(db.table(t).is_dirty for t in db.table_names))
+
+        with tempfile.TemporaryDirectory() as tmpdirname :
+            db.write_to_json(tmpdirname)
+            self.assertFalse(any(db.table(t).is_dirty for t in db.table_names))
+            mtimes = {t : os.stat(os.path.join(tmpdirname, t + '.json')).st_mtime_ns for t in db.table_names}
+
+            db.table('teams').description = 'new description'
+            self.assertTrue(db.table('teams').is_dirty)
+            with mock.patch('etl_manager.meta.write_json', wraps = write_json) as mock_write :
+                db.write_to_json(tmpdirname)
+            written = sorted(os.path.basename(c[0][1]) for c in mock_write.call_args_list)
+            self.assertEqual(written, ['database.json', 'teams.json'])
+            self.assertEqual(read_json(os.path.join(tmpdirname, 'teams.json'))['description'], 'new description')
+            self.assertEqual(os.stat(os.path.join(tmpdirname, 'pay.json')).st_mtime_ns, mtimes['pay'])
+
+            # In place edits are written too
+            db.table('pay').columns[0]['description'] = 'edited in place'
+            db.table('employees').partitions.append('employee_id')
+            self.assertTrue(db.table('pay').is_dirty)
+            db.write_to_json(tmpdirname)
+            self.assertEqual(read_json(os.path.join(tmpdirname, 'pay.json'))['columns'][0]['description'], 'edited in place')
+            self.assertIn('employee_id', read_json(os.path.join(tmpdirname, 'employees.json'))['partitions'])
+            self.assertFalse(any(db.table(t).is_dirty for t in db.table_names))
+
+            # identical content is not rewritten and no temp files are left behind
+            self.assertFalse(write_json(db.table('teams').to_dict(), os.path.join(tmpdirname, 'teams.json')))
+            self.assertEqual(sorted(os.listdir(tmpdirname)), ['database.json', 'employees.json', 'pay.json', 'teams.json'])
+
+    def test_write_json_file_mode(self) :
+        with tempfile.TemporaryDirectory() as tmpdirname :
+            plain_path = os.path.join(tmpdirname, 'plain.json')
+            with open(plain_path, 'w') as f :
+                f.write('{}')
+            new_path = os.path.join(tmpdirname, 'new.json')
+            write_json({'a' : 1}, new_path)
+            self.assertEqual(os.stat(new_path).st_mode, os.stat(plain_path).st_mode)
+
+            # The mode of an existing file is kept
+            os.chmod(new_path, 0o640)
+            write_json({'a' : 2}, new_path)
+            self.assertEqual(os.stat(new_path).st_mode & 0o777, 0o640)
+
+    def test_read_s3_database_folder(self) :
+        objects = {}
+        for f in os.listdir('example/meta_data/db1/') :
+            with open(os.path.join('example/meta_data/db1/', f), 'rb') as fh :
+                objects['meta_data/db1/' + f] = fh.read()
+        objects['meta_data/db1/notes.txt'] = b'not meta data'
+        objects['meta_data/db1/old/teams.json'] = b'{}'
+        fake_s3 = FakeS3Client(objects)
+
+        local_db = read_database_folder('example/meta_data/db1/')
+        with tempfile.TemporaryDirectory() as td, mock.patch('etl_manager.utils._s3_client', fake_s3) :
+            db = read_database_folder('s3://my-bucket/meta_data/db1', cache_dir = td)
+            self.assertEqual(db.to_dict(), local_db.to_dict())
+            self.assertEqual(sorted(db.table_names), sorted(local_db.table_names))
+            self.assertEqual(db.table('teams').to_dict(), local_db.table('teams').to_dict())
+            self.assertEqual(len([c for c in fake_s3.calls if c[0] == 'get_object']), len(local_db.table_names) + 1)
+
+            # Unchanged files are read from the cache
+            fake_s3.calls = []
+            read_database_folder('s3://my-bucket/meta_data/db1/', cache_dir = td)
+            self.assertEqual([c for c in fake_s3.calls if c[0] == 'get_object'], [])
+
+            # A changed file is fetched again
+            teams = json.loads(objects['meta_data/db1/teams.json'].decode('utf-8'))
+            teams['description'] = 'changed'
+            fake_s3.objects['meta_data/db1/teams.json'] = json.dumps(teams).encode('utf-8')
+            db = read_database_folder('s3://my-bucket/meta_data/db1/', cache_dir = td)
+            self.assertEqual([c[1] for c in fake_s3.calls if c[0] == 'get_object'], ['meta_data/db1/teams.json'])
+            self.assertEqual(db.table('teams').description, 'changed')
+
+            # A conditional get of an unchanged file is served from the cache
+            self.assertEqual(_read_s3_json('my-bucket', 'meta_data/db1/teams.json', cache_dir = td)['description'], 'changed')
+
     def test_db_value_properties(self) :
         db = read_database_folder('example/meta_data/db1/')
         db.name = 'new_name'
@@ -205,6 +772,136 @@ class DatabaseMetaTest(unittest.TestCase):
         location = gtd["StorageDescriptor"]["Location"]
         self.assertTrue(location == 's3://my-bucket/database/database1/teams/')
 
+    def test_query(self) :
+        db = read_database_folder('example/meta_data/db1/')
+        rows = [('1', 'a', '2018-01-01'), ('2', 'b', '')]
+        fake_conn = FakeAthenaConnection([('employee_id',), ('employee_name',), ('employee_dob',)], rows)
+        with mock.patch('etl_manager.athena._default_backend', fake_conn) :
+            batches = db.query('SELECT * FROM employees', batch_size = 1)
+            self.assertEqual(fake_conn.executed, [])
+            self.assertEqual(list(batches), [[{'employee_id' : '1', 'employee_name' : 'a', 'employee_dob' : '2018-01-01'}], [{'employee_id' : '2', 'employee_name' : 'b', 'employee_dob' : ''}]])
+            self.assertEqual(fake_conn.fetch_sizes, [1, 1, 1])
+            self.assertTrue(fake_conn.closed)
+            self.assertEqual(fake_conn.connect_kwargs['s3_staging_dir'], db.s3_athena_temp_folder)
+
+        fake_conn = FakeAthenaConnection([('employee_id',), ('employee_name',), ('employee_dob',)], rows)
+        with mock.patch('etl_manager.athena._default_backend', fake_conn) :
+            batches = list(db.query('SELECT * FROM employees', convert_types = True))
+        self.assertEqual(batches, [[{'employee_id' : 1, 'employee_name' : 'a', 'employee_dob' : datetime.date(2018, 1, 1)}, {'employee_id' : 2, 'employee_name' : 'b', 'employee_dob' : None}]])
+
+    def test_update_partition_indexes(self) :
+        db = read_database_folder('example/meta_data/db1/')
+        db.table('teams').partition_indexes = {'by_year' : ['snapshot_year'], 'by_month' : ['snapshot_month']}
+
+        # Glue has an index with the same name but different columns and one that is not declared
+        glue_indexes = {
+            'by_month' : {'IndexName' : 'by_month', 'Keys' : [{'Name' : 'snapshot_year', 'Type' : 'int'}], 'IndexStatus' : 'ACTIVE'},
+            'old_index' : {'IndexName' : 'old_index', 'Keys' : [{'Name' : 'snapshot_year', 'Type' : 'int'}], 'IndexStatus' : 'ACTIVE'},
+        }
+
+        def get_partition_indexes(DatabaseName, TableName, **kwargs) :
+            indexes = list(glue_indexes.values()) if TableName == 'teams' else []
+            response = {'PartitionIndexDescriptorList' : [dict(i) for i in indexes]}
+            # Creation and deletion complete by the next call
+            for k, i in list(glue_indexes.items()) :
+                if i['IndexStatus'] == 'DELETING' :
+                    del glue_indexes[k]
+                elif i['IndexStatus'] == 'CREATING' :
+                    i['IndexStatus'] = 'ACTIVE'
+            return response
+
+        def delete_partition_index(DatabaseName, TableName, IndexName) :
+            glue_indexes[IndexName]['IndexStatus'] = 'DELETING'
+
+        def create_partition_index(DatabaseName, TableName, PartitionIndex) :
+            keys = [{'Name' : k, 'Type' : 'int'} for k in PartitionIndex['Keys']]
+            glue_indexes[PartitionIndex['IndexName']] = {'IndexName' : PartitionIndex['IndexName'], 'Keys' : keys, 'IndexStatus' : 'CREATING'}
+
+        fake_glue = mock.Mock()
+        fake_glue.get_partition_indexes.side_effect = get_partition_indexes
+        fake_glue.delete_partition_index.side_effect = delete_partition_index
+        fake_glue.create_partition_index.side_effect = create_partition_index
+
+        with mock.patch('etl_manager.meta._glue_client', fake_glue), mock.patch('etl_manager.meta.time.sleep') :
+            created = db.update_partition_indexes(table_names = ['teams', 'employees'])
+
+        self.assertEqual(created, {'teams' : ['by_year', 'by_month'], 'employees' : []})
+        self.assertEqual(sorted(glue_indexes), ['by_month', 'by_year'])
+        self.assertEqual([k['Name'] for k in glue_indexes['by_month']['Keys']], ['snapshot_month'])
+        self.assertTrue(all(i['IndexStatus'] == 'ACTIVE' for i in glue_indexes.values()))
+
+    def test_read_glue_database(self) :
+        db = read_database_folder('example/meta_data/db1/')
+        db.table('teams').compression = 'gzip'
+        db.table('teams').set_bucketing(['employee_id'], 4)
+        glue_tables = []
+        for i, t in enumerate(db._tables) :
+            gtd = t.glue_table_definition()
+            gtd['StorageDescriptor']['Columns'][0]['Type'] = gtd['StorageDescriptor']['Columns'][0]['Type'].upper()
+            gtd['UpdateTime'] = datetime.datetime(2018, 1, 1)
+            glue_tables.append(gtd)
+
+        fake_glue = mock.Mock()
+        fake_glue.get_database.return_value = {'Database' : {'Name' : db.name, 'Description' : db.description}}
+        fake_glue.get_tables.side_effect = lambda DatabaseName, NextToken = None : {'TableList' : glue_tables[:2], 'NextToken' : 'page2'} if NextToken is None else {'TableList' : glue_tables[2:]}
+
+        with tempfile.TemporaryDirectory() as td, mock.patch('etl_manager.meta._glue_client', fake_glue) :
+            cache_path = os.path.join(td, 'catalog.json')
+            glue_db = read_glue_database(db.name, cache_path = cache_path)
+
+            self.assertEqual((glue_db.bucket, glue_db.base_folder, glue_db.description), (db.bucket, db.base_folder, db.description))
+            self.assertEqual(sorted(glue_db.table_names), sorted(db.table_names))
+            for t in db._tables :
+                expected = t.to_dict()
+                actual = glue_db.table(t.name).to_dict()
+                for k in ['columns', 'partitions', 'data_format', 'location', 'compression', 'bucket_columns', 'number_of_buckets'] :
+                    self.assertEqual(actual.get(k), expected.get(k), msg = '{} of {}'.format(k, t.name))
+            self.assertEqual(fake_glue.get_tables.call_count, 2)
+
+            # Read again from the cache without calling glue
+            glue_db = read_glue_database(db.name, cache_path = cache_path)
+            self.assertEqual(fake_glue.get_tables.call_count, 2)
+            self.assertEqual(sorted(glue_db.table_names), sorted(db.table_names))
+
+            # Refreshing only converts tables that have changed
+            glue_tables[0]['UpdateTime'] = datetime.datetime(2018, 2, 1)
+            glue_tables[0]['Description'] = 'changed'
+            with mock.patch('etl_manager.meta._glue_table_to_meta_dict', wraps = etl_manager.meta._glue_table_to_meta_dict) as convert :
+                glue_db = read_glue_database(db.name, cache_path = cache_path, refresh = True)
+            self.assertEqual(convert.call_count, 1)
+            self.assertEqual(glue_db.table(glue_tables[0]['Name']).description, 'changed')
+
+    def test_read_glue_database_skips_unsupported_tables(self) :
+        db = read_database_folder('example/meta_data/db1/')
+        glue_tables = [t.glue_table_definition() for t in db._tables]
+        glue_tables[0]['StorageDescriptor']['Columns'][0]['Type'] = 'decimal(10,2)'
+        glue_tables.append({'Name' : 'my_view', 'TableType' : 'VIRTUAL_VIEW', 'StorageDescriptor' : {'Columns' : [{'Name' : 'a', 'Type' : 'int'}]}})
+        glue_tables.append({'Name' : 'nested', 'StorageDescriptor' : dict(glue_tables[1]['StorageDescriptor'], Columns = [{'Name' : 'a', 'Type' : 'array<int>'}])})
+
+        fake_glue = mock.Mock()
+        fake_glue.get_database.return_value = {'Database' : {'Name' : db.name, 'Description' : db.description}}
+        fake_glue.get_tables.return_value = {'TableList' : glue_tables}
+
+        with tempfile.TemporaryDirectory() as td, mock.patch('etl_manager.meta._glue_client', fake_glue) :
+            cache_path = os.path.join(td, 'catalog.json')
+            with warnings.catch_warnings(record = True) as w :
+                warnings.simplefilter('always')
+                glue_db = read_glue_database(db.name, cache_path = cache_path)
+            self.assertEqual(sorted(glue_db.table_names), sorted(t.name for t in db._tables[1:]))
+            self.assertEqual((glue_db.bucket, glue_db.base_folder), (db.bucket, db.base_folder))
+            self.assertEqual(len(w), 1)
+            message = str(w[0].message)
+            self.assertIn('Skipped 3 table(s)', message)
+            for reason in ['decimal(10,2)', 'my_view is a view', 'array<int>'] :
+                self.assertIn(reason, message)
+
+            # Skipped tables are remembered in the cache
+            with warnings.catch_warnings(record = True) as w :
+                warnings.simplefilter('always')
+                glue_db = read_glue_database(db.name, cache_path = cache_path)
+            self.assertEqual(fake_glue.get_tables.call_count, 1)
+            self.assertIn('Skipped 3 table(s)', str(w[0].message))
+
     def test_glue_database_creation(self) :
         session = boto3.Session()
         credentials = session.get_credentials()
@@ -353,5 +1050,503 @@ class TableMetaTest(unittest.TestCase):
         with self.assertRaises(ValueError) :
             tm.update_column('j_cole', new_type = 'int')
 
+    def test_edit(self) :
+        tm = TableMeta(name = "employees", location = "employees/", columns = [
+            {"name": "employee_id", "type": "int", "description": "an ID for each employee"},
+            {"name": "employee_name", "type": "character", "description": "name of the employee"},
+            {"name": "dept", "type": "character", "description": "department"},
+            {"name": "year", "type": "int", "description": "year"}
+        ], partitions = ["dept", "year"])
+        tm.set_bucketing(["employee_id"], 4)
+        tm.sort_columns = ["employee_name"]
+
+        with tm.edit() as e :
+            e.add_column("employee_dob", "date", "date of birth")
+            e.update_column("employee_id", new_name = "emp_id")
+            e.update_column("dept", new_name = "department")
+            e.remove_column("year")
+            e.remove_column("employee_name")
+
+        self.assertEqual(tm.column_names, ["emp_id", "employee_dob", "department"])
+        self.assertEqual(tm.partitions, ["department"])
+        self.assertEqual(tm.bucket_columns, ["emp_id"])
+        self.assertEqual(tm.number_of_buckets, 4)
+        self.assertEqual(tm.sort_columns, [])
+
+        # Changes are checked against the edited columns and nothing is applied if the block fails
+        with self.assertRaises(ValueError) :
+            with tm.edit() as e :
+                e.remove_column("emp_id")
+                e.update_column("emp_id", new_type = "int")
+        with self.assertRaises(ValueError) :
+            with tm.edit() as e :
+                e.update_column("employee_dob", new_name = "department")
+        self.assertEqual(tm.column_names, ["emp_id", "employee_dob", "department"])
+        self.assertEqual(tm.bucket_columns, ["emp_id"])
+
+class InferTableMetaTest(unittest.TestCase):
+    """
+    Test inferring table meta from data files
+    """
+    def _write(self, path, text) :
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        with open(path, 'w') as f :
+            f.write(text)
+
+    def test_infer_column_types(self) :
+        with tempfile.TemporaryDirectory() as td :
+            self._write(os.path.join(td, 'a.csv'), 'id,Big Num,amount,dob,ts,flag,name\n1,99999999999,1.5,2018-01-01,2018-01-01 10:00:00,true,a\n2,,2,2018-02-28,2018-01-01T10:00:00.123,false,"b,c"\n')
+            self._write(os.path.join(td, 'b.csv'), 'id,Big Num,amount,dob,ts,flag,name\n3,1,,,2018-01-02,TRUE,1\n')
+            columns, partitions = infer_column_types(td, chunk_size = 1)
+
+        types = {c['name']: c['type'] for c in columns}
+        self.assertEqual(types, {'id': 'int', 'big_num': 'long', 'amount': 'double', 'dob': 'date', 'ts': 'datetime', 'flag': 'boolean', 'name': 'character'})
+        self.assertEqual(partitions, [])
+
+        # Every column of the file has to be kept for csv data to line up with the meta data
+        with tempfile.TemporaryDirectory() as td :
+            self._write(os.path.join(td, 'a.csv'), 'id,Big Num,big_num\n1,2,3\n')
+            with self.assertRaisesRegex(ValueError, "'Big Num' and 'big_num'") :
+                infer_column_types(td)
+            self._write(os.path.join(td, 'a.csv'), 'id,num,num\n1,2,3\n')
+            with self.assertRaisesRegex(ValueError, "more than one column called 'num'") :
+                infer_column_types(td)
+
+    def test_infer_table_meta(self) :
+        with tempfile.TemporaryDirectory() as td :
+            table_folder = os.path.join(td, 'my_table')
+            self._write(os.path.join(table_folder, 'year=2018', 'month=1', 'a.jsonl'), '{"id": 1, "name": "a", "score": 1.5}\n{"id": 2, "name": null, "score": 2}\n')
+            self._write(os.path.join(table_folder, 'year=2019', 'month=12', 'b.jsonl'), '{"id": 3, "name": "b", "flag": true}\n')
+            tm = infer_table_meta('my_table', table_folder)
+
+        self.assertEqual(tm.location, 'my_table/')
+        self.assertEqual(tm.data_format, 'json')
+        self.assertEqual(tm.partitions, ['year', 'month'])
+        self.assertEqual(tm.column_names, ['id', 'name', 'score', 'flag', 'year', 'month'])
+        self.assertEqual([c['type'] for c in tm.columns], ['int', 'character', 'double', 'boolean', 'int', 'int'])
+
+    def test_infer_csv_table_meta(self) :
+        with tempfile.TemporaryDirectory() as td :
+            self._write(os.path.join(td, 'plain', 'a.csv'), 'id,name\n1,a\n2,b\n')
+            tm = infer_table_meta('plain', os.path.join(td, 'plain'))
+            self.assertEqual(tm.data_format, 'csv')
+            self.assertEqual(tm.glue_table_definition('db_path')['Parameters']['skip.header.line.count'], '1')
+            self.assertTrue(tm.validate_data(os.path.join(td, 'plain'))['valid'])
+
+            # The csv serde does not understand quotes
+            self._write(os.path.join(td, 'quoted', 'a.csv'), 'id,name\n1,"x, y"\n')
+            tm = infer_table_meta('quoted', os.path.join(td, 'quoted'))
+            self.assertEqual(tm.data_format, 'csv_quoted_nodate')
+            self.assertEqual(tm.column_names, ['id', 'name'])
+
+            self._write(os.path.join(td, 'piped', 'a.csv'), '1|a\n')
+            tm = infer_table_meta('piped', os.path.join(td, 'piped'), header = False, delimiter = '|')
+            self.assertEqual(tm.glue_table_definition('db_path')['StorageDescriptor']['SerdeInfo']['Parameters']['field.delim'], '|')
+            self.assertNotIn('skip.header.line.count', tm.glue_table_definition('db_path')['Parameters'])
+            self.assertEqual([c['type'] for c in tm.columns], ['int', 'character'])
+
+            self._write(os.path.join(td, 'header_only', 'a.csv'), 'id,name\n')
+            with warnings.catch_warnings(record = True) as w :
+                warnings.simplefilter('always')
+                tm = infer_table_meta('header_only', os.path.join(td, 'header_only'))
+            self.assertEqual(tm.column_names, ['id', 'name'])
+            self.assertIn('no rows', str(w[0].message))
+
+            self._write(os.path.join(td, 'empty', 'a.csv'), '')
+            with self.assertRaises(ValueError) :
+                infer_table_meta('empty', os.path.join(td, 'empty'))
+
+    def test_validate_data(self) :
+        tm = read_table_json('example/meta_data/db1/teams.json')
+        tm.data_format = 'csv'
+        with tempfile.TemporaryDirectory() as td :
+            self._write(os.path.join(td, 'snapshot_year=2018', 'snapshot_month=1', 'a.csv'), '1,team a,10\n2,team b,11\n')
+            self._write(os.path.join(td, 'snapshot_year=2018', 'snapshot_month=x', 'b.csv'), '3,team c,12\nthree,team d,99999999999\n')
+            report = tm.validate_data(td, chunk_size = 1)
+
+        self.assertFalse(report['valid'])
+        self.assertEqual(report['files'], 2)
+        self.assertEqual(report['rows'], 4)
+        self.assertEqual(report['columns']['team_name']['violations'], 0)
+        self.assertEqual(report['columns']['team_id']['violations'], 1)
+        self.assertEqual(report['columns']['team_id']['samples'][0]['row'], 2)
+        self.assertEqual(report['columns']['team_id']['samples'][0]['value'], 'three')
+        self.assertEqual(report['columns']['employee_id']['violations'], 1)
+        self.assertEqual(report['columns']['snapshot_month']['violations'], 2)
+
+    @unittest.skipIf(pq is None, "pyarrow is not installed")
+    def test_convert_to_parquet(self) :
+        db = read_database_folder('example/meta_data/db1/')
+        tm = db.table('teams')
+        tm.data_format = 'csv'
+        tm.glue_specific = {'Parameters' : {'skip.header.line.count' : '1', 'classification' : 'teams'}}
+        tm.update_column('team_name', new_type = 'date')
+        with tempfile.TemporaryDirectory() as td :
+            self._write(os.path.join(td, 'csv', 'snapshot_year=2018', 'snapshot_month=1', 'a.csv'), '1,2018-01-01,10\n2,,11\n')
+            self._write(os.path.join(td, 'csv', 'snapshot_year=2018', 'snapshot_month=2', 'b.csv'), '3,2018-02-01,12\n')
+            new_tm = tm.convert_to_parquet(os.path.join(td, 'csv'), os.path.join(td, 'parquet'), location = 'teams_parquet/', header = False, row_group_size = 1)
+
+            out_files = sorted(os.path.relpath(os.path.join(r, f), td) for r, _, fs in os.walk(os.path.join(td, 'parquet')) for f in fs)
+            self.assertEqual(out_files, ['parquet/snapshot_year=2018/snapshot_month=1/part-00000.snappy.parquet', 'parquet/snapshot_year=2018/snapshot_month=2/part-00001.snappy.parquet'])
+            pf = pq.ParquetFile(os.path.join(td, out_files[0]))
+            self.assertEqual(pf.metadata.num_row_groups, 2)
+            self.assertEqual(pf.schema_arrow.names, ['team_id', 'team_name', 'employee_id'])
+            self.assertEqual(str(pf.schema_arrow.field('team_name').type), 'date32[day]')
+            self.assertEqual(pf.read().column('team_name').null_count, 1)
+
+        self.assertEqual(new_tm.data_format, 'parquet')
+        self.assertEqual(new_tm.compression, 'snappy')
+        self.assertEqual(new_tm.location, 'teams_parquet/')
+        self.assertEqual(new_tm.partitions, tm.partitions)
+        self.assertEqual(new_tm.columns, tm.columns)
+        self.assertIs(new_tm.database, db)
+        self.assertEqual(new_tm.glue_specific, {'Parameters' : {'classification' : 'teams'}})
+        self.assertEqual(tm.glue_specific['Parameters']['skip.header.line.count'], '1')
+
+        # The header setting and delimiter are read from the table (pay also skips its header in the storage descriptor parameters)
+        pay = db.table('pay')
+        pay.glue_specific['StorageDescriptor']['SerdeInfo'] = {'Parameters' : {'field.delim' : '|'}}
+        with tempfile.TemporaryDirectory() as td :
+            self._write(os.path.join(td, 'csv', 'a.csv'), 'employee_id|annual_salary\n1|1.5\n2|2\n')
+            new_pay = pay.convert_to_parquet(os.path.join(td, 'csv'), os.path.join(td, 'parquet'))
+            self.assertEqual(pq.read_table(os.path.join(td, 'parquet', 'part-00000.snappy.parquet')).column('annual_salary').to_pylist(), [1.5, 2.0])
+        self.assertEqual(new_pay._header_line_count, 0)
+        self.assertNotIn('skip.header.line.count', json.dumps(new_pay.glue_specific))
+
+class PartitionPathTest(unittest.TestCase):
+    """
+    Test finding partition paths from predicates
+    """
+    keys = [
+        'database/database1/teams/snapshot_year=2017/snapshot_month=12/a.parquet',
+        'database/database1/teams/snapshot_year=2018/snapshot_month=1/a.parquet',
+        'database/database1/teams/snapshot_year=2018/snapshot_month=2/a.parquet',
+        'database/database1/teams/snapshot_year=2018/snapshot_month=10/a.parquet',
+        'database/database1/teams/snapshot_year=2019/snapshot_month=1/a.parquet',
+    ]
+
+    def test_get_partition_paths(self) :
+        db = read_database_folder('example/meta_data/db1/')
+        tm = db.table('teams')
+        fake_s3 = FakeS3Client(self.keys)
+        with mock.patch('etl_manager.utils._s3_client', fake_s3) :
+            self.assertEqual(len(tm.get_partition_paths()), 5)
+            fake_s3.calls = []
+
+            paths = tm.get_partition_paths({'snapshot_year' : 2018, 'snapshot_month' : {'>=' : 2}})
+            self.assertEqual(paths, ['s3://my-bucket/database/database1/teams/snapshot_year=2018/snapshot_month=10/', 's3://my-bucket/database/database1/teams/snapshot_year=2018/snapshot_month=2/'])
+            # Equality on the first partition should not list the table root
+            self.assertNotIn('database/database1/teams/', [c[1] for c in fake_s3.calls])
+
+            paths = tm.get_partition_paths({'snapshot_year' : {'>' : 2017}, 'snapshot_month' : [1, 3]})
+            self.assertEqual(paths, ['s3://my-bucket/database/database1/teams/snapshot_year=2018/snapshot_month=1/', 's3://my-bucket/database/database1/teams/snapshot_year=2019/snapshot_month=1/'])
+
+        # Folders that are not of the partition type are excluded from ranges
+        fake_s3 = FakeS3Client(self.keys + [
+            'database/database1/teams/snapshot_year=__HIVE_DEFAULT_PARTITION__/snapshot_month=1/a.parquet',
+            'database/database1/teams/snapshot_year=latest/snapshot_month=1/a.parquet',
+        ])
+        with mock.patch('etl_manager.utils._s3_client', fake_s3) :
+            self.assertEqual(len(tm.get_partition_paths()), 7)
+            paths = tm.get_partition_paths({'snapshot_year' : {'>=' : 2019}})
+            self.assertEqual(paths, ['s3://my-bucket/database/database1/teams/snapshot_year=2019/snapshot_month=1/'])
+
+        with self.assertRaises(ValueError) :
+            tm.get_partition_paths({'team_id' : 1})
+        with self.assertRaises(ValueError) :
+            tm.get_partition_paths({'snapshot_year' : {'!=' : 1}})
+
+class QueryCacheTest(unittest.TestCase):
+    """
+    Test caching athena query results
+    """
+    def test_normalise_sql(self) :
+        self.assertEqual(_normalise_sql("SELECT  *\n FROM employees -- comment\n WHERE name = 'A  B';"), "select * from employees where name = 'A  B'")
+
+    def test_query_cache(self) :
+        db = read_database_folder('example/meta_data/db1/')
+        fake_s3 = FakeS3Client(['database/database1/employees/a.parquet', 'database/database1/teams/a.parquet'])
+        description = [('employee_id',)]
+
+        with tempfile.TemporaryDirectory() as td, mock.patch('etl_manager.utils._s3_client', fake_s3) :
+            cache = QueryCache(td, ttl = 60)
+
+            fake_conn = FakeAthenaConnection(description, [('1',), ('2',)])
+            with mock.patch('etl_manager.athena._default_backend', fake_conn) :
+                first = list(db.query('SELECT employee_id FROM workforce.employees', batch_size = 1, cache = cache))
+                # Same query (modulo formatting) on unchanged data is served from the cache
+                second = list(db.query('select employee_id\nfrom workforce.employees;', batch_size = 1, cache = cache))
+            self.assertEqual(first, second)
+            self.assertEqual(len(fake_conn.executed), 1)
+
+            # Changing data in another table does not invalidate the result
+            fake_s3.objects['database/database1/teams/b.parquet'] = b'new'
+            fake_conn = FakeAthenaConnection(description, [('1',), ('2',)])
+            with mock.patch('etl_manager.athena._default_backend', fake_conn) :
+                list(db.query('SELECT employee_id FROM workforce.employees', batch_size = 1, cache = cache))
+            self.assertEqual(len(fake_conn.executed), 0)
+
+            fake_s3.objects['database/database1/employees/b.parquet'] = b'new'
+            fake_conn = FakeAthenaConnection(description, [('3',)])
+            with mock.patch('etl_manager.athena._default_backend', fake_conn) :
+                third = list(db.query('SELECT employee_id FROM workforce.employees', batch_size = 1, cache = cache))
+            self.assertEqual(third, [[{'employee_id' : '3'}]])
+            self.assertEqual(len(fake_conn.executed), 1)
+
+    def test_query_cache_other_databases(self) :
+        db = read_database_folder('example/meta_data/db1/')
+        other = DatabaseMeta(name = 'other', bucket = 'my-bucket', base_folder = 'database/other')
+        other.add_table(TableMeta('ref', location = 'ref/', data_format = 'parquet'))
+        fake_s3 = FakeS3Client(['database/database1/employees/a.parquet', 'database/other/ref/a.parquet'])
+        sql = 'SELECT e.employee_id FROM workforce.employees e JOIN other.ref r ON e.employee_id = r.id'
+
+        with tempfile.TemporaryDirectory() as td, mock.patch('etl_manager.utils._s3_client', fake_s3) :
+            cache = QueryCache(td, ttl = 60)
+            fake_conn = FakeAthenaConnection([('employee_id',)], [('1',)])
+            with mock.patch('etl_manager.athena._default_backend', fake_conn) :
+                # The data of other.ref can not be fingerprinted so the query is not cached
+                list(db.query(sql, cache = cache))
+                list(db.query(sql, cache = cache))
+                self.assertEqual(len(fake_conn.executed), 2)
+
+                list(db.query(sql, cache = cache, other_databases = [other]))
+                list(db.query(sql, cache = cache, other_databases = [other]))
+                self.assertEqual(len(fake_conn.executed), 3)
+
+                fake_s3.objects['database/other/ref/b.parquet'] = b'new'
+                list(db.query(sql, cache = cache, other_databases = [other]))
+                self.assertEqual(len(fake_conn.executed), 4)
+
+    def test_query_cache_eviction(self) :
+        with tempfile.TemporaryDirectory() as td :
+            cache = QueryCache(td, ttl = 60, max_size_bytes = 100)
+            list(cache.put('a', [[{'x' : 'a' * 60}]]))
+            self.assertTrue('a' in cache)
+            list(cache.get('a'))
+            list(cache.put('b', [[{'x' : 'b' * 60}]]))
+            self.assertFalse('a' in cache)
+            self.assertTrue('b' in cache)
+
+            # Partially consumed results are not cached
+            batches = cache.put('c', [[1], [2]])
+            next(batches)
+            batches.close()
+            self.assertFalse('c' in cache)
+
+            cache.ttl = -1
+            self.assertIsNone(cache.get('b'))
+
+class CompactionTest(unittest.TestCase):
+    """
+    Test choosing partitions to compact and generating the compaction job
+    """
+    def test_compaction_job(self) :
+        db = read_database_folder('example/meta_data/db1/')
+        tm = db.table('teams')
+        prefix = 'database/database1/teams/'
+        objects = {prefix + 'snapshot_year=2018/snapshot_month=1/part-{}.parquet'.format(i) : b'x' * 100 for i in range(30)}
+        objects.update({prefix + 'snapshot_year=2018/snapshot_month=2/part-{}.parquet'.format(i) : b'x' * 1000 for i in range(3)})
+        objects[prefix + 'snapshot_year=2018/snapshot_month=3/part-0.parquet'] = b'x' * 100
+
+        with mock.patch('etl_manager.utils._s3_client', FakeS3Client(objects)) :
+            candidates = tm.compaction_candidates(target_file_size = 1000)
+        # 3000 bytes in 30 files -> 3 files, 3000 bytes in 3 files is already the right size and a single file can't be compacted
+        self.assertEqual(candidates, [{'partition' : 'snapshot_year=2018/snapshot_month=1/', 'values' : ['2018', '1'], 'numFiles' : 30, 'totalSize' : 3000, 'number_of_files' : 3}])
+
+        with tempfile.TemporaryDirectory() as td :
+            job_folder = os.path.join(td, 'glue_jobs', 'compact_teams')
+            tm.compression = 'snappy'
+            g = create_compaction_job(tm, job_folder, bucket = 'alpha-everyone', job_role = 'alpha_user_isichei', partitions = candidates, delete_old_files = True)
+
+            self.assertEqual(g.job_name, 'compact_workforce_teams')
+            self.assertEqual([os.path.basename(p) for p in g.resources], ['compaction.json'])
+            self.assertEqual([os.path.basename(p) for p in g.py_resources], ['glue_spark_runtime.py'])
+            self.assertEqual(g.all_meta_data_paths, [])
+
+            config = read_json(os.path.join(job_folder, 'glue_resources', 'compaction.json'))
+            self.assertEqual(config['table'], 'workforce.teams')
+            self.assertEqual(config['schemas']['workforce.teams']['path'], 's3://my-bucket/database/database1/teams/')
+            self.assertEqual(config['writer'], {'format' : 'parquet', 'options' : {'compression' : 'snappy'}})
+            self.assertEqual(config['partitions'], [{'partition' : 'snapshot_year=2018/snapshot_month=1/', 'values' : ['2018', '1'], 'number_of_files' : 3}])
+            self.assertTrue(config['delete_old_files'])
+            with open(os.path.join(job_folder, 'job.py')) as f :
+                compile(f.read(), 'job.py', 'exec')
+
+        with self.assertRaises(ValueError) :
+            create_compaction_job(db.table('employees'), 'unused', bucket = 'alpha-everyone', job_role = 'alpha_user_isichei', partitions = [])
+
+    def test_compaction_uses_catalog_locations(self) :
+        db = read_database_folder('example/meta_data/db1/')
+        tm = db.table('teams')
+        tm.data_format = 'csv'
+        prefix = 'database/database1/teams/'
+        # month 1 has already been compacted, the old files were kept in its default folder
+        objects = {prefix + 'snapshot_year=2018/snapshot_month={}/part-{}.csv'.format(m, i) : b'x' * 100 for m in [1, 2] for i in range(30)}
+        objects.update({prefix + '_compacted_/jr_1/snapshot_year=2018/snapshot_month=1/part-{}.csv'.format(i) : b'x' * 1000 for i in range(3)})
+        locations = {'1' : 's3://my-bucket/' + prefix + '_compacted_/jr_1/snapshot_year=2018/snapshot_month=1', '2' : 's3://my-bucket/' + prefix + 'snapshot_year=2018/snapshot_month=2/'}
+        fake_glue = mock.Mock()
+        fake_glue.get_partitions.side_effect = lambda DatabaseName, TableName, NextToken = None : {
+            'Partitions' : [{'Values' : ['2018', m], 'StorageDescriptor' : {'Location' : locations[m]}} for m in (['1'] if NextToken is None else ['2'])],
+            **({'NextToken' : 'page2'} if NextToken is None else {})
+        }
+
+        with mock.patch('etl_manager.utils._s3_client', FakeS3Client(objects)), mock.patch('etl_manager.meta._glue_client', fake_glue) :
+            self.assertEqual([c['partition'] for c in tm.compaction_candidates(target_file_size = 1000)], ['snapshot_year=2018/snapshot_month=1/', 'snapshot_year=2018/snapshot_month=2/'])
+            candidates = tm.compaction_candidates(target_file_size = 1000, database_name = 'workforce')
+            self.assertEqual(tm.stats['partitions']['snapshot_year=2018/snapshot_month=1/']['numFiles'], 3)
+            self.assertEqual(tm.stats['partitions']['snapshot_year=2018/snapshot_month=1/']['values'], ['2018', '1'])
+
+            with tempfile.TemporaryDirectory() as td :
+                create_compaction_job(tm, os.path.join(td, 'compact_teams'), bucket = 'alpha-everyone', job_role = 'alpha_user_isichei', target_file_size = 1000)
+                config = read_json(os.path.join(td, 'compact_teams', 'glue_resources', 'compaction.json'))
+        self.assertEqual([c['partition'] for c in candidates], ['snapshot_year=2018/snapshot_month=2/'])
+        self.assertEqual([p['partition'] for p in config['partitions']], ['snapshot_year=2018/snapshot_month=2/'])
+        self.assertEqual(fake_glue.get_partitions.call_args[1]['DatabaseName'], 'workforce')
+
+        # Written the way LazySimpleSerDe reads it
+        self.assertEqual(config['writer']['options']['quote'], '')
+        self.assertEqual(config['writer']['options']['timestampFormat'], 'yyyy-MM-dd HH:mm:ss')
+
+class AthenaBackendTest(unittest.TestCase):
+    """
+    Test the Athena api and fake backends
+    """
+    def test_api_backend(self) :
+        client = mock.MagicMock()
+        client.meta.region_name = 'eu-west-1'
+        client.start_query_execution.return_value = {'QueryExecutionId' : 'q1'}
+        client.get_query_execution.side_effect = [
+            {'QueryExecution' : {'Status' : {'State' : 'RUNNING'}}},
+            {'QueryExecution' : {'Status' : {'State' : 'SUCCEEDED'}, 'StatementType' : 'DML'}},
+        ]
+        column_info = [{'Name' : 'id', 'Type' : 'integer'}, {'Name' : 'name', 'Type' : 'varchar'}]
+        def row(*values) :
+            return {'Data' : [{'VarCharValue' : v} if v is not None else {} for v in values]}
+        client.get_query_results.side_effect = [
+            {'ResultSet' : {'ResultSetMetadata' : {'ColumnInfo' : column_info}, 'Rows' : [row('id', 'name'), row('1', 'a'), row('2', None)]}, 'NextToken' : 't1'},
+            {'ResultSet' : {'ResultSetMetadata' : {'ColumnInfo' : column_info}, 'Rows' : [row('3', 'c')]}},
+        ]
+
+        with mock.patch('etl_manager.athena._athena_client', client), mock.patch('etl_manager.athena.time.sleep') as sleep :
+            conn = AthenaApiConnection(s3_staging_dir = 's3://bucket/temp/', region_name = 'eu-west-1', schema_name = 'db')
+            with conn.cursor() as cursor :
+                cursor.execute('SELECT * FROM t')
+                self.assertEqual([d[0] for d in cursor.description], ['id', 'name'])
+                self.assertEqual(cursor.fetchmany(3), [(1, 'a'), (2, None), (3, 'c')])
+                self.assertEqual(cursor.fetchmany(3), [])
+        self.assertEqual(sleep.call_count, 1)
+        self.assertEqual(client.start_query_execution.call_args[1]['QueryExecutionContext'], {'Database' : 'db'})
+        self.assertEqual(client.get_query_results.call_args[1]['NextToken'], 't1')
+
+        client.get_query_execution.side_effect = [{'QueryExecution' : {'Status' : {'State' : 'FAILED', 'StateChangeReason' : 'bad sql'}}}]
+        with mock.patch('etl_manager.athena._athena_client', client) :
+            with self.assertRaises(AthenaQueryError) :
+                AthenaApiConnection(s3_staging_dir = 's3://bucket/temp/').cursor().execute('SELECT')
+
+    def test_fake_backend(self) :
+        db = read_database_folder('example/meta_data/db1/')
+        backend = FakeAthenaBackend()
+        backend.add_result('select employee_id from employees', ['employee_id'], [(1,), (2,), (3,)])
+
+        with mock.patch('etl_manager.athena._default_backend', 'jdbc') :
+            set_default_backend(backend)
+            batches = list(db.query('SELECT employee_id FROM employees', batch_size = 2))
+            db.table('teams').refresh_paritions()
+            with self.assertRaises(ValueError) :
+                set_default_backend('odbc')
+
+        self.assertEqual(batches, [[{'employee_id' : 1}, {'employee_id' : 2}], [{'employee_id' : 3}]])
+        self.assertEqual([sql for sql, kwargs in backend.executed], ['SELECT employee_id FROM employees', 'MSCK REPAIR TABLE workforce.teams'])
+        self.assertEqual(backend.executed[0][1]['schema_name'], db.name)
+
+class TableStatsTest(unittest.TestCase):
+    """
+    Test collecting table statistics from s3
+    """
+    def test_collect_stats(self) :
+        db = read_database_folder('example/meta_data/db1/')
+        tm = db.table('teams')
+        tm.data_format = 'csv'
+        fake_s3 = FakeS3Client({
+            'database/database1/teams/snapshot_year=2018/snapshot_month=1/a.csv' : b'1,a,1\n2,b,2\n',
+            'database/database1/teams/snapshot_year=2018/snapshot_month=1/b.csv' : b'3,c,3',
+            'database/database1/teams/snapshot_year=2018/snapshot_month=1/_SUCCESS' : b'',
+            'database/database1/teams/snapshot_year=2018/snapshot_month=2/a.csv' : b'4,d,4\n',
+        })
+
+        with mock.patch('etl_manager.utils._s3_client', fake_s3) :
+            stats = tm.collect_stats(row_counts = True)
+            self.assertEqual(stats['numFiles'], 3)
+            self.assertEqual(stats['totalSize'], 23)
+            self.assertEqual(stats['recordCount'], 4)
+            self.assertEqual(stats['partitions']['snapshot_year=2018/snapshot_month=1/']['recordCount'], 3)
+            self.assertEqual(stats['partitions']['snapshot_year=2018/snapshot_month=1/']['values'], ['2018', '1'])
+
+            # Only the changed partition is rescanned
+            fake_s3.objects['database/database1/teams/snapshot_year=2018/snapshot_month=2/a.csv'] = b'4,d,4\n5,e,5\n'
+            fake_s3.calls = []
+            stats = tm.collect_stats(row_counts = True)
+            self.assertEqual(stats['recordCount'], 5)
+            self.assertEqual([c[1] for c in fake_s3.calls if c[0] == 'get_object'], ['database/database1/teams/snapshot_year=2018/snapshot_month=2/a.csv'])
+
+        gtd = tm.glue_table_definition()
+        self.assertEqual(gtd['Parameters']['numFiles'], '3')
+        self.assertEqual(gtd['Parameters']['recordCount'], '5')
+
+        partition_inputs = tm.glue_partition_inputs(gtd)
+        self.assertEqual([p['Values'] for p in partition_inputs], [['2018', '1'], ['2018', '2']])
+        self.assertEqual(partition_inputs[1]['Parameters'], {'numFiles' : '1', 'totalSize' : '12', 'recordCount' : '2'})
+        self.assertEqual(partition_inputs[1]['StorageDescriptor']['Location'], 's3://my-bucket/database/database1/teams/snapshot_year=2018/snapshot_month=2/')
+
+    def test_collect_stats_compressed_with_header(self) :
+        tm = TableMeta('test', location = 'test/', data_format = 'csv', glue_specific = {'Parameters' : {'skip.header.line.count' : '1'}})
+        fake_s3 = FakeS3Client({
+            'test/a.csv.bz2' : bz2.compress(b'a,b\n1,2\n3,4\n'),
+            # concatenated gzip members
+            'test/b.csv.gz' : gzip.compress(b'a,b\n1,2\n') + gzip.compress(b'3,4\n5,6'),
+            'test/c.csv' : b'a,b\n7,8\n',
+        })
+        with mock.patch('etl_manager.utils._s3_client', fake_s3) :
+            stats = tm.collect_stats('s3://bucket/', row_counts = True)
+        self.assertEqual(stats['recordCount'], 6)
+
+        tm.compression = 'gzip'
+        with mock.patch('etl_manager.utils._s3_client', FakeS3Client({'test/a' : gzip.compress(b'a,b\n1,2\n')})) :
+            self.assertEqual(tm.collect_stats('s3://bucket/', row_counts = True)['recordCount'], 1)
+
+        tm.compression = None
+        tm.data_format = 'json'
+        with mock.patch('etl_manager.utils._s3_client', FakeS3Client({'test/a.json.bz2' : bz2.compress(b'{}\n{}\n')})) :
+            self.assertEqual(tm.collect_stats('s3://bucket/', row_counts = True)['recordCount'], 2)
+
+    def test_create_glue_database_partition_errors(self) :
+        db = DatabaseMeta(name = 'test_db', bucket = 'my-bucket')
+        tm = TableMeta('test', location = 'test/', data_format = 'csv', partitions = ['year'], columns = [{'name' : 'year', 'type' : 'int', 'description' : ''}])
+        db.add_table(tm)
+        fake_s3 = FakeS3Client({'test/year=2018/a.csv' : b'1\n', 'test/year=2019/a.csv' : b'2\n'})
+        with mock.patch('etl_manager.utils._s3_client', fake_s3) :
+            tm.collect_stats()
+
+        fake_glue = mock.MagicMock()
+        fake_glue.batch_create_partition.return_value = {'Errors' : [{'PartitionValues' : ['2019'], 'ErrorDetail' : {'ErrorCode' : 'AlreadyExistsException', 'ErrorMessage' : 'Partition already exists.'}}]}
+        with mock.patch('etl_manager.meta._glue_client', fake_glue) :
+            with self.assertRaisesRegex(RuntimeError, "1 partition.*2019: Partition already exists") :
+                db.create_glue_database()
+        self.assertEqual(len(fake_glue.batch_create_partition.call_args[1]['PartitionInputList']), 2)
+
+    @unittest.skipIf(pq is None, "pyarrow is not installed")
+    def test_parquet_row_count(self) :
+        import pyarrow as pa
+        buffer = io.BytesIO()
+        pq.write_table(pa.table({'a' : list(range(100))}), buffer)
+        data = buffer.getvalue()
+
+        tm = TableMeta('test', location = 'test/', data_format = 'parquet')
+        fake_s3 = FakeS3Client({'test/a.parquet' : data})
+        with mock.patch('etl_manager.utils._s3_client', fake_s3) :
+            stats = tm.collect_stats('s3://bucket/', row_counts = True)
+        self.assertEqual(stats['recordCount'], 100)
+        self.assertEqual(stats['partitions'][''], {'values' : [], 'numFiles' : 1, 'totalSize' : len(data), 'recordCount' : 100, 'signature' : stats['partitions']['']['signature']})
+
 if __name__ == '__main__':
     unittest.main()